@@ -0,0 +1,296 @@
+"""Load generator for the serving stack.
+
+Sends streamed chat completions at each level of concurrency of a sweep and
+reports time to first token, inter-token latency, end to end latency with
+their p50/p95/p99 and requests and tokens per second as JSON, to compare
+runs.
+
+Without :code:`--url` the whole chain runs in this process: the manager app
+of :func:`hacky_llama.service.model_manager_app` relays to a worker app whose
+engine is the :class:`FakeGemmaLib` of :mod:`hacky_llama.fake_engine`, at
+:code:`--tokens_per_second`. Both are served on localhost, as responses are
+only streamed over real connections. With :code:`--url` a running manager or
+worker is driven instead.
+
+The prompts, response lengths and images are drawn with :code:`--seed`, so
+that runs get the same requests.
+
+Usage:
+    python -m benchmarks.load [--concurrency 1,4,16] [--requests 64]
+        [--prompt_words 16:256] [--output_tokens 16:128] [--image_ratio 0.1]
+        [--url http://localhost:8000] [--out report.json]
+"""
+from typing import Optional
+from contextlib import asynccontextmanager
+from io import BytesIO
+import argparse
+import asyncio
+import base64
+import json
+import random
+import socket
+import sys
+import time
+
+import httpx
+
+from hacky_llama import service, worker
+from hacky_llama.fake_engine import FakeGemmaLib, fake_worker_app
+
+
+WORDS = ["the", "quick", "brown", "fox", "jumps", "over", "lazy", "dog", "while", "seven",
+         "wizards", "quietly", "brew", "strong", "coffee", "at", "dawn"]
+
+
+class Workload:
+    """The requests of a benchmark, drawn deterministically from :code:`seed`.
+
+    Args:
+        prompt_words: Range of the number of words of a prompt
+        output_tokens: Range of the number of tokens to generate
+        image_ratio: Fraction of requests with an image
+        image_side: Width and height of the images in pixels
+        seed: Random seed
+
+
+    """
+    def __init__(self, prompt_words: tuple[int, int] = (16, 256),
+                 output_tokens: tuple[int, int] = (16, 128), image_ratio: float = 0.0,
+                 image_side: int = 256, seed: int = 0):
+        self.prompt_words = prompt_words
+        self.output_tokens = output_tokens
+        self.image_ratio = image_ratio
+        self.image_side = image_side
+        self.seed = seed
+
+    def image(self, rng: random.Random) -> str:
+        """A base64 PNG, different for each request so that none is cached"""
+        from PIL import Image
+        img = Image.new("RGB", (self.image_side, self.image_side),
+                        tuple(rng.randrange(256) for _ in range(3)))
+        buf = BytesIO()
+        img.save(buf, format="PNG")
+        return base64.b64encode(buf.getvalue()).decode()
+
+    def requests(self, n: int, tag: str = "bench") -> list[dict]:
+        """:code:`n` requests, the same for each :code:`tag` but for their first word
+
+        The tag starts the prompt and names the session, so that no KV cache
+        is reused from the requests of another tag.
+        """
+        rng = random.Random(self.seed)
+        bodies = []
+        for i in range(n):
+            words = rng.randint(*self.prompt_words)
+            text = f"{tag}-{i}: " + " ".join(rng.choice(WORDS) for _ in range(words))
+            content: str | dict = text
+            if rng.random() < self.image_ratio:
+                content = {"text": text, "images": [self.image(rng)]}
+            bodies.append({"messages": [{"role": "user", "content": content}], "stream": True,
+                           "max_tokens": rng.randint(*self.output_tokens),
+                           "session_id": f"{tag}-{i}"})
+        return bodies
+
+    def to_dict(self) -> dict:
+        return {"prompt_words": self.prompt_words, "output_tokens": self.output_tokens,
+                "image_ratio": self.image_ratio, "image_side": self.image_side,
+                "seed": self.seed}
+
+
+async def run_request(client: httpx.AsyncClient, body: dict) -> dict:
+    """Send a streamed chat completion and time its chunks"""
+    start = time.perf_counter()
+    chunks: list[float] = []
+    result = {"ok": False, "status": None, "error": None, "output_tokens": 0}
+    try:
+        async with client.stream("POST", "/v1/chat/completions", json=body) as response:
+            result["status"] = response.status_code
+            if response.status_code != 200:
+                result["error"] = (await response.aread()).decode(errors="replace")[:200]
+                return result
+            async for line in response.aiter_lines():
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                data = json.loads(line[6:])
+                if "error" in data:
+                    result["error"] = data["error"]
+                    return result
+                if "usage" in data:
+                    result["output_tokens"] = data["usage"]["usage"]["completion_tokens"]
+                    result["ok"] = True
+                elif data["choices"][0]["delta"].get("content"):
+                    chunks.append(time.perf_counter())
+    except httpx.HTTPError as e:
+        result["error"] = str(e)
+        return result
+    end = time.perf_counter()
+    result["latency"] = end - start
+    if chunks:
+        result["ttft"] = chunks[0] - start
+        result["itl"] = [b - a for a, b in zip(chunks, chunks[1:])]
+    return result
+
+
+def percentiles(values: list[float], scale: float = 1000.0) -> Optional[dict]:
+    """Mean, p50, p95, p99 and max of :code:`values`, times :code:`scale`"""
+    if not values:
+        return None
+    values = sorted(v * scale for v in values)
+
+    def at(q: float) -> float:
+        # Linear interpolation between the closest ranks
+        pos = (len(values) - 1) * q
+        lo = int(pos)
+        hi = min(lo + 1, len(values) - 1)
+        return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+    return {"mean": sum(values) / len(values), "p50": at(0.5), "p95": at(0.95),
+            "p99": at(0.99), "max": values[-1]}
+
+
+def summarize(results: list[dict], concurrency: int, duration: float) -> dict:
+    ok = [r for r in results if r["ok"]]
+    errors: dict[str, int] = {}
+    for r in results:
+        if not r["ok"]:
+            key = str(r["status"] or "connection")
+            errors[key] = errors.get(key, 0) + 1
+    tokens = sum(r["output_tokens"] for r in ok)
+    return {"concurrency": concurrency, "requests": len(results), "ok": len(ok),
+            "errors": errors, "duration_s": duration,
+            "requests_per_second": len(ok) / duration if duration else 0.0,
+            "output_tokens_per_second": tokens / duration if duration else 0.0,
+            "ttft_ms": percentiles([r["ttft"] for r in ok if "ttft" in r]),
+            "itl_ms": percentiles([t for r in ok for t in r.get("itl", [])]),
+            "latency_ms": percentiles([r["latency"] for r in ok])}
+
+
+async def run_level(client: httpx.AsyncClient, bodies: list[dict], concurrency: int) -> dict:
+    """Send :code:`bodies` with at most :code:`concurrency` in flight"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(body):
+        async with semaphore:
+            return await run_request(client, body)
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(b) for b in bodies))
+    return summarize(results, concurrency, time.perf_counter() - start)
+
+
+async def sweep(url: str, workload: Workload, levels: list[int], n_requests: int) -> list[dict]:
+    """Run :code:`n_requests` of :code:`workload` at each concurrency in :code:`levels`"""
+    limits = httpx.Limits(max_connections=max(levels), max_keepalive_connections=max(levels))
+    async with httpx.AsyncClient(base_url=url, timeout=None, limits=limits) as client:
+        # Warm up the connections and the worker
+        await run_level(client, workload.requests(min(levels), "warmup"), min(levels))
+        return [await run_level(client, workload.requests(n_requests, f"level{c}"), c)
+                for c in levels]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def serve(app, port: int):
+    """Serve :code:`app` on localhost until the returned server is told to exit"""
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning",
+                                           lifespan="on"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.01)
+    return server, task
+
+
+@asynccontextmanager
+async def in_process_stack(lib: FakeGemmaLib, manager_config: Optional[dict] = None):
+    """Manager and worker apps with :code:`lib` as the engine. Yields the manager's URL
+
+    The manager's worker is the worker app instead of a process of its own.
+
+    Args:
+        lib: The fake engine
+        manager_config: Optional settings of the manager
+
+
+    """
+    worker_port, manager_port = free_port(), free_port()
+    worker_server, worker_task = await serve(await fake_worker_app(lib), worker_port)
+    config = {"python": sys.executable, "engine": "gemma", "model_root": "",
+              "model_path": "fake.gguf", "lib_path": "", "mmproj_path": "mmproj.gguf",
+              "n_predict": 1 << 16, "overrides": {}, "worker_ports": [worker_port, free_port()],
+              **(manager_config or {})}
+    start = worker.Worker.start
+    worker.Worker.start = lambda self: self.set_state("starting")
+    try:
+        app = service.model_manager_app(config)
+    finally:
+        worker.Worker.start = start
+    manager = app.state.model_manager
+    manager_server, manager_task = await serve(app, manager_port)
+    try:
+        await manager.worker.wait_state(30)
+        yield f"http://127.0.0.1:{manager_port}"
+    finally:
+        manager.worker.set_state("stopped")
+        for server, task in ((manager_server, manager_task), (worker_server, worker_task)):
+            server.should_exit = True
+            await task
+
+
+async def run(args) -> dict:
+    workload = Workload(args.prompt_words, args.output_tokens, args.image_ratio,
+                        args.image_side, args.seed)
+    report = {"workload": workload.to_dict(), "requests": args.requests}
+    if args.url:
+        report["target"] = args.url
+        report["levels"] = await sweep(args.url, workload, args.concurrency, args.requests)
+        return report
+    lib = FakeGemmaLib(token_delay=1 / args.tokens_per_second,
+                       prefill_delay=1 / args.prefill_tokens_per_second, fill=True)
+    report["target"] = {"fake_engine": {"tokens_per_second": args.tokens_per_second,
+                                        "prefill_tokens_per_second":
+                                        args.prefill_tokens_per_second}}
+    async with in_process_stack(lib) as url:
+        report["levels"] = await sweep(url, workload, args.concurrency, args.requests)
+    return report
+
+
+def parse_range(value: str) -> tuple[int, int]:
+    lo, _, hi = value.partition(":")
+    return int(lo), int(hi or lo)
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description="Load generator for the serving stack")
+    parser.add_argument("--url", help="Manager or worker to drive, the fake stack if not given")
+    parser.add_argument("--concurrency", type=lambda v: [int(x) for x in v.split(",")],
+                        default=[1, 4, 16], help="Comma separated levels of concurrency")
+    parser.add_argument("--requests", type=int, default=64, help="Requests per level")
+    parser.add_argument("--prompt_words", type=parse_range, default=(16, 256),
+                        help="Range of prompt words as min:max")
+    parser.add_argument("--output_tokens", type=parse_range, default=(16, 128),
+                        help="Range of generated tokens as min:max")
+    parser.add_argument("--image_ratio", type=float, default=0.0,
+                        help="Fraction of requests with an image")
+    parser.add_argument("--image_side", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tokens_per_second", type=float, default=200.0,
+                        help="Generation speed of the fake engine")
+    parser.add_argument("--prefill_tokens_per_second", type=float, default=5000.0,
+                        help="Prompt evaluation speed of the fake engine")
+    parser.add_argument("--out", help="File to write the report to, stdout if not given")
+    args = parser.parse_args(argv)
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Microbenchmark of encoding streamed chat tokens as server sent events.
+
+Compares building a :code:`choices/delta` dict per token with :code:`json.dumps`
+and an f-string, as the streaming chat path used to, with :class:`SSEEncoder`.
+
+Usage:
+    python -m benchmarks.sse_encode [n_tokens]
+"""
+import sys
+import json
+import timeit
+
+from hacky_llama import sse
+from hacky_llama.sse import SSEEncoder
+
+
+TOKENS = ["The", " quick", " brown", " fox", " jumps", " over", " the", " lazy", " dog", ".",
+          "\n", " \"Quoted\"", " naïve", " café", " ∑", " 😀"]
+
+
+def encode_dict(tokens):
+    out = []
+    for token in tokens:
+        resp = {
+            "choices": [
+                {
+                    "delta": {"content": token},
+                    "finish_reason": None,
+                }
+            ],
+        }
+        chunk = json.dumps(resp)
+        out.append(f"data: {chunk}\n\n")
+    return out
+
+
+def encode_dict_orjson(tokens):
+    out = []
+    for token in tokens:
+        resp = {"choices": [{"delta": {"content": token}, "finish_reason": None}]}
+        chunk = sse.orjson.dumps(resp).decode()
+        out.append(f"data: {chunk}\n\n")
+    return out
+
+
+def encode_sse(tokens, batch_tokens=1):
+    encoder = SSEEncoder(batch_tokens)
+    out = []
+    for token in tokens:
+        if (event := encoder.add(token)) is not None:
+            out.append(event)
+    if (event := encoder.flush()) is not None:
+        out.append(event)
+    return out
+
+
+def bench(func, tokens, repeat=5):
+    best = min(timeit.repeat(lambda: func(tokens), number=1, repeat=repeat))
+    return best / len(tokens) * 1e9
+
+
+def main(n_tokens=100_000):
+    tokens = (TOKENS * (n_tokens // len(TOKENS) + 1))[:n_tokens]
+    assert [json.loads(x[6:]) for x in encode_dict(tokens[:20])] ==\
+        [json.loads(x[6:]) for x in encode_sse(tokens[:20])]
+    results = {"dict + json.dumps": bench(encode_dict, tokens)}
+    if sse.orjson is not None:
+        results["dict + orjson.dumps"] = bench(encode_dict_orjson, tokens)
+    results["SSEEncoder"] = bench(encode_sse, tokens)
+    results["SSEEncoder, 8 tokens per event"] = bench(lambda t: encode_sse(t, 8), tokens)
+    for name, ns in results.items():
+        print(f"{name:35s} {ns:8.1f} ns/token")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
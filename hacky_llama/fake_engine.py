@@ -0,0 +1,141 @@
+"""Deterministic stand in for the C library, for tests and benchmarks on any CPU box.
+
+Usage, a worker serving the fake engine on a port:
+    python -m hacky_llama.fake_engine [--port 8001] [--tokens_per_second 50]
+"""
+from typing import Optional
+import argparse
+import asyncio
+import ctypes
+import json
+import time
+
+from .lib import Gemma3TokensInfo
+from .gemma_iface import GemmaInterface
+from .gemma_service import create_app
+
+
+class FakeGemmaLib:
+    """Stands in for the C library returned by :func:`hacky_llama.lib.init_lib`.
+
+    Each generation replies with :code:`reply` split into words. Evaluated
+    messages are recorded in :code:`evaluated` as (messages, add_bos) tuples.
+
+    Args:
+        reply: Text of each reply
+        token_delay: Seconds to generate a token
+        prefill_delay: Seconds to evaluate a word of the prompt
+        fill: Repeat :code:`reply` up to :code:`n_predict` tokens, so that the
+              length of the response is set by the request's :code:`max_tokens`
+
+
+    """
+    def __init__(self, reply="This is a test.", token_delay=0.0, prefill_delay=0.0, fill=False):
+        self.reply = reply
+        self.token_delay = token_delay
+        self.prefill_delay = prefill_delay
+        self.fill = fill
+        self.evaluated = []
+        self.images = []
+        self.resets = 0
+        self.generating = False
+        self.interrupted = False
+        self.prompt_n = 0
+        self.predicted_n = 0
+
+    def tokens(self, n: Optional[int] = None):
+        words = self.reply.split(" ")
+        if self.fill and n:
+            return [(" " if i else "") + words[i % len(words)] for i in range(n)]
+        return [w if not i else " " + w for i, w in enumerate(words)]
+
+    def gemma3_static_initialize(self, model_path, mmproj_path, overrides):
+        return 1
+
+    def re_init_sampler(self, params):
+        return None
+
+    def gemma3_static_eval_message_text_only(self, msgs, add_bos):
+        msgs = json.loads(msgs)
+        self.evaluated.append((msgs, add_bos))
+        self.prompt_n = sum(len(m["content"].split()) for m in msgs)
+        if self.prefill_delay:
+            time.sleep(self.prompt_n * self.prefill_delay)
+        return 0
+
+    def gemma3_static_eval_message_with_images(self, msgs, image_data, image_sizes, num_images,
+                                               add_bos):
+        self.images.append([ctypes.string_at(image_data[i], image_sizes[i])
+                            for i in range(num_images)])
+        return self.gemma3_static_eval_message_text_only(msgs, add_bos)
+
+    def gemma3_static_stream_response(self, callback, n_predict, stop_strings, n_stop_strings):
+        self.generating = True
+        self.interrupted = False
+        self.predicted_n = 0
+        n_predict = int(getattr(n_predict, "value", n_predict))
+        for token in self.tokens(n_predict)[:n_predict]:
+            if self.interrupted:
+                break
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            callback(token.encode())
+            self.predicted_n += 1
+        self.generating = False
+        callback(b"[EOS]")
+        return 0
+
+    def gemma3_static_collect_response(self, n_predict, buffer, size, stop_strings,
+                                       n_stop_strings):
+        chunks = []
+        self.gemma3_static_stream_response(lambda t: chunks.append(t), n_predict,
+                                           stop_strings, n_stop_strings)
+        buffer.value = b"".join(chunks[:-1])
+        return 0
+
+    def gemma3_static_reset(self):
+        self.resets += 1
+        return 0
+
+    def gemma3_is_generating(self):
+        return self.generating
+
+    def gemma3_static_interrupt(self):
+        self.interrupted = True
+
+    def gemma3_tokens_info(self):
+        return Gemma3TokensInfo(self.prompt_n, self.predicted_n)
+
+
+async def fake_worker_app(lib: FakeGemmaLib, config: Optional[dict] = None):
+    """Worker app serving :code:`lib`, with images enabled
+
+    Args:
+        lib: The fake library
+        config: Optional worker config, see :func:`create_app`
+
+
+    """
+    iface = GemmaInterface(None, "model.gguf", "mmproj.gguf", lib=lib)
+    return await create_app(config or {}, mock_llama_interface=iface)
+
+
+def main():
+    import uvicorn
+    parser = argparse.ArgumentParser(description="Worker serving the fake engine")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--tokens_per_second", type=float, default=50.0)
+    parser.add_argument("--prefill_tokens_per_second", type=float, default=2000.0)
+    args = parser.parse_args()
+    lib = FakeGemmaLib(token_delay=1 / args.tokens_per_second,
+                       prefill_delay=1 / args.prefill_tokens_per_second, fill=True)
+
+    async def run():
+        app = await fake_worker_app(lib)
+        await uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=args.port,
+                                            log_level="warning")).serve()
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
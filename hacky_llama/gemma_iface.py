@@ -1,23 +1,56 @@
-from typing import Optional, AsyncGenerator
+from typing import Any, Callable, Optional, AsyncGenerator
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import ctypes
-from ctypes import c_int, create_string_buffer, POINTER, c_ubyte, cast
+from ctypes import c_int, POINTER, c_ubyte, cast
 import time
 import json
 import asyncio
-import base64
+import codecs
+import hashlib
 import sys
 
-from .lib import init_lib, TOKEN_CALLBACK
+from .lib import init_lib, has_state_api, TOKEN_CALLBACK
+from .sessions import SessionCache
+from .state_cache import DiskStateCache
+from .token_buffer import TokenBuffer, TokenCollector
+from .image_cache import ImageCache
+from .image_input import ImageRef
+from .image_preprocess import ImagePreprocessor
+from .tracing import Trace
+
+
+DEFAULT_SESSION = "default"
 
 
 class GemmaInterface:
     def __init__(self, lib_path: str, model_path: str, mmproj_path: Optional[str] = None,
-                 overrides: Optional[dict] = None, n_predict: int = 8192, loop=None):
-        print("Loading library", lib_path)
-        self.lib = init_lib(lib_path)
+                 overrides: Optional[dict] = None, n_predict: int = 8192, loop=None, lib=None,
+                 max_sessions: int = 8, max_session_bytes: int = 4 << 30,
+                 state_cache_dir: Optional[str] = None, state_cache_bytes: int = 16 << 30,
+                 token_flush_interval: float = 0.01, token_flush_bytes: int = 512,
+                 token_buffer_bytes: int = 1 << 20, token_overflow: str = "block",
+                 image_cache_bytes: int = 256 << 20, image_max_side: Optional[int] = None,
+                 image_format: str = "PNG", image_workers: int = 4):
+        if lib is None:
+            print("Loading library", lib_path)
+            lib = init_lib(lib_path)
+        self.lib = lib
         overrides = overrides or {}
-        # self.queues: dict[str, asyncio.Queue[str]] = {}
-        self.q: asyncio.Queue[str] = asyncio.Queue()
+        # Tokens of the current stream, see :class:`TokenBuffer`
+        self.tokens: Optional[TokenBuffer | TokenCollector] = None
+        # Tokens may end within a multi byte character
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.token_buffer_opts = {"flush_interval": token_flush_interval,
+                                  "flush_bytes": token_flush_bytes,
+                                  "max_bytes": token_buffer_bytes,
+                                  "overflow": token_overflow}
+        self.image_cache = ImageCache(image_cache_bytes)
+        self.image_preprocessor = ImagePreprocessor(image_max_side, image_format,
+                                                    workers=image_workers)
+        self.image_timings: list[dict] = []
+        # Wall clock time of the first token of the current response
+        self.first_token_time: Optional[float] = None
         self.c_callback = TOKEN_CALLBACK(self.python_token_callback)
         self.is_multimodal = True
         if not mmproj_path:
@@ -30,10 +63,29 @@ class GemmaInterface:
             json.dumps(overrides).encode()
         )
         self.n_predict = n_predict
+        # Hashes of the messages (and the generated reply) currently in the KV cache
+        self.cached_prefix: list[str] = []
+        self.cached_messages = 0
+        self._pending_prefix: Optional[list[str]] = None
+        self._inflight_prefix: Optional[list[str]] = None
+        # Conversations other than the active one keep their KV state in a session slot
+        self.supports_state = has_state_api(self.lib)
+        if not self.supports_state:
+            print("Library cannot save KV state. Switching sessions will reset the context")
+        self.sessions = SessionCache(max_sessions, max_session_bytes)
+        self.active_session: Optional[str] = None
+        self.disk_cache: Optional[DiskStateCache] = None
+        if state_cache_dir and self.supports_state:
+            self.disk_cache = DiskStateCache(state_cache_dir, model_path, state_cache_bytes)
         try:
             self.loop = loop or asyncio.get_running_loop()
         except Exception:
+            self.loop = None
             print("Could not get event loop will run in sync mode")
+        # Blocking calls into the library run on this thread, off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gemma-engine")
+        # Evaluation of the current prompt on the executor, see :meth:`run_prefill`
+        self.prefill_job: Optional[asyncio.Future] = None
 
     def interrupt(self):
         self.lib.gemma3_static_interrupt()
@@ -42,37 +94,277 @@ class GemmaInterface:
         return self.lib.gemma3_is_generating()
 
     def python_token_callback(self, token_ptr):
-        token = ctypes.string_at(token_ptr).decode('utf-8')
-        future = asyncio.run_coroutine_threadsafe(self.q.put(token), self.loop)
-        future.add_done_callback(lambda f: f.exception() and print("Put failed:", f.exception()))
+        raw = ctypes.string_at(token_ptr)
+        if self.tokens is None:
+            return
+        if self.first_token_time is None:
+            self.first_token_time = time.time()
+        if raw == b"[EOS]":  # End-of-stream token
+            if tail := self._decoder.decode(b"", final=True):
+                self.tokens.put(tail)
+            self.tokens.close()
+        elif token := self._decoder.decode(raw):
+            self.tokens.put(token)
+
+    @staticmethod
+    def message_hash(message: dict) -> str:
+        """Hash of a message's role, text and images.
+
+        Assistant text is stripped so that a reply echoed back by the client
+        matches the one that was generated.
+
+        Args:
+            message: Message dict with role, content and images
+
+
+        """
+        content = message["content"]
+        if message["role"] == "assistant":
+            content = content.strip()
+        h = hashlib.blake2b(digest_size=16)
+        h.update(message["role"].encode())
+        h.update(b"\0")
+        h.update(content.encode())
+        for img in message.get("images") or []:
+            h.update(b"\0")
+            h.update(ImageCache.key(img).encode())
+        return h.hexdigest()
+
+    def save_state(self) -> Optional[ctypes.Array]:
+        """Copy the KV state of the context into a new buffer"""
+        size = self.lib.gemma3_static_state_size()
+        buf = (c_ubyte * size)()
+        if not self.lib.gemma3_static_state_save(buf, size):
+            return None
+        return buf
+
+    def load_state(self, buf) -> bool:
+        """Restore the KV state of the context from :code:`buf`
+
+        Args:
+            buf: A writable buffer as returned by :meth:`save_state`
+
+
+        """
+        size = len(buf)
+        # Arrays are passed as pointers. Avoid cast, its reference cycle would keep
+        # the buffer exported after the call
+        return self.lib.gemma3_static_state_load((c_ubyte * size).from_buffer(buf), size) == size
+
+    def switch_session(self, session_id: str):
+        """Make :code:`session_id` the conversation held in the context.
+
+        If the library supports it, the KV state of the outgoing session is saved
+        to its slot and that of the incoming session restored. Otherwise the
+        context is marked as unknown and the next evaluation resets it.
+
+        Args:
+            session_id: Session / conversation id
+
+
+        """
+        if session_id == self.active_session:
+            self.sessions.get(session_id)
+            return
+        if self.active_session is not None and self.supports_state and self.cached_prefix:
+            outgoing = self.sessions.peek(self.active_session)
+            if outgoing is not None:
+                outgoing.state = self.save_state()
+                outgoing.prefix = list(self.cached_prefix) if outgoing.state is not None else []
+        incoming = self.sessions.get(session_id)
+        self.active_session = session_id
+        self.cached_prefix = []
+        if incoming.state is not None and self.load_state(incoming.state):
+            self.cached_prefix = incoming.prefix
+        # The state now lives in the context
+        incoming.drop_state()
+        for session in self.sessions.evict(keep=session_id):
+            if self.disk_cache is not None:
+                self.disk_cache.save(session.prefix, session.state)
+            session.drop_state()
+
+    def restore_prefix(self, hashes: list[str]) -> bool:
+        """Restore the longest snapshot on disk matching a prefix of :code:`hashes`
+
+        Args:
+            hashes: Message hashes of the incoming request
+
+
+        """
+        if self.disk_cache is None or (found := self.disk_cache.find(hashes)) is None:
+            return False
+        prefix, mm = found
+        try:
+            restored = self.load_state(mm)
+        finally:
+            mm.close()
+        self.cached_prefix = prefix if restored else []
+        return restored
+
+    def persist_sessions(self):
+        """Snapshot the active context and all saved session states to disk"""
+        if self.disk_cache is None:
+            return
+        if self.cached_prefix:
+            self.disk_cache.save(self.cached_prefix, self.save_state())
+        for session in self.sessions:
+            if session.state is not None:
+                self.disk_cache.save(session.prefix, session.state)
+
+    def sync_prefix(self, messages: list[dict], reset: bool = False,
+                    session_id: Optional[str] = None) -> tuple[list[dict], bool]:
+        """Find the messages that still have to be evaluated.
+
+        Switches to the session :code:`session_id` first. If the messages already
+        in the KV cache, or in a snapshot on disk, are a prefix of :code:`messages`
+        only the new suffix is returned. Otherwise, or if :code:`reset` is given,
+        the context is reset and all the messages are returned.
+
+        Args:
+            messages: Full message history of the request
+            reset: Force a context reset
+            session_id: Optional session / conversation id
+
+        Returns:
+            A tuple of the messages to evaluate and whether to add BOS
+
+
+        """
+        self.switch_session(session_id or DEFAULT_SESSION)
+        hashes = [self.message_hash(m) for m in messages]
+        n = len(self.cached_prefix)
+        if not reset and not (0 < n < len(hashes) and hashes[:n] == self.cached_prefix):
+            if self.restore_prefix(hashes):
+                n = len(self.cached_prefix)
+        if not reset and 0 < n < len(hashes) and hashes[:n] == self.cached_prefix:
+            suffix, add_bos = messages[n:], False
+            self.cached_messages = n
+        else:
+            self.reset_context()
+            suffix, add_bos = messages, True
+        self._pending_prefix = hashes
+        return suffix, add_bos
+
+    def commit_response(self, text: Optional[str]):
+        """Record what the KV cache holds after a generation.
+
+        Args:
+            text: The generated reply, or :code:`None` if generation did not finish
+
+
+        """
+        prefix, self._inflight_prefix = self._inflight_prefix, None
+        if prefix is None or text is None:
+            # Unknown state, next request resets
+            self.cached_prefix = []
+        else:
+            self.cached_prefix = [*prefix, self.message_hash({"role": "assistant",
+                                                              "content": text})]
+
+    def prepare_images(self, images: list[str | bytes | ImageRef]) -> list[ctypes.Array]:
+        """Get the images ready for the library.
+
+        Images not in the cache are preprocessed in parallel and cached. Per image
+        timings are kept in :code:`image_timings`. Writable buffers, like mapped
+        files, are passed to the library without a copy.
+
+        Args:
+            images: Base64 encoded or raw images, or references to them
+
+
+        """
+        keys = [self.image_cache.key(img) for img in images]
+        prepared = [self.image_cache.get(k) for k in keys]
+        self.image_timings = [{"cached": True} for _ in images]
+        # The same image may occur more than once in a request
+        missing: dict[str, int] = {}
+        for i, data in enumerate(prepared):
+            if data is None:
+                missing.setdefault(keys[i], i)
+        results = self.image_preprocessor.process(
+            [img.data if isinstance(img := images[i], ImageRef) else img
+             for i in missing.values()])
+        arrays = {}
+        for (key, i), (data, timings) in zip(missing.items(), results):
+            try:
+                arrays[key] = (c_ubyte * len(data)).from_buffer(data)
+            except TypeError:
+                arrays[key] = (c_ubyte * len(data)).from_buffer_copy(data)
+            self.image_cache.put(key, arrays[key])
+            self.image_timings[i] = {"cached": False, **timings}
+        return [arrays[k] if data is None else data for k, data in zip(keys, prepared)]
 
     def eval_message(self, messages: list[dict[str, str | list[str]]], stream=False, add_bos=False,
-                     stop_strings=None, sampler_params: Optional[dict] = None) -> int | str:
+                     stop_strings=None, sampler_params: Optional[dict] = None,
+                     n_predict: Optional[int] = None, trace: Optional[Trace] = None) -> int | str:
+        """Evaluate :code:`messages` and generate a response.
+
+        With :code:`stream` the tokens are generated on the engine thread and
+        read with :meth:`receive_tokens`. Otherwise generation blocks and the
+        response is returned. Either way the prompt is evaluated in the
+        calling thread, see :meth:`run_prefill` to evaluate it on the engine
+        thread instead.
+
+        Args:
+            messages: Messages with role, content and images
+            stream: Whether to stream the response
+            add_bos: Whether to add the BOS token
+            stop_strings: Strings to stop generation at
+            sampler_params: Optional sampler params
+            n_predict: Maximum tokens to generate, at most the server's :code:`n_predict`
+            trace: Optional :class:`Trace` for the sampler, image and prefill spans
+
+
+        """
+        self.prefill(messages, add_bos=add_bos, sampler_params=sampler_params, trace=trace)
+        if stream:
+            self.stream(stop_strings, n_predict)
+            return 0
+        return self.generate(stop_strings, n_predict)
+
+    def prefill(self, messages: list[dict[str, str | list[str]]], add_bos=False,
+                sampler_params: Optional[dict] = None, trace: Optional[Trace] = None):
+        """Evaluate :code:`messages` with their images, before :meth:`generate` or :meth:`stream`.
+
+        Blocks for as long as the prompt takes.
+
+        Args:
+            messages: Messages with role, content and images
+            add_bos: Whether to add the BOS token
+            sampler_params: Optional sampler params
+            trace: Optional :class:`Trace` for the sampler, image and prefill spans
+
+
+        """
+        # Messages evaluated without going through sync_prefix leave the cache untracked
+        self._inflight_prefix, self._pending_prefix = self._pending_prefix, None
+        self.cached_prefix = []
+        trace = trace or Trace("eval_message")
         sampler_params = sampler_params or {}
         if sampler_params:
-            self.lib.re_init_sampler(json.dumps(sampler_params).encode())
-        self.q = asyncio.Queue()
+            with trace.span("sampler"):
+                self.lib.re_init_sampler(json.dumps(sampler_params).encode())
         msgs_text = [{"role": m["role"], "content": m["content"]} for m in messages]
-        msg_imgs: list[str] = []
+        msg_imgs: list[str | bytes] = []
+        self.image_timings = []
         for m in messages:
-            msg_imgs.extend(m["images"])
-        stop_strings = stop_strings or []
-        c_strings = (ctypes.c_char_p * len(stop_strings))()
-        c_strings[:] = [s.encode('utf-8') for s in stop_strings]  # Encode to bytes
+            msg_imgs.extend(m.get("images") or [])
         self.process_start_time = time.time()
+        self.first_token_time = None
         if not self.is_multimodal:
-            _ = self.lib.gemma3_static_eval_message_text_only(
-                json.dumps(msgs_text).encode(),  # type: ignore
-                add_bos
-            )
+            with trace.span("prefill"):
+                _ = self.lib.gemma3_static_eval_message_text_only(
+                    json.dumps(msgs_text).encode(),  # type: ignore
+                    add_bos
+                )
         else:
             image_data = []
             image_sizes = []
             if msg_imgs:
-                for img in msg_imgs:
-                    data = base64.b64decode(img)
-                    image_data.append((c_ubyte * len(data)).from_buffer_copy(data))
-                    image_sizes.append(len(data))
+                with trace.span("images"):
+                    for data in self.prepare_images(msg_imgs):
+                        image_data.append(data)
+                        image_sizes.append(len(data))
                 num_images = len(image_data)
             else:
                 num_images = 0
@@ -82,41 +374,129 @@ class GemmaInterface:
                                                                    for img_data in image_data))
             image_sizes_array_type = c_int * num_images
             image_sizes_array = image_sizes_array_type(*image_sizes)
-            _ = self.lib.gemma3_static_eval_message_with_images(
-                json.dumps(msgs_text).encode(),  # type: ignore
-                image_data_pointers,
-                image_sizes_array,
-                num_images,
-                add_bos
-            )
+            with trace.span("prefill"):
+                _ = self.lib.gemma3_static_eval_message_with_images(
+                    json.dumps(msgs_text).encode(),  # type: ignore
+                    image_data_pointers,
+                    image_sizes_array,
+                    num_images,
+                    add_bos
+                )
         self.generation_start_time = time.time()
-        if stream:
-            self.loop.run_in_executor(
-                None,
-                lambda: self.lib.gemma3_static_stream_response(self.c_callback, self.n_predict,
-                                                               c_strings,
-                                                               c_int(len(c_strings)))
-            )
-            return 0
-        buffer = create_string_buffer(self.n_predict)
-        _ = self.lib.gemma3_static_collect_response(c_int(self.n_predict),
-                                                    buffer,
-                                                    c_int(self.n_predict * 8),
-                                                    c_strings,
-                                                    c_int(len(c_strings)))
-        return buffer.value.decode()
+        self._decoder.reset()
+
+    async def run_prefill(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run :code:`func`, which evaluates a prompt, on the engine thread.
+
+        The event loop stays free to serve :code:`/interrupt`, :code:`/health`
+        etc. meanwhile. Should the caller be cancelled the evaluation runs to
+        its end, which :meth:`abort` waits for.
+
+        Args:
+            func: Function to call with :code:`args` and :code:`kwargs`, e.g. :meth:`prefill`
+
+
+        """
+        job = self.prefill_job = asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(func, *args, **kwargs))
+        return await asyncio.shield(job)
+
+    @staticmethod
+    def stop_array(stop_strings: Optional[list[str]]) -> ctypes.Array:
+        stop_strings = stop_strings or []
+        c_strings = (ctypes.c_char_p * len(stop_strings))()
+        c_strings[:] = [s.encode('utf-8') for s in stop_strings]  # Encode to bytes
+        return c_strings
+
+    def stream(self, stop_strings=None, n_predict: Optional[int] = None):
+        """Generate on the engine thread into :code:`tokens`, see :meth:`receive_tokens`.
+
+        Called on the event loop once the prompt is evaluated.
+        """
+        n_predict = min(n_predict, self.n_predict) if n_predict else self.n_predict
+        c_strings = self.stop_array(stop_strings)
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self.tokens = TokenBuffer(self.loop, on_overflow=self.interrupt,
+                                  **self.token_buffer_opts)
+        self.loop.run_in_executor(
+            self.executor,
+            lambda: self.lib.gemma3_static_stream_response(self.c_callback, n_predict,
+                                                           c_strings,
+                                                           c_int(len(c_strings)))
+        )
+
+    def generate(self, stop_strings=None, n_predict: Optional[int] = None) -> str:
+        """Generate and return the response, once the prompt is evaluated. Blocks"""
+        n_predict = min(n_predict, self.n_predict) if n_predict else self.n_predict
+        c_strings = self.stop_array(stop_strings)
+        # Collected through the token callback as well, so that nothing needs to
+        # be allocated up front for the longest possible response
+        collector = self.tokens = TokenCollector()
+        try:
+            _ = self.lib.gemma3_static_stream_response(self.c_callback, n_predict,
+                                                       c_strings,
+                                                       c_int(len(c_strings)))
+        finally:
+            self.tokens = None
+        result = collector.text()
+        self.commit_response(result)
+        return result
 
     async def receive_tokens(self) -> AsyncGenerator[str, None]:
-        """Receive tokens"""
-        while True:
-            token = await self.q.get()
-            if token == "[EOS]":  # End-of-stream token
-                print("Got [EOS] token")
-                sys.stdout.flush()
-                break
-            yield token
+        """Receive tokens
+
+        Tokens generated close together are coalesced into one chunk.
+
+        """
+        tokens = []
+        finished = False
+        buffer = self.tokens
+        try:
+            while buffer is not None:
+                chunk = await buffer.get()
+                if chunk is None:
+                    print("Got [EOS] token")
+                    sys.stdout.flush()
+                    finished = True
+                    break
+                tokens.append(chunk)
+                yield chunk
+        finally:
+            self.commit_response("".join(tokens) if finished else None)
+
+    async def abort(self, timeout: float = 30.0):
+        """Interrupt the generation and drain the tokens nobody will read.
+
+        Waits for the end of the stream so that stale tokens cannot leak into the
+        next request.
+
+        Args:
+            timeout: Maximum seconds to wait for the end of the stream
+
+
+        """
+        if (job := self.prefill_job) is not None and not job.done():
+            # Nothing is generated for a prompt still being evaluated, but the
+            # next request may only start once it is
+            try:
+                await asyncio.wait_for(asyncio.shield(job), timeout)
+            except Exception as e:
+                print(f"Prompt evaluation of an aborted request ended with {e!r}")
+        self.interrupt()
+
+        async def drain():
+            while self.tokens is not None and await self.tokens.get() is not None:
+                pass
+        try:
+            await asyncio.wait_for(drain(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Generation did not stop within {timeout}s of interrupt")
+        self.commit_response(None)
 
     def reset_context(self):
+        self.cached_prefix = []
+        self.cached_messages = 0
         return self.lib.gemma3_static_reset()
 
     def info(self):
@@ -1,152 +1,243 @@
-from typing import Optional, AsyncGenerator
+from typing import Optional, AsyncGenerator, Callable
+from functools import partial
 import asyncio
-import time
 import json
+import time
 import sys
 
 from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.exceptions import HTTPException
 from starlette.requests import Request
-from starlette.responses import StreamingResponse, JSONResponse
+from starlette.responses import Response, StreamingResponse, JSONResponse
 from starlette.routing import Route
 
 from .gemma_iface import GemmaInterface
+from .image_input import resolve_image_refs, multipart_available
+from .image_preprocess import ImageError
+from .metrics import EngineMetrics
+from .tracing import Trace, make_exporter
+from .scheduler import RequestScheduler, SchedulerError
+from .sse import SSEEncoder
+
+
+SCHEDULER_OPTIONS = ("max_queue_depth", "max_queue_wait")
+
 
+def scheduler_error_response(e: SchedulerError) -> JSONResponse:
+    return JSONResponse({"error": str(e)}, status_code=e.status_code,
+                        headers={"Retry-After": str(e.retry_after)})
 
-async def stream_response(request: Request) -> StreamingResponse:
+
+class DisconnectWatcher:
+    """Interrupt generation if the client disconnects before the response is done.
+
+    Must be stopped before the response completes, as the server reports a
+    disconnect for every finished request as well.
+
+    Args:
+        request: The request
+        iface: GemmaInterface to interrupt
+
+
+    """
+    def __init__(self, request: Request, iface: GemmaInterface):
+        self.request = request
+        self.iface = iface
+        self.disconnected = False
+        self._task = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        while (await self.request.receive())["type"] != "http.disconnect":
+            pass
+        self.disconnected = True
+        self.iface.interrupt()
+
+    def stop(self):
+        self._task.cancel()
+
+
+async def stream_response(request: Request) -> StreamingResponse | JSONResponse:
     """
     Endpoint that streams tokens from the Llama model.
     """
     message = await request.json()
     #  get the llama interface from the app state.
     print(f"Got message {message}")
-    iface: GemmaInterface = request.app.state.llama_interface
-    request_id = iface.eval_message(message, stream=True)
-    # TODO: It's an int right now
-    if request_id is None:
-        raise Exception("eval_message failed to return a request ID for streaming")
+    scheduler: RequestScheduler = request.app.state.scheduler
+    try:
+        iface: GemmaInterface = await scheduler.acquire()
+    except SchedulerError as e:
+        return scheduler_error_response(e)
+    try:
+        await iface.run_prefill(iface.prefill, message)
+        iface.stream()
+    except BaseException:
+        scheduler.release()
+        raise
 
     async def generate_tokens() -> AsyncGenerator[str, None]:
+        finished = False
         try:
             async for token in iface.receive_tokens():
                 yield token + "\n\n"  # Add a newline for easier client handling
                 print(token, end="")
                 sys.stdout.flush()
+            finished = True
         except KeyError as e:
             yield f"KeyError: {e}"
         except Exception as e:
             yield f"Exception: {e}"
+        finally:
+            if finished:
+                scheduler.release()
+            else:
+                scheduler.abandon(iface.abort())
 
     return StreamingResponse(generate_tokens(), media_type="text/plain",
                              headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
-def get_message_list(messages) -> tuple[list[dict], bool]:
+def get_message_list(messages) -> list[dict]:
     """Convert appropriately the messages received
 
+    The content of each message can be a string, a dict with :code:`text` and
+    :code:`images` or a list of :code:`text` and :code:`image` parts.
+
     Args:
         messages: A list of messages
 
 
     """
     prompt = []
-    if isinstance(messages[-1]["content"], list):
-        for m in messages:
-            for _m in m["content"]:
-                if _m.keys() - {"type", "text", "images"}:
+    for m in messages:
+        content = m["content"]
+        if isinstance(content, list):
+            for _m in content:
+                if _m.keys() - {"type", "text", "image"}:
                     raise NotImplementedError("Only text and images implemented for now")
-        for m in messages:
-            prompt.append({"role": m["role"],
-                           "content": "\n\n".join([x["text"] for x in m["content"]
-                                                   if x["type"] == "text"]),
-                           "images": [x["image"] for x in m["content"]
-                                      if x["type"] == "image"]})
-    elif isinstance(messages[-1]["content"], dict):
-        if messages[-1]["content"].keys() - {"type", "text", "images"}:
-            raise NotImplementedError("Only text and images implemented for now")
-        for m in messages:
-            prompt.append({"role": m["role"],
-                           "content": m["content"]["text"],
-                           "images": m["content"].get("images")})
-    elif isinstance(messages[-1]["content"], str):
-        prompt = [{"role": "user", "content": messages[-1]["content"], "images": []}]
-    else:
-        raise NotImplementedError(f"Got bad message f{messages[-1]['content']}")
-    reset = len(messages) == 1
-    return prompt, reset
+            text = "\n\n".join([x["text"] for x in content if x["type"] == "text"])
+            images = [x["image"] for x in content if x["type"] == "image"]
+        elif isinstance(content, dict):
+            if content.keys() - {"type", "text", "images"}:
+                raise NotImplementedError("Only text and images implemented for now")
+            text = content["text"]
+            images = content.get("images") or []
+        elif isinstance(content, str):
+            text = content
+            images = []
+        else:
+            raise NotImplementedError(f"Got bad message f{content}")
+        prompt.append({"role": m["role"], "content": text, "images": images})
+    return prompt
 
 
 async def stream_chat(iface: GemmaInterface, messages: list[dict[str, str]],
                       stop_strings: Optional[list[str]] = None,
                       reset: bool = False,
-                      sampler_params: Optional[dict] = None) -> AsyncGenerator[str, None]:
-    """Stream chat response
+                      sampler_params: Optional[dict] = None,
+                      session_id: Optional[str] = None,
+                      encoder: Optional[SSEEncoder] = None,
+                      max_tokens: Optional[int] = None,
+                      on_usage: Optional[Callable[[dict], None]] = None,
+                      trace: Optional[Trace] = None) -> AsyncGenerator[str, None]:
+    """Stream chat response as server sent events
 
         iface: GemmaInterface
         messages: List of messages with {role, content} keys
         stop_strings: An optional list of strings to stop generation (antiprompt)
-        reset: Reset context flag
+        reset: Force a context reset even if the history matches the KV cache
         sampler_params: Optional additional sampler params
+        session_id: Optional session / conversation id whose KV state to use
+        encoder: Optional :class:`SSEEncoder`, e.g. to batch tokens per event
+        max_tokens: Optional maximum number of tokens to generate
+        on_usage: Optional callback with the usage/timings of the finished response
+        trace: Optional :class:`Trace` of the request
 
     """
-    msgs, _reset = get_message_list(messages)
-    reset = _reset or reset
-    add_bos = False
-    if reset:
-        iface.reset_context()
-        add_bos = True
-    print(f"msgs {msgs}, add_bos {add_bos}")
-    sys.stdout.flush()
-    iface.eval_message(msgs, stream=True, add_bos=add_bos,
-                       stop_strings=stop_strings,
-                       sampler_params=sampler_params)
+    encoder = encoder or SSEEncoder()
+    trace = trace or Trace("stream_chat")
+
+    def prefill():
+        with trace.span("sync"):
+            msgs, add_bos = iface.sync_prefix(get_message_list(messages), reset=reset,
+                                              session_id=session_id)
+        print(f"msgs {msgs}, add_bos {add_bos}")
+        sys.stdout.flush()
+        iface.prefill(msgs, add_bos=add_bos, sampler_params=sampler_params, trace=trace)
+    try:
+        # Off the event loop, so that /interrupt, /health etc. are served meanwhile
+        await iface.run_prefill(prefill)
+    except ImageError as e:
+        yield encoder.error(e)
+        return
+    iface.stream(stop_strings, max_tokens)
     try:
         async for token in iface.receive_tokens():
-            resp = {
-                "choices": [
-                    {
-                        "delta": {"content": token},
-                        "finish_reason": None,
-                    }
-                ],
-            }
-            yield json.dumps(resp)  # Add a newline for easier client handling
+            start = time.time()
+            event = encoder.add(token)
+            trace.accumulate("sse", time.time() - start)
+            if event is not None:
+                yield event
+        if (event := encoder.flush()) is not None:
+            yield event
     except KeyError as e:
-        yield f"KeyError: {e}"
+        yield encoder.frame(f"KeyError: {e}")
     except Exception as e:
-        yield f"Exception: {e}"
-    finally:
-        usage = get_usage_timings(iface)
-        final_chunk = {
-            "choices": [{"delta": {"content": ""}, "finish_reason": "stop"}],
-            "usage": usage
-        }
-        yield json.dumps(final_chunk)
+        yield encoder.frame(f"Exception: {e}")
+    # Not in a finally, nothing may be yielded once the consumer has gone away
+    usage = get_usage_timings(iface)
+    if on_usage is not None:
+        on_usage(usage)
+    yield encoder.final(usage)
 
 
 def complete_chat(iface: GemmaInterface, messages: list[dict[str, str]],
                   stop_strings: Optional[list[str]] = None,
                   reset: bool = False,
-                  sampler_params: Optional[dict] = None) -> str:
+                  sampler_params: Optional[dict] = None,
+                  session_id: Optional[str] = None,
+                  max_tokens: Optional[int] = None,
+                  trace: Optional[Trace] = None) -> str:
     """Generate complete chat response and send as one message.
 
         iface: GemmaInterface
         messages: List of messages with {role, content} keys
         stop_strings: An optional list of strings to stop generation (antiprompt)
-        reset: Reset context flag
+        reset: Force a context reset even if the history matches the KV cache
         sampler_params: Optional additional sampler params
+        session_id: Optional session / conversation id whose KV state to use
+        max_tokens: Optional maximum number of tokens to generate
+        trace: Optional :class:`Trace` of the request
 
     """
-    msgs, _reset = get_message_list(messages)
-    reset = _reset or reset
-    add_bos = False
-    if reset:
-        iface.reset_context()
-        add_bos = True
+    trace = trace or Trace("complete_chat")
+    with trace.span("sync"):
+        msgs, add_bos = iface.sync_prefix(get_message_list(messages), reset=reset,
+                                          session_id=session_id)
     sys.stdout.flush()
     return str(iface.eval_message(msgs, stream=False,
                                   add_bos=add_bos,
                                   stop_strings=stop_strings,
-                                  sampler_params=sampler_params))
+                                  sampler_params=sampler_params,
+                                  n_predict=max_tokens,
+                                  trace=trace))
+
+
+def run_in_engine(iface: GemmaInterface, func, *args, **kwargs) -> asyncio.Future:
+    """Run blocking :code:`func` on the interface's engine thread.
+
+    Keeps the event loop free to serve :code:`/interrupt`, :code:`/is_generating`
+    etc. while the library evaluates the prompt and generates.
+
+    Args:
+        iface: GemmaInterface
+        func: Function to call with :code:`args` and :code:`kwargs`
+
+
+    """
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(iface.executor, partial(func, *args, **kwargs))
 
 
 def get_usage_timings(iface: GemmaInterface):
@@ -177,10 +268,39 @@ def get_usage_timings(iface: GemmaInterface):
             "predicted_ms": generation_time*1000,
             "predicted_per_token_ms": generation_time/predicted_n*1000,
             "predicted_per_second": 1/generation_time*predicted_n,
+            "cached_messages": iface.cached_messages,
+            "images": iface.image_timings,
         }
     }
 
 
+async def read_body(request: Request) -> tuple[dict, dict[str, UploadFile]]:
+    """Read the JSON body of a request and any uploaded files.
+
+    A :code:`multipart/form-data` request carries the JSON body in its
+    :code:`payload` field and the images as files, which the messages refer
+    to as :code:`{"upload": <field>}`. This avoids base64 encoding the images
+    and parsing them as part of the JSON. The caller closes the uploads.
+
+    Args:
+        request: The request
+
+
+    """
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        if not multipart_available():
+            raise ImageError("Multipart uploads need python-multipart to be installed")
+        form = await request.form(max_files=1024)
+        try:
+            body = json.loads(form["payload"])
+        except Exception:
+            await form.close()
+            raise
+        uploads = {k: v for k, v in form.multi_items() if isinstance(v, UploadFile)}
+        return body, uploads
+    return await request.json(), {}
+
+
 async def chat(request: Request) -> StreamingResponse | JSONResponse:
     """
     Handles the chat endpoints
@@ -188,19 +308,43 @@ async def chat(request: Request) -> StreamingResponse | JSONResponse:
     :code:`/chat/completions`
     :code:`/v1/chat/completions`
 
+    The phases of the request are timed in a :class:`Trace`, sent as the
+    :code:`Server-Timing` header and, with :code:`include_timing` in the
+    body, as :code:`timing` with the usage.
     """
-    iface: GemmaInterface = request.app.state.llama_interface
+    received = time.time()
+    scheduler: RequestScheduler = request.app.state.scheduler
+    metrics: EngineMetrics = request.app.state.metrics
+    trace = Trace(request.url.path, request.app.state.trace_exporter)
     try:
-        body = await request.json()
-        messages = body["messages"]
+        with trace.span("parse"):
+            body, uploads = await read_body(request)
+            try:
+                messages = resolve_image_refs(body["messages"], uploads,
+                                              request.app.state.image_root)
+            finally:
+                # The images stay mapped or copied in their refs
+                for upload in uploads.values():
+                    await upload.close()
         stream = body.get("stream", False)
         stop_strings = body.get("stop", [])
         reset = body.get("reset", False)
+        session_id = body.get("session_id") or body.get("conversation_id") or\
+            request.headers.get("x-session-id")
+        batch_tokens = int((body.get("stream_options") or {}).get("batch_tokens", 1))
+        max_tokens = body.get("max_completion_tokens") or body.get("max_tokens")
+        max_tokens = int(max_tokens) if max_tokens else None
+        include_timing = bool(body.get("include_timing", False))
+    except ImageError as e:
+        metrics.requests.inc(outcome="bad_request")
+        return JSONResponse({"error": str(e)}, status_code=400)
     except Exception as e:
+        metrics.requests.inc(outcome="bad_request")
+
         async def error_generator(e):
-            err = {'error': str(e)}
-            yield f"data: {json.dumps(err)}\n\n"
-            yield "data: [DONE]\n\n"
+            encoder = SSEEncoder()
+            yield encoder.error(e)
+            yield encoder.done
         return StreamingResponse(error_generator(e), media_type="text/event-stream")
 
     sampler_params = {k: body.get(k)
@@ -209,19 +353,85 @@ async def chat(request: Request) -> StreamingResponse | JSONResponse:
     if "temperature" in sampler_params:
         sampler_params["temp"] = sampler_params.pop("temperature")
 
+    try:
+        with trace.span("queue"):
+            iface: GemmaInterface = await scheduler.acquire()
+    except SchedulerError as e:
+        metrics.requests.inc(outcome="rejected")
+        return scheduler_error_response(e)
+    metrics.queue_wait.observe(scheduler.last_wait)
+
+    def on_usage(usage: dict):
+        if iface.first_token_time is not None:
+            metrics.ttft.observe(iface.first_token_time - received)
+            trace.add("first_token", iface.generation_start_time, iface.first_token_time)
+        trace.add("generate", iface.generation_start_time, time.time())
+        metrics.observe_usage(usage)
+        if include_timing:
+            usage["timing"] = trace.to_dict()
+
     async def generate() -> AsyncGenerator[str, None]:
-        async for chunk in stream_chat(iface, messages,
-                                       reset=reset,
-                                       stop_strings=stop_strings,
-                                       sampler_params=sampler_params):
-            yield f"data: {chunk}\n\n"
+        watcher = DisconnectWatcher(request, iface)
+        finished = False
+        try:
+            async for chunk in stream_chat(iface, messages,
+                                           reset=reset,
+                                           stop_strings=stop_strings,
+                                           sampler_params=sampler_params,
+                                           session_id=session_id,
+                                           encoder=SSEEncoder(batch_tokens),
+                                           max_tokens=max_tokens,
+                                           on_usage=on_usage,
+                                           trace=trace):
+                yield chunk
+            finished = True
+        finally:
+            watcher.stop()
+            trace.finish()
+            if not finished:
+                # Cancelled by the server on disconnect, stop the engine and drain
+                scheduler.abandon(iface.abort())
+            elif watcher.disconnected:
+                scheduler.abandon()
+            else:
+                scheduler.release()
+            metrics.requests.inc(outcome="ok" if finished and not watcher.disconnected
+                                 else "disconnected")
     if stream:
-        return StreamingResponse(generate(), media_type="text/event-stream")
+        # Only the phases before the response are known when its headers are sent
+        return StreamingResponse(generate(), media_type="text/event-stream",
+                                 headers={"Server-Timing": trace.server_timing()})
     else:
-        result = complete_chat(iface, messages,
-                               reset=reset,
-                               stop_strings=stop_strings,
-                               sampler_params=sampler_params)
+        watcher = DisconnectWatcher(request, iface)
+        job = run_in_engine(iface, complete_chat, iface, messages,
+                            reset=reset,
+                            stop_strings=stop_strings,
+                            sampler_params=sampler_params,
+                            session_id=session_id,
+                            max_tokens=max_tokens,
+                            trace=trace)
+        try:
+            # Shielded so that the engine keeps the slot until the job is really done
+            result = await asyncio.shield(job)
+            usage = get_usage_timings(iface)
+            on_usage(usage)
+        except ImageError as e:
+            metrics.requests.inc(outcome="bad_request")
+            return JSONResponse({"error": str(e)}, status_code=400)
+        except BaseException:
+            metrics.requests.inc(outcome="disconnected" if watcher.disconnected else "error")
+            raise
+        finally:
+            watcher.stop()
+            if not job.done():
+                iface.interrupt()
+                scheduler.abandon(job)
+            elif watcher.disconnected:
+                scheduler.abandon()
+            else:
+                scheduler.release()
+        metrics.requests.inc(outcome="disconnected" if watcher.disconnected else "ok")
+        trace.finish()
         return JSONResponse({"role": "assistant",
                              "choices": [
                                  {"message": {"content": result},
@@ -234,33 +444,95 @@ async def chat(request: Request) -> StreamingResponse | JSONResponse:
                                   "audio": None,
                                   "function_call": None,
                                   "tool_calls": None}],
-                             **get_usage_timings(iface)},
-                            status_code=200)
+                             **usage},
+                            status_code=200,
+                            headers={"Server-Timing": trace.server_timing()})
 
 
 async def reset_context(request: Request) -> JSONResponse:
-    iface: GemmaInterface = request.app.state.llama_interface
-    result = iface.reset_context()
+    try:
+        async with request.app.state.scheduler.slot() as iface:
+            result = iface.reset_context()
+    except SchedulerError as e:
+        return scheduler_error_response(e)
     if not result:
         return JSONResponse({"message": "Successfully reset"}, status_code=200)
     else:
         return JSONResponse({"message": "Could not reset"}, status_code=500)
 
 
+def loaded_iface(request: Request) -> GemmaInterface:
+    """The interface, if the model has loaded"""
+    if (iface := request.app.state.llama_interface) is None:
+        raise HTTPException(503, f"Model is {request.app.state.status}",
+                            headers={"Retry-After": "5"})
+    return iface
+
+
 async def interrupt(request: Request) -> JSONResponse:
-    request.app.state.llama_interface.interrupt()
+    loaded_iface(request).interrupt()
     return JSONResponse({"message": "Interrupted"})
 
 
 async def is_generating(request: Request) -> JSONResponse:
-    val = request.app.state.llama_interface.is_generating()
+    val = loaded_iface(request).is_generating()
     return JSONResponse({"message": val})
 
 
+async def health(request: Request) -> JSONResponse:
+    """Status of the worker, one of "loading", "ready", "generating" or "error"
+
+    The status code is 200 once the model has loaded and 503 before.
+    """
+    state = request.app.state
+    status = state.status
+    if status == "ready" and state.llama_interface.is_generating():
+        status = "generating"
+    body = {"status": status}
+    if state.load_error:
+        body["error"] = state.load_error
+    return JSONResponse(body, status_code=200 if status in {"ready", "generating"} else 503)
+
+
+async def queue_stats(request: Request) -> JSONResponse:
+    return JSONResponse(request.app.state.scheduler.stats())
+
+
+async def prometheus_metrics(request: Request) -> Response:
+    """Prometheus metrics of the worker, see :class:`EngineMetrics`"""
+    return request.app.state.metrics.registry.response()
+
+
+async def sessions(request: Request) -> JSONResponse:
+    iface = loaded_iface(request)
+    return JSONResponse({"active": iface.active_session,
+                         "supports_state": iface.supports_state,
+                         **iface.sessions.stats(),
+                         "disk": iface.disk_cache and iface.disk_cache.stats(),
+                         "images": iface.image_cache.stats()})
+
+
 async def create_app(config, mock_llama_interface=None) -> Starlette:
     """
     Create the Starlette application.
+
+    Keys in :code:`config` named in :data:`SCHEDULER_OPTIONS` configure the
+    :class:`RequestScheduler`. :code:`image_root` is the directory requests may
+    refer to local images in. :code:`trace_exporter` optionally exports the
+    traces of requests, see :func:`make_exporter`. The rest are passed on to
+    :class:`GemmaInterface`.
+
+    The model is loaded in the background after startup, see :func:`health`.
+    Requests that arrive meanwhile wait in the scheduler's queue, and get a
+    503 should the model fail to load.
     """
+    config = dict(config or {})
+    image_root = config.pop("image_root", None)
+    trace_exporter = make_exporter(config.pop("trace_exporter", None), "gemma_worker")
+    scheduler_opts = {}
+    for k in SCHEDULER_OPTIONS:
+        if (v := config.pop(k, None)) is not None:
+            scheduler_opts[k] = v
     app = Starlette(routes=[
         Route("/stream", stream_response, methods=["POST"]),
         Route("/completions", chat, methods=["POST"]),
@@ -269,17 +541,49 @@ async def create_app(config, mock_llama_interface=None) -> Starlette:
         Route("/reset_context", reset_context, methods=["GET"]),
         Route("/interrupt", interrupt, methods=["GET"]),
         Route("/is_generating", is_generating, methods=["GET"]),
+        Route("/queue_stats", queue_stats, methods=["GET"]),
+        Route("/sessions", sessions, methods=["GET"]),
+        Route("/health", health, methods=["GET"]),
+        Route("/metrics", prometheus_metrics, methods=["GET"]),
     ], debug=True)
+    app.state.image_root = image_root
+    app.state.trace_exporter = trace_exporter
+    app.state.metrics = EngineMetrics(lambda: app.state.scheduler.stats())
+    app.state.llama_interface = None
+    app.state.status = "loading"
+    app.state.load_error = None
+
+    async def load(scheduler: RequestScheduler):
+        # Holds the scheduler's slot until the model has loaded
+        await scheduler.acquire()
+        try:
+            loop = asyncio.get_running_loop()
+            iface = await asyncio.to_thread(GemmaInterface, loop=loop, **config)
+        except Exception as e:
+            print(f"Could not load model: {e}")
+            app.state.status = "error"
+            app.state.load_error = str(e)
+            # Queued and later requests fail at once, the model will not load
+            scheduler.fail(f"Model failed to load: {e}")
+            return
+        scheduler.iface = app.state.llama_interface = iface
+        app.state.status = "ready"
+        scheduler.release()
 
     async def startup():
         if mock_llama_interface is not None:
             app.state.llama_interface = mock_llama_interface
+            app.state.status = "ready"
+            app.state.scheduler = RequestScheduler(mock_llama_interface, **scheduler_opts)
         else:
-            loop = asyncio.get_running_loop()
-            app.state.llama_interface = GemmaInterface(
-                loop=loop,
-                **config
-            )
+            app.state.scheduler = RequestScheduler(None, **scheduler_opts)
+            app.state.loader = asyncio.create_task(load(app.state.scheduler))
+
+    async def shutdown():
+        iface = getattr(app.state, "llama_interface", None)
+        if persist := getattr(iface, "persist_sessions", None):
+            persist()
 
     app.add_event_handler("startup", startup)
+    app.add_event_handler("shutdown", shutdown)
     return app
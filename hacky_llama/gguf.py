@@ -0,0 +1,315 @@
+from typing import Any, BinaryIO, Optional
+from pathlib import Path
+import struct
+
+
+GGUF_MAGIC = b"GGUF"
+
+# GGUF metadata value types, see gguf.h
+(UINT8, INT8, UINT16, INT16, UINT32, INT32, FLOAT32, BOOL, STRING, ARRAY, UINT64, INT64,
+ FLOAT64) = range(13)
+
+SCALAR_FORMATS = {UINT8: "<B", INT8: "<b", UINT16: "<H", INT16: "<h", UINT32: "<I",
+                  INT32: "<i", FLOAT32: "<f", BOOL: "<?", UINT64: "<Q", INT64: "<q",
+                  FLOAT64: "<d"}
+
+# ggml tensor types as (name, elements per block, bytes per block), see ggml.h
+GGML_TYPES = {
+    0: ("F32", 1, 4), 1: ("F16", 1, 2), 2: ("Q4_0", 32, 18), 3: ("Q4_1", 32, 20),
+    6: ("Q5_0", 32, 22), 7: ("Q5_1", 32, 24), 8: ("Q8_0", 32, 34), 9: ("Q8_1", 32, 36),
+    10: ("Q2_K", 256, 84), 11: ("Q3_K", 256, 110), 12: ("Q4_K", 256, 144),
+    13: ("Q5_K", 256, 176), 14: ("Q6_K", 256, 210), 15: ("Q8_K", 256, 292),
+    16: ("IQ2_XXS", 256, 66), 17: ("IQ2_XS", 256, 74), 18: ("IQ3_XXS", 256, 98),
+    19: ("IQ1_S", 256, 50), 20: ("IQ4_NL", 32, 18), 21: ("IQ3_S", 256, 110),
+    22: ("IQ2_S", 256, 82), 23: ("IQ4_XS", 256, 136), 24: ("I8", 1, 1), 25: ("I16", 1, 2),
+    26: ("I32", 1, 4), 27: ("I64", 1, 8), 28: ("F64", 1, 8), 29: ("IQ1_M", 256, 56),
+    30: ("BF16", 1, 2), 34: ("TQ1_0", 256, 54), 35: ("TQ2_0", 256, 66),
+    39: ("MXFP4", 32, 17),
+}
+
+# general.file_type, the predominant quantization of a model, see llama.h
+FILE_TYPES = {0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1",
+              10: "Q2_K", 11: "Q3_K_S", 12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S",
+              15: "Q4_K_M", 16: "Q5_K_S", 17: "Q5_K_M", 18: "Q6_K", 19: "IQ2_XXS",
+              20: "IQ2_XS", 21: "Q2_K_S", 22: "IQ3_XS", 23: "IQ3_XXS", 24: "IQ1_S",
+              25: "IQ4_NL", 26: "IQ3_S", 27: "IQ3_M", 28: "IQ2_S", 29: "IQ2_M",
+              30: "IQ4_XS", 31: "IQ1_M", 32: "BF16", 36: "TQ1_0", 37: "TQ2_0",
+              38: "MXFP4_MOE"}
+
+
+class GGUFError(Exception):
+    pass
+
+
+class TensorInfo:
+    """Name, shape and type of a tensor in a GGUF file"""
+    __slots__ = ("name", "shape", "type", "offset")
+
+    def __init__(self, name: str, shape: tuple[int, ...], ggml_type: int, offset: int):
+        self.name = name
+        self.shape = shape
+        self.type = ggml_type
+        self.offset = offset
+
+    @property
+    def type_name(self) -> str:
+        return GGML_TYPES[self.type][0] if self.type in GGML_TYPES else str(self.type)
+
+    @property
+    def nbytes(self) -> int:
+        elements = 1
+        for d in self.shape:
+            elements *= d
+        if self.type not in GGML_TYPES:
+            raise GGUFError(f"Unknown type {self.type} of tensor {self.name}")
+        _, block, size = GGML_TYPES[self.type]
+        return elements // block * size
+
+
+class GGUFHeader:
+    """Metadata and tensor infos of a GGUF file, read without its weights.
+
+    Arrays longer than :code:`max_array`, like the tokenizer's vocabulary, are
+    skipped, their lengths are in :code:`array_lengths`.
+
+    Args:
+        version: GGUF version
+        metadata: Metadata key values
+        tensors: Infos of the tensors
+        array_lengths: Lengths of all the array values by key
+
+
+    """
+    def __init__(self, version: int, metadata: dict[str, Any], tensors: list[TensorInfo],
+                 array_lengths: dict[str, int]):
+        self.version = version
+        self.metadata = metadata
+        self.tensors = tensors
+        self.array_lengths = array_lengths
+
+    @property
+    def architecture(self) -> Optional[str]:
+        return self.metadata.get("general.architecture")
+
+    def arch_value(self, key: str, default: Any = None) -> Any:
+        """Metadata :code:`key` of the model's architecture, e.g. "block_count" """
+        return self.metadata.get(f"{self.architecture}.{key}", default)
+
+    @property
+    def n_layers(self) -> int:
+        return self.arch_value("block_count", 0)
+
+    @property
+    def context_length(self) -> Optional[int]:
+        return self.arch_value("context_length")
+
+    @property
+    def n_embd(self) -> int:
+        return self.arch_value("embedding_length", 0)
+
+    @property
+    def n_vocab(self) -> int:
+        return (self.arch_value("vocab_size") or
+                self.array_lengths.get("tokenizer.ggml.tokens", 0))
+
+    @property
+    def n_head(self) -> int:
+        n_head = self.arch_value("attention.head_count", 0)
+        return max(n_head) if isinstance(n_head, list) else n_head
+
+    def head_counts(self) -> list[int]:
+        """Number of KV heads of each layer"""
+        n_head = self.arch_value("attention.head_count", 0)
+        n_head_kv = self.arch_value("attention.head_count_kv", n_head)
+        if isinstance(n_head_kv, list):
+            return n_head_kv
+        return [n_head_kv] * self.n_layers
+
+    @property
+    def key_length(self) -> int:
+        head_dim = self.n_embd // self.n_head if self.n_head else 0
+        return self.arch_value("attention.key_length", head_dim)
+
+    @property
+    def value_length(self) -> int:
+        return self.arch_value("attention.value_length", self.key_length)
+
+    @property
+    def file_type(self) -> Optional[str]:
+        if (file_type := self.metadata.get("general.file_type")) is None:
+            return None
+        return FILE_TYPES.get(file_type, str(file_type))
+
+    @property
+    def n_params(self) -> int:
+        n = 0
+        for t in self.tensors:
+            elements = 1
+            for d in t.shape:
+                elements *= d
+            n += elements
+        return n
+
+    @property
+    def weight_bytes(self) -> int:
+        return sum(t.nbytes for t in self.tensors)
+
+    def layer_bytes(self) -> list[int]:
+        """Bytes of the weights of each layer"""
+        sizes = [0] * self.n_layers
+        for t in self.tensors:
+            if t.name.startswith("blk."):
+                if (i := int(t.name.split(".")[1])) < len(sizes):
+                    sizes[i] += t.nbytes
+        return sizes
+
+    def summary(self) -> dict:
+        """The commonly needed metadata, JSON serializable"""
+        return {"architecture": self.architecture,
+                "name": self.metadata.get("general.name"),
+                "file_type": self.file_type,
+                "n_layers": self.n_layers,
+                "context_length": self.context_length,
+                "n_embd": self.n_embd,
+                "n_vocab": self.n_vocab,
+                "n_tensors": len(self.tensors),
+                "n_params": self.n_params,
+                "weight_bytes": self.weight_bytes}
+
+
+class _Reader:
+    def __init__(self, f: BinaryIO):
+        self.f = f
+
+    def read(self, n: int) -> bytes:
+        data = self.f.read(n)
+        if len(data) != n:
+            raise GGUFError("Unexpected end of file")
+        return data
+
+    def scalar(self, value_type: int):
+        fmt = SCALAR_FORMATS[value_type]
+        return struct.unpack(fmt, self.read(struct.calcsize(fmt)))[0]
+
+    def string(self) -> str:
+        return self.read(self.scalar(UINT64)).decode(errors="replace")
+
+    def skip_string(self):
+        n = self.scalar(UINT64)
+        self.f.seek(n, 1)
+
+    def value(self, value_type: int, key: str, array_lengths: dict[str, int], max_array: int):
+        if value_type == STRING:
+            return self.string()
+        if value_type == ARRAY:
+            item_type = self.scalar(UINT32)
+            n = self.scalar(UINT64)
+            array_lengths[key] = n
+            if n > max_array:
+                self.skip_array(item_type, n, key)
+                return None
+            return [self.value(item_type, key, array_lengths, max_array) for _ in range(n)]
+        if value_type not in SCALAR_FORMATS:
+            raise GGUFError(f"Unknown type {value_type} of {key}")
+        return self.scalar(value_type)
+
+    def skip_array(self, item_type: int, n: int, key: str):
+        if item_type == STRING:
+            for _ in range(n):
+                self.skip_string()
+        elif item_type == ARRAY:
+            for _ in range(n):
+                self.skip_array(self.scalar(UINT32), self.scalar(UINT64), key)
+        elif item_type not in SCALAR_FORMATS:
+            raise GGUFError(f"Unknown type {item_type} of {key}")
+        else:
+            self.f.seek(struct.calcsize(SCALAR_FORMATS[item_type]) * n, 1)
+
+
+def read_header(path: str | Path, max_array: int = 64) -> GGUFHeader:
+    """Read the metadata and tensor infos of the GGUF file at :code:`path`.
+
+    Only the header at the start of the file is read, not the weights.
+
+    Args:
+        path: Path of the file
+        max_array: Arrays longer than this are skipped
+
+
+    Raises:
+        GGUFError: If the file is not GGUF version 2 or 3, or is truncated
+
+    """
+    with open(path, "rb") as f:
+        r = _Reader(f)
+        if r.read(4) != GGUF_MAGIC:
+            raise GGUFError(f"{path} is not a GGUF file")
+        if (version := r.scalar(UINT32)) not in (2, 3):
+            raise GGUFError(f"Unsupported GGUF version {version}")
+        n_tensors = r.scalar(UINT64)
+        n_kv = r.scalar(UINT64)
+        metadata: dict[str, Any] = {}
+        array_lengths: dict[str, int] = {}
+        for _ in range(n_kv):
+            key = r.string()
+            value = r.value(r.scalar(UINT32), key, array_lengths, max_array)
+            if value is not None:
+                metadata[key] = value
+        tensors = []
+        for _ in range(n_tensors):
+            name = r.string()
+            n_dims = r.scalar(UINT32)
+            shape = tuple(r.scalar(UINT64) for _ in range(n_dims))
+            tensors.append(TensorInfo(name, shape, r.scalar(UINT32), r.scalar(UINT64)))
+    return GGUFHeader(version, metadata, tensors, array_lengths)
+
+
+def write_header(path: str | Path, metadata: dict[str, Any],
+                 tensors: list[tuple[str, tuple[int, ...], int]]):
+    """Write a GGUF file with :code:`metadata` and infos of :code:`tensors`, but no weights.
+
+    For synthetic models in tests. Ints are written as UINT32, or INT64 if
+    they do not fit, floats as FLOAT32 and lists as arrays of the type of
+    their first item.
+
+    Args:
+        path: Path of the file
+        metadata: Metadata key values
+        tensors: (name, shape, ggml type) of each tensor
+
+
+    """
+    def value_type(value) -> int:
+        if isinstance(value, bool):
+            return BOOL
+        if isinstance(value, int):
+            return UINT32 if 0 <= value < 1 << 32 else INT64
+        if isinstance(value, float):
+            return FLOAT32
+        if isinstance(value, str):
+            return STRING
+        if isinstance(value, list):
+            return ARRAY
+        raise GGUFError(f"Cannot write {type(value)}")
+
+    def encode(value) -> bytes:
+        t = value_type(value)
+        if t == STRING:
+            data = value.encode()
+            return struct.pack("<Q", len(data)) + data
+        if t == ARRAY:
+            item_type = value_type(value[0]) if value else UINT32
+            return (struct.pack("<IQ", item_type, len(value)) +
+                    b"".join(encode(v) for v in value))
+        return struct.pack(SCALAR_FORMATS[t], value)
+
+    out = [GGUF_MAGIC, struct.pack("<IQQ", 3, len(tensors), len(metadata))]
+    for key, value in metadata.items():
+        out += [encode(key), struct.pack("<I", value_type(value)), encode(value)]
+    offset = 0
+    for name, shape, ggml_type in tensors:
+        out += [encode(name), struct.pack("<I", len(shape)),
+                b"".join(struct.pack("<Q", d) for d in shape),
+                struct.pack("<IQ", ggml_type, offset)]
+        offset += TensorInfo(name, shape, ggml_type, offset).nbytes
+    Path(path).write_bytes(b"".join(out))
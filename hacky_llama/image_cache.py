@@ -0,0 +1,72 @@
+from typing import Optional
+import collections
+import ctypes
+import hashlib
+
+from .image_input import ImageRef
+
+
+class ImageCache:
+    """LRU cache of preprocessed images, ready to be passed to the library.
+
+    Images are keyed by a hash of their content as received, so the same
+    image sent again in a later turn is neither decoded, preprocessed nor
+    copied again. The
+    total size of the cached images is bounded by :code:`max_bytes`.
+
+    Args:
+        max_bytes: Maximum total size of the cached images
+
+
+    """
+    def __init__(self, max_bytes: int = 256 << 20):
+        self.max_bytes = max_bytes
+        self._images: collections.OrderedDict[str, ctypes.Array] = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._images)
+
+    @staticmethod
+    def key(img: str | bytes | ImageRef) -> str:
+        """Content hash of an image
+
+        Args:
+            img: Base64 encoded or raw image, or a reference that has its own key
+
+
+        """
+        if isinstance(img, ImageRef):
+            return img.key
+        data = img.encode() if isinstance(img, str) else img
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[ctypes.Array]:
+        data = self._images.get(key)
+        if data is not None:
+            self._images.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return data
+
+    def put(self, key: str, data: ctypes.Array):
+        if key in self._images:
+            self.nbytes -= len(self._images.pop(key))
+        self._images[key] = data
+        self.nbytes += len(data)
+        while self.nbytes > self.max_bytes and len(self._images) > 1:
+            _, evicted = self._images.popitem(last=False)
+            self.nbytes -= len(evicted)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {"images": len(self._images),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
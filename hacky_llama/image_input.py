@@ -0,0 +1,144 @@
+from typing import Optional, Any
+from io import BytesIO
+import hashlib
+import importlib.util
+import mmap
+import os
+
+from .image_preprocess import ImageError
+
+
+class ImageRef:
+    """Raw image bytes received out of band, with their cache key.
+
+    :code:`data` is a bytes-like object. Files are mapped with
+    :code:`mmap.ACCESS_COPY` so that the library can read them without any
+    copies in python.
+
+    Args:
+        data: The image bytes
+        key: Key for the image cache
+        source: Where the image came from, for error messages
+
+
+    """
+    __slots__ = ("data", "key", "source")
+
+    def __init__(self, data: bytes | mmap.mmap, key: str, source: str):
+        self.data = data
+        self.key = key
+        self.source = source
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return f"ImageRef({self.source!r}, {len(self.data)} bytes)"
+
+
+def multipart_available() -> bool:
+    """Whether :code:`python-multipart` is installed for parsing uploads"""
+    return any(importlib.util.find_spec(name) is not None
+               for name in ("python_multipart", "multipart"))
+
+
+def map_file(fileobj) -> mmap.mmap:
+    """Map the whole of an open file copy-on-write"""
+    try:
+        return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_COPY)
+    except ValueError:
+        raise ImageError("Empty image file")
+
+
+def read_local_image(path: str, image_root: Optional[str]) -> ImageRef:
+    """Map an image file under :code:`image_root`.
+
+    The cache key is derived from the path, size and modification time so the
+    file is not read before it is needed.
+
+    Args:
+        path: Path relative to :code:`image_root`
+        image_root: Directory local images may be read from. :code:`None`
+                    disallows local images
+
+
+    """
+    if not image_root:
+        raise ImageError("Local image paths are not enabled on this server")
+    root = os.path.realpath(image_root)
+    full_path = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, full_path]) != root:
+        raise ImageError(f"Image path {path} is outside the image root")
+    try:
+        with open(full_path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            data = map_file(f)
+    except OSError as e:
+        raise ImageError(f"Could not open image {path}: {e.strerror}")
+    key = hashlib.blake2b(f"{full_path}\0{stat.st_size}\0{stat.st_mtime_ns}".encode(),
+                          digest_size=16).hexdigest()
+    return ImageRef(data, key, path)
+
+
+def read_upload(name: str, upload) -> ImageRef:
+    """Get the bytes of an uploaded file without reading it into a new buffer.
+
+    Starlette spools uploads in memory up to a size and to a temporary file
+    beyond it. Spooled files are mapped, small ones are used as they are.
+
+    Args:
+        name: Form field of the upload
+        upload: The :class:`starlette.datastructures.UploadFile`
+
+
+    """
+    f = upload.file
+    f.flush()
+    # SpooledTemporaryFile only exposes its buffer privately, and fileno()
+    # would write an in memory one out to disk
+    inner = getattr(f, "_file", f)
+    if isinstance(inner, BytesIO):
+        data = inner.getvalue()
+        if not data:
+            raise ImageError(f"Empty upload {name}")
+    else:
+        data = map_file(inner)
+    return ImageRef(data, hashlib.blake2b(data, digest_size=16).hexdigest(), name)
+
+
+def resolve_image_refs(messages: list[dict], uploads: dict[str, Any],
+                       image_root: Optional[str]) -> list[dict]:
+    """Replace image references in :code:`messages` by their data.
+
+    Wherever an image may be given as a base64 string, it may instead be a
+    dict :code:`{"upload": <form field>}` naming a file of a multipart
+    request or :code:`{"path": <path>}` naming a file under :code:`image_root`.
+
+    Args:
+        messages: Messages as received
+        uploads: Uploaded files by form field
+        image_root: Directory local images may be read from
+
+
+    """
+    def resolve(img):
+        if not isinstance(img, dict):
+            return img
+        if "upload" in img:
+            if img["upload"] not in uploads:
+                raise ImageError(f"No uploaded file {img['upload']}")
+            return read_upload(img["upload"], uploads[img["upload"]])
+        if "path" in img:
+            return read_local_image(img["path"], image_root)
+        raise ImageError(f"Bad image reference {img}")
+
+    resolved = []
+    for m in messages:
+        content = m.get("content")
+        if isinstance(content, list):
+            content = [{**x, "image": resolve(x["image"])} if x.get("type") == "image" else x
+                       for x in content]
+        elif isinstance(content, dict) and content.get("images"):
+            content = {**content, "images": [resolve(x) for x in content["images"]]}
+        resolved.append({**m, "content": content})
+    return resolved
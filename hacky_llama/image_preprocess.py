@@ -0,0 +1,106 @@
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import base64
+import binascii
+import mmap
+import time
+
+from PIL import Image, UnidentifiedImageError
+
+
+class ImageError(ValueError):
+    """An image could not be decoded or is invalid"""
+
+
+class ImagePreprocessor:
+    """Decode, validate, downscale and re-encode the images of a request in parallel.
+
+    Images within :code:`max_side` and in one of the accepted formats are only
+    validated from their header and passed on as they are. Larger ones are
+    downscaled and re-encoded as :code:`format`. PIL releases the GIL while
+    decoding, resizing and encoding, so a thread pool is enough to use
+    several cores.
+
+    Args:
+        max_side: Maximum width and height in pixels. :code:`None` keeps the size
+        format: Format to re-encode images as, "PNG" or "JPEG"
+        quality: JPEG quality
+        workers: Number of threads
+
+
+    """
+    accepted_formats = {"PNG", "JPEG", "WEBP", "BMP", "GIF"}
+
+    def __init__(self, max_side: Optional[int] = None, format: str = "PNG", quality: int = 90,
+                 workers: int = 4):
+        self.max_side = max_side
+        self.format = format.upper()
+        self.quality = quality
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-prep")
+
+    def process_one(self, img: str | bytes | mmap.mmap) -> tuple[bytes | mmap.mmap, dict]:
+        """Preprocess one image
+
+        A mapped file is read in place and passed on as it is if it needs no
+        resizing.
+
+        Args:
+            img: Base64 encoded or raw image
+
+        Returns:
+            The image bytes to pass to the library and the timings of each step
+
+
+        """
+        start = time.perf_counter()
+        if isinstance(img, str):
+            try:
+                raw = base64.b64decode(img, validate=True)
+            except binascii.Error as e:
+                raise ImageError(f"Bad base64 image data: {e}")
+        else:
+            raw = img
+        t_decode = time.perf_counter()
+        if isinstance(raw, mmap.mmap):
+            raw.seek(0)
+            fp = raw
+        else:
+            fp = BytesIO(raw)
+        try:
+            image = Image.open(fp)
+        except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+            raise ImageError(f"Could not read image: {e}")
+        info = {"bytes_in": len(raw), "width": image.width, "height": image.height,
+                "format": image.format}
+        resize = self.max_side is not None and max(image.size) > self.max_side
+        if not resize and image.format in self.accepted_formats:
+            data = raw
+            t_resize = t_encode = time.perf_counter()
+        else:
+            try:
+                image.load()
+            except (Image.DecompressionBombError, OSError) as e:
+                raise ImageError(f"Could not decode image: {e}")
+            if resize:
+                image.thumbnail((self.max_side, self.max_side), Image.Resampling.BICUBIC)
+            if self.format == "JPEG" and image.mode not in {"RGB", "L"}:
+                image = image.convert("RGB")
+            t_resize = time.perf_counter()
+            out = BytesIO()
+            image.save(out, format=self.format, quality=self.quality)
+            data = out.getvalue()
+            t_encode = time.perf_counter()
+            info.update({"width": image.width, "height": image.height, "format": self.format})
+        timings = {**info,
+                   "bytes_out": len(data),
+                   "decode_ms": (t_decode - start) * 1000,
+                   "resize_ms": (t_resize - t_decode) * 1000,
+                   "encode_ms": (t_encode - t_resize) * 1000}
+        return data, timings
+
+    def process(self, images: list[str | bytes | mmap.mmap]) -> list[tuple[bytes | mmap.mmap, dict]]:
+        """Preprocess :code:`images` in parallel, see :meth:`process_one`"""
+        if len(images) == 1:
+            return [self.process_one(images[0])]
+        return list(self.executor.map(self.process_one, images))
@@ -1,7 +1,7 @@
 from typing import Optional, AsyncGenerator
 import ctypes
 from ctypes import (cdll, c_void_p, c_char_p, c_int, create_string_buffer, CFUNCTYPE,
-                    POINTER, c_ubyte, cast, Structure, Array, c_voidp, c_bool)
+                    POINTER, c_ubyte, cast, Structure, Array, c_voidp, c_bool, c_size_t)
 import time
 from io import BytesIO
 import json
@@ -115,4 +115,35 @@ def init_lib(dll_path: str):
     lib.gemma3_tokens_info.argtypes = []
     lib.gemma3_tokens_info.restype = Gemma3TokensInfo
 
+    # Optional KV state (de)serialization of the static context. Not exported by
+    # all builds, see :func:`has_state_api`
+    if has_state_api(lib):
+        lib.gemma3_static_state_size.argtypes = []
+        lib.gemma3_static_state_size.restype = c_size_t
+
+        lib.gemma3_static_state_save.argtypes = [
+            POINTER(c_ubyte),           # destination buffer
+            c_size_t                    # buffer size
+        ]
+        lib.gemma3_static_state_save.restype = c_size_t
+
+        lib.gemma3_static_state_load.argtypes = [
+            POINTER(c_ubyte),           # source buffer
+            c_size_t                    # buffer size
+        ]
+        lib.gemma3_static_state_load.restype = c_size_t
+
     return lib
+
+
+def has_state_api(lib) -> bool:
+    """Check if :code:`lib` can save and restore the KV state of the context
+
+    Args:
+        lib: The loaded library
+
+
+    """
+    return all(hasattr(lib, name) for name in ("gemma3_static_state_size",
+                                               "gemma3_static_state_save",
+                                               "gemma3_static_state_load"))
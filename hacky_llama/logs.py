@@ -0,0 +1,105 @@
+from typing import AsyncIterator
+from collections import deque
+import asyncio
+import json
+import logging
+import sys
+import time
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+
+
+logger = logging.getLogger("hacky_llama.worker_output")
+
+
+def default_handler():
+    """Print worker output to stdout, as the manager did, unless logging is configured"""
+    if logger.level == logging.NOTSET:
+        logger.setLevel(logging.INFO)
+    if not logger.hasHandlers():
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+
+
+class LogBuffer:
+    """The last :code:`max_lines` lines of output of a worker.
+
+    Each line is also logged to the :code:`hacky_llama.worker_output` logger,
+    with the worker and stream in its :code:`extra`, which prints them if
+    logging is not configured, see :func:`default_handler`. Lines are numbered, so
+    that readers can :meth:`follow` them from where they left off. It is
+    closed until the worker is started.
+
+    Args:
+        name: Name of the worker, for the log records
+        max_lines: Number of lines to keep
+
+
+    """
+    def __init__(self, name: str, max_lines: int = 2000):
+        self.name = name
+        self.lines: deque[dict] = deque(maxlen=max_lines)
+        self.seq = 0
+        self.closed = True
+        self._new = asyncio.Event()
+        default_handler()
+
+    def append(self, stream: str, text: str):
+        self.seq += 1
+        self.lines.append({"seq": self.seq, "time": time.time(), "stream": stream, "text": text})
+        logger.info(text, extra={"worker": self.name, "stream": stream})
+        self._wake()
+
+    def close(self):
+        """No more lines will come, e.g. as the worker exited"""
+        self.closed = True
+        self._wake()
+
+    def reopen(self):
+        self.closed = False
+
+    def _wake(self):
+        self._new.set()
+        self._new = asyncio.Event()
+
+    def tail(self, n: int) -> list[dict]:
+        return list(self.lines)[-n:] if n > 0 else []
+
+    def since(self, seq: int) -> list[dict]:
+        """Lines after line :code:`seq` that are still kept"""
+        return [line for line in self.lines if line["seq"] > seq]
+
+    async def follow(self, since: int) -> AsyncIterator[dict]:
+        """Lines after line :code:`since` as they come, until :meth:`close`"""
+        while True:
+            new = self._new
+            for line in self.since(since):
+                since = line["seq"]
+                yield line
+            if self.closed:
+                return
+            await new.wait()
+
+
+def log_response(log: LogBuffer, request: Request) -> Response:
+    """Response to a :code:`/logs` request for :code:`log`.
+
+    The query param :code:`tail` is the number of last lines, 100 by default.
+    With :code:`follow`, they and then new lines are streamed as NDJSON until
+    the worker exits or the client goes away.
+    """
+    try:
+        tail = int(request.query_params.get("tail", 100))
+    except ValueError:
+        return JSONResponse({"error": "tail must be an integer"}, status_code=400)
+    lines = log.tail(tail)
+    if request.query_params.get("follow", "false").lower() in {"0", "false", "no"}:
+        return JSONResponse({"worker": log.name, "closed": log.closed, "lines": lines})
+    since = lines[0]["seq"] - 1 if lines else log.seq
+
+    async def stream():
+        async for line in log.follow(since):
+            yield json.dumps(line) + "\n"
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
@@ -0,0 +1,264 @@
+from typing import Optional, Callable, Iterable
+import bisect
+import math
+
+from starlette.responses import Response
+
+
+# Seconds, for latencies from a few milliseconds to minutes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                   120.0)
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    """A metric family in the Prometheus text format.
+
+    Values are kept per tuple of label values, in the order of
+    :code:`labels`.
+
+    Args:
+        name: Metric name
+        help: Description
+        labels: Names of the labels
+
+
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} has labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[k]) for k in self.labels)
+
+    def label_str(self, key: tuple, extra: Optional[tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labels, key)) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+    def samples(self) -> Iterable[str]:
+        return []
+
+    def render(self) -> str:
+        return "".join([f"# HELP {self.name} {self.help}\n", f"# TYPE {self.name} {self.type}\n",
+                        *(f"{s}\n" for s in self.samples())])
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield f"{self.name}{self.label_str(key)} {format_value(value)}"
+
+
+class Gauge(Metric):
+    """A value that goes up and down.
+
+    With :code:`fn` the values are read when the metrics are rendered. It
+    returns the value, or the values by tuple of label values.
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (),
+                 fn: Optional[Callable[[], float | dict[tuple, float]]] = None):
+        super().__init__(name, help, labels)
+        self.values: dict[tuple, float] = {}
+        self.fn = fn
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+    def samples(self):
+        values = self.values
+        if self.fn is not None:
+            values = self.fn()
+            if not isinstance(values, dict):
+                values = {(): values}
+        for key, value in values.items():
+            yield f"{self.name}{self.label_str(key)} {format_value(value)}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (),
+                 buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Per label values: non cumulative bucket counts, sum
+        self.values: dict[tuple, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        if (entry := self.values.get(key)) is None:
+            entry = self.values[key] = ([0] * len(self.buckets), [0.0])
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    def count(self, **labels) -> int:
+        entry = self.values.get(self.key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def samples(self):
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield (f"{self.name}_bucket{self.label_str(key, ('le', format_value(bound)))} "
+                       f"{cumulative}")
+            yield f"{self.name}_sum{self.label_str(key)} {format_value(total[0])}"
+            yield f"{self.name}_count{self.label_str(key)} {cumulative}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Iterable[str] = (), fn=None) -> Gauge:
+        return self.add(Gauge(name, help, labels, fn))
+
+    def histogram(self, name: str, help: str, labels: Iterable[str] = (),
+                  buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        return "".join(m.render() for m in self.metrics)
+
+    def response(self) -> Response:
+        return Response(self.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+class EngineMetrics:
+    """Metrics of a gemma worker, see :func:`gemma_service.create_app`
+
+    Args:
+        scheduler_stats: Returns the scheduler's stats, read on each scrape
+
+
+    """
+    def __init__(self, scheduler_stats: Optional[Callable[[], dict]] = None):
+        r = self.registry = MetricsRegistry()
+        self.requests = r.counter("llama_requests_total", "Chat requests by outcome",
+                                  ["outcome"])
+        self.ttft = r.histogram("llama_time_to_first_token_seconds",
+                                "Seconds from receiving a request to its first token")
+        self.queue_wait = r.histogram("llama_queue_wait_seconds",
+                                      "Seconds requests waited for the model")
+        self.prompt_ms_per_token = r.histogram(
+            "llama_prompt_eval_ms_per_token", "Milliseconds to evaluate a prompt token",
+            buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250))
+        self.tokens_per_second = r.histogram(
+            "llama_generation_tokens_per_second", "Tokens generated per second of a response",
+            buckets=(1, 2.5, 5, 10, 20, 30, 50, 75, 100, 150, 250, 500))
+        self.prompt_tokens = r.counter("llama_prompt_tokens_total", "Prompt tokens evaluated")
+        self.generated_tokens = r.counter("llama_generated_tokens_total", "Tokens generated")
+        self.scheduler_stats = scheduler_stats
+        r.gauge("llama_queue_depth", "Requests waiting for the model",
+                fn=lambda: self.stat("queue_depth"))
+        r.gauge("llama_busy", "Whether the model is serving a request",
+                fn=lambda: int(bool(self.stat("busy"))))
+
+    def stat(self, name: str) -> float:
+        return (self.scheduler_stats() if self.scheduler_stats else {}).get(name, 0)
+
+    def observe_usage(self, usage: dict):
+        """Record the :code:`usage` and :code:`timings` of a finished response"""
+        self.prompt_tokens.inc(usage["usage"]["prompt_tokens"])
+        self.generated_tokens.inc(usage["usage"]["completion_tokens"])
+        timings = usage["timings"]
+        if timings["prompt_n"]:
+            self.prompt_ms_per_token.observe(timings["prompt_per_token_ms"])
+        if timings["predicted_n"]:
+            self.tokens_per_second.observe(timings["predicted_per_second"])
+
+
+class ProxyMetrics:
+    """Metrics of a model manager proxying to workers
+
+    Args:
+        workers: Returns the current workers, read on each scrape
+        active_streams: Returns the requests being relayed by backend URL
+
+
+    """
+    def __init__(self, workers: Callable[[], Iterable], active_streams: Callable[[], dict]):
+        r = self.registry = MetricsRegistry()
+        self.workers = workers
+        self.requests = r.counter("llama_proxy_requests_total",
+                                  "Proxied requests by backend and status", ["backend", "status"])
+        self.upstream_latency = r.histogram(
+            "llama_proxy_upstream_latency_seconds",
+            "Seconds until a backend responded with its status and headers", ["backend"])
+        self.starts = r.counter("llama_worker_starts_total",
+                                "Workers started, by loads and switches too", ["model"])
+        self.restarts = r.counter("llama_worker_restarts_total",
+                                  "Workers started for a model whose worker had failed",
+                                  ["model"])
+        self.abandoned = r.counter("llama_proxy_abandoned_streams_total",
+                                   "Streams abandoned by clients")
+        # Without labels it is exported before the first abandoned stream
+        self.abandoned.inc(0)
+        # By model, the live workers and the failed ones not restarted yet
+        self.started: dict[str, list] = {}
+        r.gauge("llama_proxy_active_streams", "Requests being relayed to each backend",
+                ["backend"], fn=lambda: {(url,): n for url, n in active_streams().items()})
+        r.gauge("llama_worker_held_requests", "Requests waiting for a worker to be ready",
+                ["backend"], fn=lambda: {(w.url,): w.held for w in self.workers()})
+        r.gauge("llama_worker_up", "Whether the worker is ready", ["backend", "model"],
+                fn=lambda: {(w.url, w.config["model_path"]): int(w.state == "ready")
+                            for w in self.workers()})
+
+    def worker_started(self, worker):
+        """Count the start of :code:`worker`, as a restart if it replaces a failed one"""
+        model = worker.config["model_path"]
+        self.starts.inc(model=model)
+        workers = self.started.setdefault(model, [])
+        if failed := next((w for w in workers if w.failed_at is not None), None):
+            workers.remove(failed)
+            self.restarts.inc(model=model)
+        # Workers stopped on purpose, e.g. after a switch, are not restarted
+        workers[:] = [w for w in workers if w.state != "stopped" or w.failed_at is not None]
+        workers.append(worker)
+
+    def response_observer(self, backend: str) -> Callable[[int, float], None]:
+        """Callback for :func:`relay` recording responses of :code:`backend`"""
+        def observe(status: int, seconds: float):
+            self.requests.inc(backend=backend, status=status)
+            self.upstream_latency.observe(seconds, backend=backend)
+        return observe
@@ -0,0 +1,281 @@
+from typing import Optional, Any
+from pathlib import Path
+import copy
+import logging
+import shutil
+import subprocess
+
+from .gguf import read_header, GGUFHeader
+from .worker import is_gemma
+
+
+logger = logging.getLogger(__name__)
+
+
+# Bytes per element of the KV cache types, see --cache-type-k
+CACHE_TYPE_BYTES = {"f32": 4.0, "f16": 2.0, "bf16": 2.0, "q8_0": 34 / 32, "q4_0": 18 / 32,
+                    "q4_1": 20 / 32, "iq4_nl": 18 / 32, "q5_0": 22 / 32, "q5_1": 24 / 32}
+
+# Context size llama.cpp uses if none is given
+DEFAULT_CTX_SIZE = 4096
+
+
+class PlanError(Exception):
+    pass
+
+
+class Estimate:
+    """Memory a model takes with its KV cache, by where it can be placed.
+
+    llama.cpp offloads the last :code:`n_gpu_layers` layers, and the output
+    layer too if it is larger than the number of layers. The token embeddings
+    stay in CPU memory. The compute buffers and the multimodal projector go to
+    the GPU if anything is offloaded.
+
+    Args:
+        layers: Bytes of the weights and KV cache of each layer
+        input_bytes: Bytes of the weights before the first layer
+        output_bytes: Bytes of the weights after the last layer
+        offload_bytes: Bytes of compute buffers and projector
+        n_ctx: Context size the KV cache is for
+        kv_bytes: Bytes of the KV cache
+
+
+    """
+    def __init__(self, layers: list[int], input_bytes: int, output_bytes: int,
+                 offload_bytes: int, n_ctx: int, kv_bytes: int):
+        self.layers = layers
+        self.input_bytes = input_bytes
+        self.output_bytes = output_bytes
+        self.offload_bytes = offload_bytes
+        self.n_ctx = n_ctx
+        self.kv_bytes = kv_bytes
+
+    @property
+    def n_layers(self) -> int:
+        return len(self.layers)
+
+    @property
+    def total(self) -> int:
+        return sum(self.layers) + self.input_bytes + self.output_bytes + self.offload_bytes
+
+    def split(self, n_gpu_layers: int) -> tuple[int, int]:
+        """Bytes on the GPU and in CPU memory with :code:`n_gpu_layers` offloaded"""
+        n = min(n_gpu_layers, self.n_layers + 1)
+        gpu = sum(self.layers[self.n_layers - min(n, self.n_layers):]) if n else 0
+        if n > self.n_layers:
+            gpu += self.output_bytes
+        if n:
+            gpu += self.offload_bytes
+        return gpu, self.total - gpu
+
+    def max_layers(self, free: int) -> int:
+        """Most layers that can be offloaded to a GPU with :code:`free` bytes"""
+        n = self.n_layers + 1
+        while n and self.split(n)[0] > free:
+            n -= 1
+        return n
+
+    def stats(self) -> dict:
+        return {"n_layers": self.n_layers, "n_ctx": self.n_ctx, "total": self.total,
+                "kv_bytes": self.kv_bytes, "weight_bytes": self.total - self.kv_bytes -
+                self.offload_bytes}
+
+
+def context_size(overrides: dict, context_length: Optional[int]) -> int:
+    """Context size a worker with :code:`overrides` is started with"""
+    n_ctx = overrides.get("ctx_size", overrides.get("n_ctx", DEFAULT_CTX_SIZE))
+    if not n_ctx:
+        return context_length or DEFAULT_CTX_SIZE
+    return int(n_ctx)
+
+
+def estimate(header: GGUFHeader, overrides: Optional[dict] = None,
+             mmproj: Optional[GGUFHeader] = None) -> Estimate:
+    """Estimate the memory a model needs, from its GGUF header.
+
+    The weights are the sizes of its tensors. The KV cache is for the
+    context size and cache types in :code:`overrides` (:code:`ctx_size` or
+    :code:`n_ctx`, :code:`cache_type_k`, :code:`cache_type_v`). The compute
+    buffers are estimated from the logits of a batch of :code:`ubatch_size`.
+
+    Args:
+        header: Header of the model
+        overrides: Overrides the worker is started with
+        mmproj: Optional header of the multimodal projector
+
+
+    """
+    overrides = overrides or {}
+    n_ctx = context_size(overrides, header.context_length)
+    k_bytes = CACHE_TYPE_BYTES.get(overrides.get("cache_type_k", "f16"), 2.0)
+    v_bytes = CACHE_TYPE_BYTES.get(overrides.get("cache_type_v", "f16"), 2.0)
+    per_head = header.key_length * k_bytes + header.value_length * v_bytes
+    kv = [int(n_ctx * n_head_kv * per_head) for n_head_kv in header.head_counts()]
+    layers = [w + k for w, k in zip(header.layer_bytes(), kv)]
+    input_bytes = sum(t.nbytes for t in header.tensors if t.name.startswith("token_embd"))
+    output_bytes = header.weight_bytes - sum(header.layer_bytes()) - input_bytes
+    n_batch = int(overrides.get("ubatch_size", 512))
+    compute = n_batch * (header.n_vocab + 4 * header.n_embd) * 4
+    if mmproj is not None:
+        compute += mmproj.weight_bytes
+    return Estimate(layers, input_bytes, output_bytes, compute, n_ctx, sum(kv))
+
+
+def estimate_model(config: dict) -> Estimate:
+    """:func:`estimate` for the model of a worker :code:`config`"""
+    root = Path(config["model_root"])
+    mmproj = None
+    if is_gemma(config) and config.get("mmproj_path"):
+        if (mmproj_path := root.joinpath(config["mmproj_path"])).exists():
+            mmproj = read_header(mmproj_path)
+    return estimate(read_header(root.joinpath(config["model_path"])),
+                    config.get("overrides"), mmproj)
+
+
+class Device:
+    """A GPU, or the CPU memory if :code:`id` is None, with its free memory"""
+    def __init__(self, id: Optional[int], free: int, total: Optional[int] = None,
+                 name: str = ""):
+        self.id = id
+        self.free = free
+        self.total = total
+        self.name = name or ("cpu" if id is None else f"CUDA{id}")
+
+    def __repr__(self):
+        return f"Device({self.name}, free={self.free})"
+
+
+def detect_devices() -> list[Device]:
+    """The GPUs reported by :code:`nvidia-smi` and the available CPU memory"""
+    devices = []
+    if shutil.which("nvidia-smi"):
+        try:
+            out = subprocess.run(["nvidia-smi", "--query-gpu=index,name,memory.total,memory.free",
+                                  "--format=csv,noheader,nounits"],
+                                 capture_output=True, text=True, timeout=10).stdout
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning(f"Could not query GPUs: {e}")
+            out = ""
+        for line in out.splitlines():
+            index, name, total, free = [x.strip() for x in line.split(",")]
+            devices.append(Device(int(index), int(free) << 20, int(total) << 20, name))
+    with open("/proc/meminfo") as f:
+        meminfo = dict(line.split(":", 1) for line in f)
+    available = int(meminfo["MemAvailable"].split()[0]) << 10
+    devices.append(Device(None, available, int(meminfo["MemTotal"].split()[0]) << 10))
+    return devices
+
+
+class Placement:
+    """Where a model runs, and how much memory it takes there"""
+    def __init__(self, key: Any, device: Optional[int], n_gpu_layers: int, gpu_bytes: int,
+                 cpu_bytes: int, estimate: Estimate):
+        self.key = key
+        self.device = device
+        self.n_gpu_layers = n_gpu_layers
+        self.gpu_bytes = gpu_bytes
+        self.cpu_bytes = cpu_bytes
+        self.estimate = estimate
+
+    def stats(self) -> dict:
+        return {"device": self.device, "n_gpu_layers": self.n_gpu_layers,
+                "gpu_bytes": self.gpu_bytes, "cpu_bytes": self.cpu_bytes,
+                "estimate": self.estimate.stats()}
+
+
+def plan(models: list[tuple[Any, Estimate, Optional[int]]], devices: list[Device],
+         reserve: int = 512 << 20) -> dict[Any, Placement]:
+    """Place models on devices so that they fit in memory together.
+
+    The largest model is placed first. A model goes whole onto the GPU with
+    the least free memory that holds it. If no GPU does, as many layers as
+    fit go onto the GPU with the most free memory and the rest into CPU
+    memory. Without GPUs models go into CPU memory, even those with a fixed
+    :code:`n_gpu_layers`.
+
+    Args:
+        models: (key, estimate, fixed :code:`n_gpu_layers` or None) of each model
+        devices: Devices with their free memory, see :func:`detect_devices`.
+                 Without a CPU device, CPU memory is not checked.
+        reserve: Bytes to leave free on each device
+
+
+    Raises:
+        PlanError: If the models do not fit, or a fixed number of layers fits
+                   on no GPU
+
+    """
+    gpus = [d for d in devices if d.id is not None]
+    cpu = next((d for d in devices if d.id is None), None)
+    free = {id(d): d.free - reserve for d in devices}
+    placements = {}
+    for key, est, fixed in sorted(models, key=lambda m: -m[1].total):
+        if fixed and not gpus:
+            logger.warning(f"No GPUs, running {key} on the CPU instead of offloading "
+                           f"{fixed} layers")
+            fixed = 0
+        full = est.n_layers + 1 if fixed is None else fixed
+        gpu = None
+        if fitting := [g for g in gpus if est.split(full)[0] <= free[id(g)]]:
+            gpu = min(fitting, key=lambda g: free[id(g)])
+            n = full
+        elif gpus and fixed is None:
+            gpu = max(gpus, key=lambda g: free[id(g)])
+            n = est.max_layers(free[id(gpu)])
+        if gpu is None or n == 0:
+            if fixed:
+                raise PlanError(f"{fixed} layers of {key} fit on no GPU")
+            gpu, n = None, 0
+        gpu_bytes, cpu_bytes = est.split(n)
+        if cpu is not None and cpu_bytes > free[id(cpu)]:
+            raise PlanError(f"{key} needs {cpu_bytes} bytes of CPU memory, "
+                            f"{max(free[id(cpu)], 0)} are free")
+        if gpu is not None:
+            free[id(gpu)] -= gpu_bytes
+        if cpu is not None:
+            free[id(cpu)] -= cpu_bytes
+        placements[key] = Placement(key, gpu.id if gpu is not None else None, n,
+                                    gpu_bytes, cpu_bytes, est)
+    return placements
+
+
+def plan_config(config: dict, devices: Optional[list[Device]] = None,
+                reserve: int = 512 << 20) -> dict[int, dict]:
+    """Per worker configs for the :code:`models` in a manager config, placed by :func:`plan`.
+
+    Each model in :code:`models` is a model config, with the missing keys
+    taken from :code:`default`, and :code:`replicas` for the number of
+    workers to run it in. Each worker config gets the :code:`gpu_id` it is
+    placed on, None for the CPU, and :code:`n_gpu_layers` in its overrides.
+
+    Args:
+        config: Manager config
+        devices: Devices to place on, by default :func:`detect_devices`
+        reserve: Bytes to leave free on each device
+
+
+    """
+    defaults = config.get("default", {})
+    workers = []
+    for model in config["models"]:
+        model_config = {**copy.deepcopy(defaults), **copy.deepcopy(model)}
+        model_config["overrides"] = {**defaults.get("overrides", {}),
+                                     **model.get("overrides", {})}
+        est = estimate_model(model_config)
+        for _ in range(model_config.pop("replicas", 1)):
+            workers.append((copy.deepcopy(model_config), est))
+    devices = detect_devices() if devices is None else devices
+    placements = plan([(i, est, w["overrides"].get("n_gpu_layers"))
+                       for i, (w, est) in enumerate(workers)], devices, reserve)
+    planned = {}
+    for i, (model_config, _) in enumerate(workers):
+        placement = placements[i]
+        model_config["gpu_id"] = placement.device
+        model_config["overrides"]["n_gpu_layers"] = placement.n_gpu_layers
+        model_config["placement"] = placement.stats()
+        logger.info(f"Placing {model_config['model_path']} on "
+                    f"{'CPU' if placement.device is None else f'GPU {placement.device}'} "
+                    f"with {placement.n_gpu_layers} layers offloaded")
+        planned[i] = model_config
+    return planned
@@ -0,0 +1,267 @@
+from typing import Optional, Callable
+from collections import OrderedDict, deque
+from pathlib import Path
+import asyncio
+import logging
+import os
+import time
+
+from .upstream import UpstreamPool
+from .worker import Worker, WorkerUnavailable, is_gemma
+from .gguf import GGUFError
+from .planner import estimate_model
+
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_bytes(config: dict) -> int:
+    """Memory a worker for :code:`config` takes.
+
+    Estimated from the GGUF header of the model with its KV cache, see
+    :func:`estimate_model`. If the header cannot be read, the size of the
+    model file and of the multimodal projector for the gemma worker. Files
+    that are missing count as 0.
+
+    Args:
+        config: Model config
+
+
+    """
+    try:
+        return estimate_model(config).total
+    except (GGUFError, OSError):
+        pass
+    paths = [Path(config["model_root"]).joinpath(config["model_path"])]
+    if is_gemma(config) and config.get("mmproj_path"):
+        paths.append(Path(config["model_root"]).joinpath(config["mmproj_path"]))
+    return sum(os.path.getsize(p) for p in paths if p.exists())
+
+
+class ModelPool:
+    """Workers for several models kept loaded at once, within a memory budget.
+
+    A request for a resident model goes to its worker straight away. A model
+    that is not resident is loaded in a new worker, after evicting the least
+    recently used models until it fits in :code:`budget` bytes and a port is
+    free. Idle models are evicted before ones with requests in flight, which
+    are drained first. The new model is started once the models evicted for
+    it have stopped, which holds up neither other loads nor requests to the
+    other models. Models in :code:`pinned`, like the default one, are never
+    evicted.
+
+    Loads and evictions are kept in :code:`events`, and the time each model
+    has been resident in :meth:`stats`.
+
+    Args:
+        budget: Bytes of memory the resident models may take, see :func:`estimate_bytes`
+        ports: Ports for the workers, one per resident model
+        python: Python to run the gemma worker with
+        upstreams: Clients for the workers
+        watch: Called with each started worker to monitor its health
+        drain_timeout: Maximum seconds to wait for the requests of an evicted model
+        max_events: Number of load and eviction events to keep
+
+
+    """
+    def __init__(self, budget: int, ports: list[int], python: str, upstreams: UpstreamPool,
+                 watch: Callable[[Worker], None], drain_timeout: float = 600.0,
+                 max_events: int = 256):
+        self.budget = budget
+        self.ports = ports
+        self.python = python
+        self.upstreams = upstreams
+        self.watch = watch
+        self.drain_timeout = drain_timeout
+        # By model path, least recently used first
+        self.workers: OrderedDict[str, Worker] = OrderedDict()
+        self.sizes: dict[str, int] = {}
+        self.last_used: dict[str, float] = {}
+        self.residency: dict[str, float] = {}
+        self.pinned: set[str] = set()
+        self.events: deque[dict] = deque(maxlen=max_events)
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        # By port, tasks stopping evicted workers
+        self.retiring: dict[int, asyncio.Task] = {}
+
+    @property
+    def used(self) -> int:
+        return sum(self.sizes.values())
+
+    def fits(self, size: int) -> bool:
+        return self.used + size <= self.budget and len(self.workers) < len(self.ports)
+
+    def record(self, event: str, model_path: str, **details):
+        logger.info(f"Model pool: {event} {model_path} {details}")
+        self.events.append({"event": event, "model_path": model_path, "time": time.time(),
+                            **details})
+
+    def reserve(self, config: dict) -> Worker:
+        """Add a worker for :code:`config` on a free port, to be started by the caller
+
+        The evicted worker on the port may still be stopping, see :code:`retiring`.
+        """
+        path = config["model_path"]
+        busy = {w.port for w in self.workers.values()}
+        port = next(p for p in self.ports if p not in busy)
+        worker = Worker(config, port, self.python)
+        # Requests for the model are held until it is loaded
+        worker.set_state("starting")
+        self.workers[path] = worker
+        self.sizes[path] = estimate_bytes(config)
+        self.last_used[path] = time.time()
+        self.loads += 1
+        self.record("load", path, port=port, bytes=self.sizes[path])
+        return worker
+
+    def start(self, config: dict) -> Worker:
+        """Start a worker for :code:`config` on a free port, without making room for it"""
+        worker = self.reserve(config)
+        worker.start()
+        return worker
+
+    def use(self, model_path: str) -> Optional[Worker]:
+        """The worker for :code:`model_path` if it is resident, marked as most recently used"""
+        if (worker := self.workers.get(model_path)) is not None:
+            self.workers.move_to_end(model_path)
+            self.last_used[model_path] = time.time()
+            self.hits += 1
+        return worker
+
+    async def get(self, config: dict) -> Worker:
+        """The worker for the model of :code:`config`, loading it if it is not resident.
+
+        The request is counted in flight on the worker, so that it is not
+        evicted before the request is relayed, and must be released with
+        :meth:`Worker.release`. The worker may still be loading the model, see
+        :meth:`Worker.hold`.
+
+        Args:
+            config: Model config
+
+
+        Raises:
+            WorkerUnavailable: If the model does not fit even after evicting
+                               all the models that are not pinned
+
+        """
+        path = config["model_path"]
+        if (worker := self.use(path)) is not None:
+            worker.acquire()
+            return worker
+        # Nothing awaits until the worker is in the pool, so that no other
+        # request loads the model too or takes the room made for it. Resident
+        # models are used and others loaded while the evicted ones drain
+        size = estimate_bytes(config)
+        if size > self.budget:
+            raise WorkerUnavailable(f"{path} needs {size} bytes, more than the pool's "
+                                    f"budget of {self.budget}", retry_after=3600)
+        stopping = self.make_room(size)
+        worker = self.reserve(config)
+        worker.acquire()
+        if (task := self.retiring.get(worker.port)) is not None:
+            stopping.append(task)
+        try:
+            # Started even if the request goes away, others may wait for the model
+            await asyncio.shield(self.launch(worker, stopping))
+        except BaseException:
+            worker.release()
+            raise
+        return worker
+
+    async def launch(self, worker: Worker, stopping: list[asyncio.Task]):
+        """Start :code:`worker` once the evicted workers it replaces have stopped
+
+        If it was evicted in the meantime it is never started, and the requests
+        held for it fail at once.
+        """
+        if stopping:
+            await asyncio.gather(*set(stopping))
+        if self.workers.get(worker.config["model_path"]) is not worker:
+            worker.set_state("stopped")
+            return
+        worker.start()
+        self.watch(worker)
+
+    def make_room(self, size: int) -> list[asyncio.Task]:
+        """Evict models until :code:`size` more bytes fit, least recently used and idle first
+
+        Returns:
+            The tasks stopping the evicted models
+
+
+        """
+        stopping = []
+        while not self.fits(size):
+            candidates = [w for path, w in self.workers.items() if path not in self.pinned]
+            if not candidates:
+                raise WorkerUnavailable(f"No room in the pool for {size} more bytes")
+            stopping.append(self.remove(next(
+                (w for w in candidates if not w.in_flight and not w.held), candidates[0])))
+        return stopping
+
+    def remove(self, worker: Worker) -> Optional[asyncio.Task]:
+        """Remove :code:`worker` from the pool. Returns the task stopping it, see :meth:`retire`"""
+        path = worker.config["model_path"]
+        if self.workers.get(path) is not worker:
+            return None
+        del self.workers[path]
+        size = self.sizes.pop(path)
+        resident = time.time() - (worker.started_at or time.time())
+        self.residency[path] = self.residency.get(path, 0.0) + resident
+        self.evictions += 1
+        self.record("evict", path, port=worker.port, bytes=size, resident_seconds=resident)
+        task = asyncio.create_task(self.retire(worker, self.retiring.get(worker.port)))
+        self.retiring[worker.port] = task
+
+        def retired(_):
+            if self.retiring.get(worker.port) is task:
+                del self.retiring[worker.port]
+        task.add_done_callback(retired)
+        return task
+
+    async def retire(self, worker: Worker, previous: Optional[asyncio.Task] = None):
+        """Stop an evicted :code:`worker` once its requests have finished
+
+        Args:
+            worker: The evicted worker
+            previous: Task stopping the previous worker on the same port
+
+
+        """
+        if previous is not None:
+            await previous
+        path = worker.config["model_path"]
+        if not await worker.drain(self.drain_timeout):
+            logger.warning(f"Evicting {path} with {worker.in_flight} requests in flight")
+        await worker.astop()
+        await self.upstreams.close(worker.url)
+
+    async def evict(self, worker: Worker):
+        """Remove :code:`worker` from the pool and stop it once its requests have finished"""
+        if (task := self.remove(worker)) is not None:
+            await task
+
+    def stats(self) -> dict:
+        now = time.time()
+        models = []
+        for path, worker in reversed(self.workers.items()):
+            resident = now - (worker.started_at or now)
+            models.append({**worker.stats(),
+                           "bytes": self.sizes[path],
+                           "pinned": path in self.pinned,
+                           "last_used": self.last_used.get(path),
+                           "resident_seconds": resident,
+                           "total_resident_seconds": self.residency.get(path, 0.0) + resident})
+        evicted = {path: seconds for path, seconds in self.residency.items()
+                   if path not in self.workers}
+        return {"budget": self.budget,
+                "used": self.used,
+                "models": models,
+                "evicted_resident_seconds": evicted,
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "events": list(self.events)}
@@ -0,0 +1,226 @@
+from typing import Optional
+from pathlib import Path
+import asyncio
+import json
+import logging
+import os
+import re
+
+from .gguf import read_header, GGUFError
+
+
+logger = logging.getLogger(__name__)
+
+
+# Tokens of mmproj file names that say nothing about the model they belong to
+MMPROJ_NOISE = {"mmproj", "model", "f16", "f32", "bf16", "q8", "0", "gguf"}
+
+# Tokens of the number of parameters, like "12b" or "270m"
+SIZE_TOKEN = re.compile(r"\d+[bm]")
+
+
+def name_tokens(name: str) -> list[str]:
+    return [t for t in re.split(r"[^a-z0-9]+", name.lower()) if t]
+
+
+def matches_tokens(query: list[str], name: list[str]) -> bool:
+    """Whether each of the :code:`query` tokens is one of the :code:`name` tokens
+
+    Tokens with digits, like sizes, must be equal, words may start a token.
+    """
+    return all(any(n.startswith(t) for n in name) if t.isalpha() else t in name
+               for t in query)
+
+
+class ModelEntry:
+    """A GGUF file in the model root, with its header metadata once parsed.
+
+    Args:
+        name: File name
+        size: File size
+        mtime_ns: Modification time of the file
+
+
+    """
+    def __init__(self, name: str, size: int, mtime_ns: int):
+        self.name = name
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.metadata: Optional[dict] = None
+        self.error: Optional[str] = None
+        self.mmproj: Optional[str] = None
+
+    @property
+    def is_mmproj(self) -> bool:
+        return "mmproj" in self.name.lower()
+
+    @property
+    def stem(self) -> str:
+        return Path(self.name).stem
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "size": self.size, "mtime_ns": self.mtime_ns,
+                "metadata": self.metadata, "error": self.error, "mmproj": self.mmproj}
+
+
+class ModelRegistry:
+    """Index of the GGUF models in :code:`model_root`.
+
+    :meth:`scan` lists the files and is cheap. The headers of new or changed
+    files are parsed by :meth:`parse_pending`, and kept in memory and in
+    :code:`cache_path` if given, so that they are not parsed again after a
+    restart. :meth:`watch` keeps the index up to date, with
+    :code:`watchfiles` if it is installed, and by polling every
+    :code:`poll_interval` seconds otherwise.
+
+    Args:
+        model_root: Directory of the models
+        cache_path: Optional JSON file to keep the parsed metadata in
+        poll_interval: Seconds between scans without :code:`watchfiles`
+
+
+    """
+    def __init__(self, model_root: str, cache_path: Optional[str] = None,
+                 poll_interval: float = 5.0):
+        self.model_root = model_root
+        self.cache_path = cache_path
+        self.poll_interval = poll_interval
+        self.entries: dict[str, ModelEntry] = {}
+        self.scans = 0
+        self.parsed = 0
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path) as f:
+                    for d in json.load(f):
+                        entry = self.entries[d["name"]] = ModelEntry(
+                            d["name"], d["size"], d["mtime_ns"])
+                        entry.metadata, entry.error = d["metadata"], d["error"]
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Ignoring model index {cache_path}: {e}")
+                self.entries = {}
+
+    def scan(self) -> bool:
+        """Update the index with the files in :code:`model_root`. Returns whether it changed"""
+        entries = {}
+        try:
+            files = [f for f in os.scandir(self.model_root)
+                     if f.name.endswith(".gguf") and f.is_file()]
+        except FileNotFoundError:
+            files = []
+        for f in files:
+            stat = f.stat()
+            entry = self.entries.get(f.name)
+            if entry is None or (entry.size, entry.mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                entry = ModelEntry(f.name, stat.st_size, stat.st_mtime_ns)
+            entries[f.name] = entry
+        changed = entries.keys() != self.entries.keys() or any(
+            entries[k] is not self.entries[k] for k in entries)
+        if changed or not self.scans:
+            self.pair_mmprojs(entries)
+            # Swapped whole, so that lookups never see it half updated
+            self.entries = entries
+        self.scans += 1
+        return changed
+
+    @staticmethod
+    def pair_mmprojs(entries: dict[str, ModelEntry]):
+        """Pair each model with the mmproj file whose name shares most with its name.
+
+        Files of models of different sizes, like "4b" and "12b", are not
+        paired. An only mmproj file that shares nothing with any model is
+        paired with the gemma 3 models.
+        """
+        mmprojs = [e for e in entries.values() if e.is_mmproj]
+        for entry in entries.values():
+            if entry.is_mmproj:
+                continue
+            tokens = set(name_tokens(entry.stem))
+            best, best_score = None, 0
+            for mmproj in mmprojs:
+                mmproj_tokens = set(name_tokens(mmproj.stem)) - MMPROJ_NOISE
+                model_sizes = {t for t in tokens if SIZE_TOKEN.fullmatch(t)}
+                mmproj_sizes = {t for t in mmproj_tokens if SIZE_TOKEN.fullmatch(t)}
+                if model_sizes and mmproj_sizes and model_sizes != mmproj_sizes:
+                    continue
+                score = len(tokens & mmproj_tokens)
+                if score > best_score:
+                    best, best_score = mmproj, score
+            if best is None and len(mmprojs) == 1 and "gemma-3" in entry.name.lower():
+                best = mmprojs[0]
+            entry.mmproj = best.name if best is not None else None
+
+    def parse_pending(self) -> int:
+        """Parse the headers of the files not parsed yet. Returns how many were parsed"""
+        n = 0
+        for entry in list(self.entries.values()):
+            if entry.metadata is not None or entry.error is not None:
+                continue
+            try:
+                entry.metadata = read_header(os.path.join(self.model_root, entry.name)).summary()
+            except (GGUFError, OSError) as e:
+                entry.error = str(e)
+            n += 1
+        self.parsed += n
+        return n
+
+    def save(self):
+        if not self.cache_path:
+            return
+        tmp = f"{self.cache_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump([e.to_dict() for e in self.entries.values()], f)
+        os.replace(tmp, self.cache_path)
+
+    def refresh(self):
+        """:meth:`scan`, then :meth:`parse_pending` and :meth:`save` if anything changed"""
+        changed = self.scan()
+        if self.parse_pending() or changed:
+            self.save()
+
+    async def watch(self):
+        """Keep the index up to date until cancelled"""
+        await asyncio.to_thread(self.refresh)
+        try:
+            from watchfiles import awatch
+        except ImportError:
+            awatch = None
+        if awatch is not None and os.path.isdir(self.model_root):
+            async for _ in awatch(self.model_root):
+                await asyncio.to_thread(self.refresh)
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await asyncio.to_thread(self.refresh)
+
+    def names(self) -> list[str]:
+        """File names of the models, without the mmproj files"""
+        return sorted(name for name, e in self.entries.items() if not e.is_mmproj)
+
+    def find(self, query: str) -> Optional[ModelEntry]:
+        """The model named :code:`query`.
+
+        Matches the file name, then the name without extension case
+        insensitively, then the shortest name with all the words and numbers
+        in :code:`query` among its own, e.g. "gemma 12b" matches
+        "gemma-3-12b-it-Q4_K_M.gguf". Numbers and sizes like "12b" must match
+        whole, so that "2b" does not match "12b", words may be the start of
+        a word, so that "qwen" matches "qwen3-8b.gguf".
+
+        Args:
+            query: Name of the model as requested
+
+
+        """
+        entries = [e for e in self.entries.values() if not e.is_mmproj]
+        if (entry := self.entries.get(query)) is not None and not entry.is_mmproj:
+            return entry
+        stem = Path(query).stem.lower() if query.lower().endswith(".gguf") else query.lower()
+        for entry in entries:
+            if entry.stem.lower() == stem:
+                return entry
+        if not (tokens := name_tokens(stem)):
+            return None
+        matches = [e for e in entries if matches_tokens(tokens, name_tokens(e.name))]
+        return min(matches, key=lambda e: (len(e.name), e.name), default=None)
+
+    def list(self) -> list[dict]:
+        return [self.entries[name].to_dict() for name in self.names()]
@@ -0,0 +1,197 @@
+from typing import Optional, Any
+from pathlib import Path
+import hashlib
+import time
+
+
+class Replica:
+    """A worker serving a model, with the requests it is handling.
+
+    A replica that failed a request is unhealthy for :code:`retry_after`
+    seconds, after which it gets requests again. A replica that is not
+    :code:`ready`, e.g. still loading its model, is unhealthy until it is.
+
+    Args:
+        replica_id: Id of the replica, e.g. its GPU
+        url: Base URL of the worker
+        model: Logical model name
+
+
+    """
+    retry_after = 5.0
+
+    def __init__(self, replica_id: Any, url: str, model: str):
+        self.id = replica_id
+        self.url = url
+        self.model = model
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.failed_at: Optional[float] = None
+        self.ready = True
+
+    @property
+    def healthy(self) -> bool:
+        if not self.ready:
+            return False
+        return self.failed_at is None or time.monotonic() - self.failed_at >= self.retry_after
+
+    def stats(self) -> dict:
+        return {"id": self.id,
+                "url": self.url,
+                "model": self.model,
+                "in_flight": self.in_flight,
+                "requests": self.requests,
+                "errors": self.errors,
+                "ready": self.ready,
+                "healthy": self.healthy}
+
+
+def model_name(model_config: dict) -> str:
+    """Logical name of the model of :code:`model_config`
+
+    The :code:`name` in the config if given, otherwise the file name of the
+    model without its extension.
+
+    Args:
+        model_config: Config of a worker
+
+
+    """
+    return model_config.get("name") or Path(model_config["model_path"]).stem
+
+
+class Router:
+    """Route requests for a model to the least loaded of its replicas.
+
+    Replicas serving the same model form a replica set. Each request goes to the
+    healthy replica in the set with the fewest requests in flight, ties broken
+    by the fewest requests so far.
+
+    Requests with an affinity key, like a conversation id, go to the same
+    replica as long as it is healthy, so that it can reuse its KV cache. The
+    replicas are ranked for each key by rendezvous hashing, so adding or
+    removing a replica only moves the keys ranked first on it. If the first
+    one is down or has more than :code:`affinity_slack` requests in flight
+    above the least loaded one, the next one in the ranking is used.
+
+    Args:
+        default_model: Model for requests that name none, or the only model if
+                       there is just one
+        affinity_slack: Extra requests in flight a replica may have and still
+                        get the requests with affinity to it
+
+
+    """
+    def __init__(self, default_model: Optional[str] = None, affinity_slack: int = 2):
+        self.default_model = default_model
+        self.affinity_slack = affinity_slack
+        self.replicas: dict[Any, Replica] = {}
+        self.affinity_requests = 0
+        self.affinity_hits = 0
+
+    def add(self, replica_id: Any, url: str, model: str) -> Replica:
+        """Add or replace the replica :code:`replica_id`"""
+        replica = self.replicas[replica_id] = Replica(replica_id, url, model)
+        return replica
+
+    def remove(self, replica_id: Any):
+        self.replicas.pop(replica_id, None)
+
+    def models(self) -> dict[str, list[Replica]]:
+        """Replica sets by model name"""
+        models: dict[str, list[Replica]] = {}
+        for replica in self.replicas.values():
+            models.setdefault(replica.model, []).append(replica)
+        return models
+
+    def resolve(self, model: Optional[str]) -> list[Replica]:
+        """The replica set for :code:`model`.
+
+        Matches the name exactly, then the name without a path or extension,
+        then any name containing it case insensitively.
+
+        Args:
+            model: Model name as requested
+
+
+        Raises:
+            KeyError: If no replica serves :code:`model`
+
+        """
+        models = self.models()
+        if not model:
+            if self.default_model in models:
+                return models[self.default_model]
+            if len(models) == 1:
+                return next(iter(models.values()))
+            raise KeyError("No model given and no default model")
+        if model in models:
+            return models[model]
+        stem = Path(model).stem.lower()
+        for name, replicas in models.items():
+            if name.lower() == stem:
+                return replicas
+        matches = [r for name, replicas in models.items() if stem in name.lower()
+                   for r in replicas]
+        if not matches:
+            raise KeyError(f"No replica serves model {model}")
+        return matches
+
+    def pick(self, candidates: list[Replica]) -> Replica:
+        """Least loaded of :code:`candidates`, preferring healthy ones"""
+        healthy = [r for r in candidates if r.healthy] or candidates
+        return min(healthy, key=lambda r: (r.in_flight, r.requests))
+
+    @staticmethod
+    def rank(key: str, candidates: list[Replica]) -> list[Replica]:
+        """Rendezvous order of :code:`candidates` for :code:`key`"""
+        def weight(replica: Replica) -> bytes:
+            return hashlib.blake2b(f"{key}\0{replica.id}".encode(), digest_size=8).digest()
+        return sorted(candidates, key=weight, reverse=True)
+
+    def pick_affine(self, key: str, candidates: list[Replica]) -> Replica:
+        """Replica for affinity :code:`key`, see :class:`Router`"""
+        ranked = self.rank(key, candidates)
+        healthy = [r for r in ranked if r.healthy] or ranked
+        limit = min(r.in_flight for r in healthy) + self.affinity_slack
+        replica = next(r for r in healthy if r.in_flight <= limit)
+        self.affinity_requests += 1
+        if replica is ranked[0]:
+            self.affinity_hits += 1
+        return replica
+
+    def acquire(self, replica: Replica) -> Replica:
+        replica.in_flight += 1
+        replica.requests += 1
+        return replica
+
+    def release(self, replica: Replica, error: bool = False):
+        replica.in_flight -= 1
+        if error:
+            replica.errors += 1
+        replica.failed_at = time.monotonic() if error else None
+
+    def route(self, model: Optional[str], affinity_key: Optional[str] = None) -> Replica:
+        """Pick and acquire a replica for :code:`model`, see :meth:`resolve`
+
+        Args:
+            model: Model name as requested
+            affinity_key: Optional key of requests that should go to the same replica
+
+
+        """
+        candidates = self.resolve(model)
+        if affinity_key:
+            return self.acquire(self.pick_affine(affinity_key, candidates))
+        return self.acquire(self.pick(candidates))
+
+    def stats(self) -> dict:
+        return {"replicas": [r.stats() for r in self.replicas.values()],
+                "models": {name: [r.id for r in replicas]
+                           for name, replicas in self.models().items()},
+                "affinity": {"requests": self.affinity_requests,
+                             "hits": self.affinity_hits,
+                             "fallbacks": self.affinity_requests - self.affinity_hits,
+                             "hit_rate": (self.affinity_hits / self.affinity_requests
+                                          if self.affinity_requests else None)}}
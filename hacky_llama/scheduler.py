@@ -0,0 +1,209 @@
+from typing import Any, Awaitable, Optional
+from contextlib import asynccontextmanager
+import asyncio
+import collections
+import math
+import time
+
+
+class SchedulerError(Exception):
+    """Raised when a request cannot be admitted.
+
+    Args:
+        message: Error message
+        retry_after: Suggested seconds before the client retries
+
+
+    """
+    status_code = 503
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueFullError(SchedulerError):
+    status_code = 429
+
+
+class QueueTimeoutError(SchedulerError):
+    status_code = 503
+
+
+class UnavailableError(SchedulerError):
+    """The interface will never be available, e.g. as the model failed to load"""
+    status_code = 503
+
+
+class RequestScheduler:
+    """FIFO admission scheduler in front of a :class:`GemmaInterface`.
+
+    The C backend holds a single static context so only one request may use
+    the interface at a time. Other requests wait in a bounded FIFO queue and are
+    rejected when the queue is full or when they have waited too long.
+
+    Args:
+        iface: The interface owned by the scheduler
+        max_queue_depth: Maximum number of requests waiting for the interface
+        max_queue_wait: Maximum seconds a request may wait for its turn
+
+
+    """
+    def __init__(self, iface: Any, max_queue_depth: int = 16, max_queue_wait: float = 60.0):
+        self.iface = iface
+        self.max_queue_depth = max_queue_depth
+        self.max_queue_wait = max_queue_wait
+        self._waiters: collections.deque[asyncio.Future] = collections.deque()
+        self._busy = False
+        self._busy_since = 0.0
+        self.admitted = 0
+        self.completed = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.abandoned = 0
+        self._tasks: set[asyncio.Task] = set()
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+        self.total_wait = 0.0
+        self.total_service = 0.0
+        self.error: Optional[str] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def busy(self) -> bool:
+        return self._busy
+
+    def retry_after(self) -> int:
+        """Estimate in seconds until a new request could be served"""
+        mean_service = self.total_service / self.completed if self.completed else 1.0
+        return max(1, math.ceil(mean_service * (self.queue_depth + 1)))
+
+    def _grant(self, wait: float):
+        self._busy = True
+        self._busy_since = time.monotonic()
+        self.admitted += 1
+        self.last_wait = wait
+        self.max_wait = max(self.max_wait, wait)
+        self.total_wait += wait
+
+    def _discard(self, fut: asyncio.Future):
+        fut.cancel()
+        try:
+            self._waiters.remove(fut)
+        except ValueError:
+            pass
+
+    async def acquire(self):
+        """Wait for exclusive use of the interface and return it.
+
+        Raises :class:`QueueFullError` if the queue is at capacity,
+        :class:`QueueTimeoutError` if the wait exceeds :code:`max_queue_wait`
+        and :class:`UnavailableError` once the scheduler has :meth:`fail` ed.
+
+        """
+        if self.error is not None:
+            raise UnavailableError(self.error, 30)
+        start = time.monotonic()
+        if not self._busy and not self._waiters:
+            self._grant(0.0)
+            return self.iface
+        if len(self._waiters) >= self.max_queue_depth:
+            self.rejected_queue_full += 1
+            raise QueueFullError(f"Request queue is full ({self.max_queue_depth} waiting)",
+                                 self.retry_after())
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await asyncio.wait_for(fut, self.max_queue_wait)
+        except asyncio.TimeoutError:
+            self._discard(fut)
+            self.rejected_timeout += 1
+            raise QueueTimeoutError(f"Timed out after {self.max_queue_wait}s in request queue",
+                                    self.retry_after())
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # The slot was handed to us just as we were cancelled
+                self._grant(time.monotonic() - start)
+                self.release()
+            else:
+                self._discard(fut)
+            raise
+        self._grant(time.monotonic() - start)
+        return self.iface
+
+    def release(self):
+        """Release the interface and hand it to the next waiter, if any"""
+        if not self._busy:
+            return
+        self.completed += 1
+        self.total_service += time.monotonic() - self._busy_since
+        self._busy = False
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                # Stays busy, ownership passes directly to the waiter
+                self._busy = True
+                fut.set_result(None)
+                return
+
+    def fail(self, message: str):
+        """Reject the waiting requests and all later ones, e.g. if the model did not load"""
+        self.error = message
+        while self._waiters:
+            if not (fut := self._waiters.popleft()).done():
+                fut.set_exception(UnavailableError(message, 30))
+
+    def abandon(self, cleanup: Optional[Awaitable] = None):
+        """Count a request abandoned by its client and release the interface.
+
+        Args:
+            cleanup: Optional awaitable to run (e.g. :meth:`GemmaInterface.abort`)
+                     before the interface is handed to the next request
+
+
+        """
+        self.abandoned += 1
+        if cleanup is None:
+            self.release()
+            return
+
+        async def _cleanup():
+            try:
+                await cleanup
+            finally:
+                self.release()
+        task = asyncio.get_running_loop().create_task(_cleanup())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @asynccontextmanager
+    async def slot(self):
+        """Async context manager around :meth:`acquire` and :meth:`release`"""
+        iface = await self.acquire()
+        try:
+            yield iface
+        finally:
+            self.release()
+
+    def stats(self) -> dict[str, Any]:
+        mean_wait = self.total_wait / self.admitted if self.admitted else 0.0
+        return {
+            "busy": self._busy,
+            "error": self.error,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "max_queue_wait": self.max_queue_wait,
+            "admitted": self.admitted,
+            "completed": self.completed,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "abandoned": self.abandoned,
+            "wait_ms": {
+                "last": self.last_wait * 1000,
+                "mean": mean_wait * 1000,
+                "max": self.max_wait * 1000,
+            },
+        }
@@ -1,175 +1,310 @@
-import json
-import subprocess
+from typing import Optional, Any
+import asyncio
 import logging
 import copy
-from pathlib import Path
-from threading import Thread
-import re
-import glob
-
-import httpx
+import signal
+import time
 
 from starlette.applications import Starlette
 from starlette.requests import Request
-from starlette.responses import StreamingResponse, JSONResponse, Response
+from starlette.responses import JSONResponse
 from starlette.routing import Route
-from starlette.background import BackgroundTask
+
+from .upstream import UpstreamPool, GENERATION_ENDPOINTS, relay, peek_field
+from .worker import Worker, WorkerUnavailable, is_gemma
+from .routing import model_name
+from .pool import ModelPool
+from .metrics import ProxyMetrics
+from .tracing import Trace, make_exporter
+from .registry import ModelRegistry
+from .logs import log_response
 
 
 logger = logging.getLogger(__name__)
 
 
-async def stream_response(upstream_url: str, data):
-    async with httpx.AsyncClient() as client:
-        async with client.stream("POST", upstream_url, json=data, timeout=None) as response:
-            async for chunk in response.aiter_bytes():
-                yield chunk
+class ModelManager:
+    """Manage the worker serving the model and proxy requests to it.
 
+    A model switch starts the new worker on the other of two ports while the
+    current one keeps serving. Once the new worker has loaded the model and
+    generated a token it gets all new requests, and the old one is stopped
+    when its requests in flight have finished.
 
-class ModelManager:
+    Requests that arrive while the worker is still loading are held for up to
+    :code:`hold_timeout` seconds, at most :code:`max_held` of them.
+
+    With :code:`pool_bytes` in the config several models are kept loaded at
+    once in a :class:`ModelPool`, up to :code:`pool_max_models` of them.
+    Requests go to the model named by their :code:`x-model` header or
+    :code:`model` field, or to the current model if they name none. The body
+    is read ahead up to :code:`max_peek_bytes` for the field, requests whose
+    model is not found within them go to the current model. A switch to a
+    resident model is then immediate, and the previous model stays resident
+    until it is evicted.
+
+    Args:
+        config: Model config, with the manager settings
+
+
+    """
     def __init__(self, config):
         self._initial_config = config
         self.config = copy.deepcopy(self._initial_config)
         self.llama = None
-        self.process = None
-        self.service_port = 8001
-        self.service_url = f"http://localhost:{self.service_port}"
+        self.ports = config.get("worker_ports") or [8001, 8002]
         self.config = config
         self.python = config["python"]
+        self.abandoned_streams = 0
+        self.trace_exporter = make_exporter(config.get("trace_exporter"), "model_manager")
+        self.metrics = ProxyMetrics(self.all_workers,
+                                    lambda: {w.url: w.in_flight for w in self.all_workers()})
+        self.upstreams = UpstreamPool.from_config(config)
+        self.worker: Optional[Worker] = None
+        self.next_worker: Optional[Worker] = None
+        self.switch_state: dict[str, Any] = {"state": "idle"}
+        self._switch_task: Optional[asyncio.Task] = None
+        self._monitors: set[asyncio.Task] = set()
+        self.hold_timeout = config.get("hold_timeout", 120.0)
+        self.max_held = config.get("max_held", 64)
+        self.max_peek_bytes = config.get("max_peek_bytes", 1 << 20)
+        self.registry = ModelRegistry(config["model_root"], config.get("model_index_path"),
+                                      config.get("model_poll_interval", 5.0))
+        self.registry.scan()
+        self._registry_task: Optional[asyncio.Task] = None
+        self.pool: Optional[ModelPool] = None
+        if budget := config.get("pool_bytes"):
+            self.ports = (config.get("worker_ports") or
+                          list(range(8001, 8001 + config.get("pool_max_models", 4))))
+            self.pool = ModelPool(budget, self.ports, self.python, self.upstreams, self.watch,
+                                  drain_timeout=config.get("drain_timeout", 600))
         self.start_process()
 
-    def _print_stream(self, stream):
-        while True:
-            output = stream.readline()
-            if len(output):
-                print(output.strip())
-
-    def _start_llama_process(self):
-        """Starts the llama.cpp process."""
-        cmd_args = ["--model_root", self.config["model_root"],
-                    "--model_path", self.config["model_path"],
-                    "--lib_path", self.config["lib_path"],
-                    "--mmproj_path", self.config["mmproj_path"],
-                    "--n_predict", str(self.config["n_predict"]),
-                    "--port", str(self.service_port),
-                    "--overrides", json.dumps(self.config["overrides"])]
-        print(f"Starting process with python: {self.python} and args {cmd_args}")
-        command = [self.python, "-u", "main.py", *cmd_args]
-        logger.info(f"Starting llama.cpp process with command: {' '.join(command)}")
-        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                        text=True)
-        self._print_stdout_thread = Thread(target=self._print_stream,
-                                           args=[self.process.stdout])
-        self._print_stderr_thread = Thread(target=self._print_stream,
-                                           args=[self.process.stderr])
-        self._print_stdout_thread.start()
-        self._print_stderr_thread.start()
-
-    def _start_llama_server_process(self):
-        """Starts the :code:`llama-server` process."""
-        llama_server_path = Path(self.config["lib_path"]).parent.joinpath("llama-server")
-        more_args = []
-        for k, v in self.config["overrides"].items():
-            if v == True:
-                more_args.append("--" + k.replace("_", "-"))
-            else:
-                more_args.extend(["--" + k.replace("_", "-"), str(v)])
-        cmd_args = ["--model", str(Path(self.config["model_root"]).joinpath(self.config["model_path"])),
-                    "--n-predict", str(self.config["n_predict"]),
-                    "--port", str(self.service_port),
-                    "--log-file", "~/logs/llama.log",
-                    *more_args]
-        print(f"Starting llama-server process with args {cmd_args}")
-        command = [str(llama_server_path), *cmd_args]
-        logger.info(f"Starting llama-server process: {' '.join(command)}")
-        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                        text=True)
-        self._print_stdout_thread = Thread(target=self._print_stream,
-                                           args=[self.process.stdout])
-        self._print_stderr_thread = Thread(target=self._print_stream,
-                                           args=[self.process.stderr])
-        self._print_stdout_thread.start()
-        self._print_stderr_thread.start()
+    @property
+    def process(self):
+        return self.worker.process if self.worker is not None else None
+
+    @property
+    def service_port(self) -> int:
+        return self.worker.port if self.worker is not None else self.ports[0]
+
+    @property
+    def service_url(self) -> str:
+        return f"http://localhost:{self.service_port}"
+
+    def _count_abandoned(self):
+        self.abandoned_streams += 1
+        self.metrics.abandoned.inc()
 
     def start_process(self):
-        if "gemma-3" in self.config["model_path"]:
-            self.process_thread = Thread(target=self._start_llama_process)
-        else:
-            self.process_thread = Thread(target=self._start_llama_server_process)
-        self.process_thread.daemon = True
-        self.process_thread.start()
+        if self.pool is not None:
+            self.worker = self.pool.start(self.config)
+            self.pool.pinned = {self.config["model_path"]}
+            return
+        self.worker = Worker(self.config, self.ports[0], self.python)
+        self.worker.start()
+
+    def watch(self, worker: Worker):
+        """Poll the health of :code:`worker` until it is stopped, and read its output"""
+        self.metrics.worker_started(worker)
+        for coro in (self.supervise(worker), worker.pump()):
+            task = asyncio.create_task(coro)
+            self._monitors.add(task)
+            task.add_done_callback(self._monitors.discard)
+
+    async def supervise(self, worker: Worker):
+        """Monitor :code:`worker`, and restart it if its process exits while it is current.
+
+        Other workers of the pool that exit are evicted, a model being
+        switched to fails the switch.
+        """
+        await worker.monitor(self.upstreams.client(worker.url))
+        if not worker.exited():
+            return
+        if worker is not self.worker:
+            if self.pool is not None and worker is not self.next_worker:
+                self.pool.remove(worker)
+            return
+        await asyncio.sleep(worker.restart_delay())
+        if worker is self.worker and worker.exited():
+            logger.warning(f"Restarting worker on port {worker.port}")
+            worker.start()
+            self.watch(worker)
+
+    async def stop_monitors(self):
+        for task in list(self._monitors):
+            task.cancel()
 
     def stop_process(self):
         """Stops the llama.cpp process."""
-        if self.process:
-            logger.info("Stopping llama.cpp process...")
-            self.process.terminate()  # Or .kill() if needed
-            self.process.wait()
-            self.process = None
-            logger.info("llama.cpp process stopped.")
-
-    def load_model(self, new_config) -> bool:
-        """Loads a new model."""
-        if model_name := new_config.get("model_name"):
-            model_list = self.list_models()
-            matches = list(filter(lambda x: re.match(".+" + model_name + ".+", x, flags=re.IGNORECASE),
-                                  model_list))
-            if matches:
-                new_config.pop("model_name")
-                new_config["model_path"] = matches[0]
+        if self.worker is not None:
+            self.worker.stop()
+
+    def all_workers(self) -> list[Worker]:
+        """The current and next workers and those in the pool"""
+        workers = [self.worker, self.next_worker,
+                   *(self.pool.workers.values() if self.pool is not None else [])]
+        return list({id(w): w for w in workers if w is not None}.values())
+
+    def find_worker(self, name: str) -> Optional[Worker]:
+        """The current or :code:`next` worker, or the worker on port :code:`name`"""
+        if name == "current":
+            return self.worker
+        if name == "next":
+            return self.next_worker
+        return next((w for w in self.all_workers() if str(w.port) == name), None)
+
+    def resolve_config(self, new_config) -> Optional[dict]:
+        """The full config for a switch to :code:`new_config`, or None if it is bad"""
+        new_config = dict(new_config)
+        if name := new_config.pop("model_name", None):
+            if (entry := self.registry.find(name)) is None:
+                return None
+            new_config["model_path"] = entry.name
+            if entry.mmproj and "mmproj_path" not in new_config:
+                new_config["mmproj_path"] = entry.mmproj
         elif "model_path" not in new_config:
+            return None
+        return {**self.config, **new_config}
+
+    def resolve_model(self, name: str) -> Optional[dict]:
+        """Config for the model requested as :code:`name`, or None if there is none.
+
+        Matches the current and resident models by path or name, then the
+        available models, see :meth:`ModelRegistry.find`.
+        """
+        configs = [self.config, *(w.config for w in self.pool.workers.values())]
+        for config in configs:
+            if name in (config["model_path"], model_name(config)):
+                return config
+        return self.resolve_config({"model_name": name})
+
+    async def load_model(self, new_config) -> bool:
+        """Load a new model without interrupting service.
+
+        The switch continues in the background, its progress is in
+        :code:`switch_state`.
+
+        Args:
+            new_config: Config to update the current one with. :code:`model_name`
+                        is matched against the available models.
+
+
+        """
+        if self._switch_task is not None and not self._switch_task.done():
+            print("A model switch is already in progress")
+            return False
+        config = self.resolve_config(new_config)
+        if config is None:
             print("Bad new config")
             return False
-        self.stop_process()
-        self.config.update(new_config)
-        print(f"New config {self.config}")
-        self.process = self.start_process()
+        print(f"New config {config}")
+        if self.pool is not None:
+            try:
+                self.next_worker = await self.pool.get(config)
+            except WorkerUnavailable as e:
+                print(f"Cannot load {config['model_path']}: {e}")
+                return False
+        else:
+            port = next(p for p in self.ports if p != self.service_port)
+            self.next_worker = Worker(config, port, self.python)
+            self.next_worker.start()
+            self.watch(self.next_worker)
+        self.switch_state = {"state": "loading", "model_path": config["model_path"],
+                             "port": self.next_worker.port, "started_at": time.time()}
+        self._switch_task = asyncio.create_task(self._switch(self.next_worker))
         return True
 
+    async def _switch(self, new: Worker):
+        ready = await new.wait_ready(self.upstreams.client(new.url),
+                                     timeout=self.config.get("load_timeout", 600))
+        if self.pool is not None:
+            # Counted in flight by the pool while it loads, see ModelPool.get
+            new.release()
+        if not ready:
+            self.switch_state.update({"state": "failed", "finished_at": time.time()})
+            if self.pool is not None:
+                await self.pool.evict(new)
+            else:
+                await new.astop()
+                await self.upstreams.close(new.url)
+            self.next_worker = None
+            return
+        # Nothing awaits between these, so a request sees either worker whole
+        old, self.worker, self.config = self.worker, new, new.config
+        self.next_worker = None
+        if self.pool is not None:
+            # The previous model stays resident until it is evicted
+            self.pool.pinned = {new.config["model_path"]}
+            self.switch_state.update({"state": "idle", "finished_at": time.time()})
+            return
+        self.switch_state["state"] = "draining"
+        if old is not None:
+            if not await old.drain(self.config.get("drain_timeout", 600)):
+                logger.warning(f"Stopping worker on port {old.port} with "
+                               f"{old.in_flight} requests in flight")
+            await old.astop()
+            await self.upstreams.close(old.url)
+        self.switch_state.update({"state": "idle", "finished_at": time.time()})
+
     def reset_config(self):
         self.config = copy.deepcopy(self._initial_config)
 
     async def proxy_request(self, endpoint: str, request: Request):
-        """Proxies a request to the service.py process."""
-        url = f"{self.service_url}/{endpoint}"
-        headers = request.headers.mutablecopy()
+        """Proxies a request to the service.py process.
+
+        With a model pool, the request goes to the worker of the model it
+        names in the :code:`x-model` header or the :code:`model` field of the
+        body, which is loaded if it is not resident. The request and response
+        are relayed as they are, see :func:`relay`, with the time spent on the
+        way in the :code:`Server-Timing` header.
+        """
+        worker = None
+        body = None
+        trace = Trace(f"proxy /{endpoint}", self.trace_exporter)
         try:
-            if request.method == "GET":
-                resp = httpx.get(url, headers=headers, params=request.query_params)
-                if not endpoint:
-                    return Response(resp.content.decode(), status_code=200)
-                else:
-                    return JSONResponse(resp.json(), headers=resp.headers, status_code=200)
-            elif request.method == "POST":
-                data = await request.json()
-                if endpoint == "stream" or\
-                   endpoint in {"completions", "chat/completions", "v1/chat/completions"} and\
-                   data.get("stream"):
-                    return StreamingResponse(stream_response(url, data),
-                                             background=BackgroundTask(lambda: None),
-                                             media_type="text/event-stream")
-                elif endpoint in {"completions", "chat/completions", "v1/chat/completions"}:
-                    resp = httpx.post(url, json=data, timeout=None)
-                    return JSONResponse(resp.json(), status_code=200)
-                else:
-                    resp = httpx.post(url, json=data, timeout=2)
-                    return JSONResponse(resp.json(), status_code=200)
-            else:
-                return JSONResponse({"Error": "Method not allowed"}, status_code=405)
-        except Exception as e:
-            logger.error(f"Error proxying request to service.py: {e}")
-            return JSONResponse({"error": f"Failed to proxy request: {e}"}, status_code=500)
+            if self.pool is not None and request.method == "POST":
+                if (model := request.headers.get("x-model")) is None:
+                    with trace.span("peek"):
+                        model, _, body = await peek_field(request, "model",
+                                                          max_bytes=self.max_peek_bytes)
+                if model:
+                    if (config := self.resolve_model(model)) is None:
+                        return JSONResponse({"error": f"No such model: {model}"}, status_code=404)
+                    with trace.span("load"):
+                        worker = await self.pool.get(config)
+            if worker is None:
+                worker = self.worker
+                worker.acquire()
+            # Counted in flight while held, so that it is not stopped meanwhile
+            with trace.span("hold"):
+                await worker.hold(self.hold_timeout, self.max_held)
+        except WorkerUnavailable as e:
+            if worker is not None:
+                worker.release()
+            return JSONResponse({"error": str(e)}, status_code=e.status_code,
+                                headers={"Retry-After": str(e.retry_after)})
+        except BaseException:
+            # E.g. the client went away while held
+            if worker is not None:
+                worker.release()
+            raise
+        client = self.upstreams.client(worker.url)
+        timeout = None if endpoint in GENERATION_ENDPOINTS else self.upstreams.control_timeout
+        return await relay(client, request, f"/{endpoint}", body=body, timeout=timeout,
+                           on_abandon=self._count_abandoned, on_close=worker.release,
+                           on_response=self.metrics.response_observer(worker.url),
+                           trace=trace)
 
     async def interrupt(self, request: Request):
-        if "gemma-3" in self.config["model_path"]:
+        if is_gemma(self.config):
             return await self.proxy_request("interrupt", request)
         else:
-            self.process.send_signal(subprocess.signal.SIGINT)  # type: ignore
+            self.process.send_signal(signal.SIGINT)  # type: ignore
             return JSONResponse({"message": "interrupted"}, status_code=200)
 
     def list_models(self):
-        models = glob.glob(self.config["model_root"] + "/*.gguf")
-        return [Path(x).name for x in models if not Path(x).name.startswith("mmproj")]
+        return self.registry.names()
 
 
 def model_manager_app(config):
@@ -178,12 +313,12 @@ def model_manager_app(config):
 
     # Model manager only endpoints
     async def list_models(request):
-        return JSONResponse(model_manager.list_models(), status_code=200)
+        return JSONResponse(model_manager.registry.list(), status_code=200)
 
     async def switch_model(request):
         params = await request.json()
         logger.info(f"Switching model with params: {params}")
-        status = model_manager.load_model(params)
+        status = await model_manager.load_model(params)
         if status:
             return JSONResponse({"message": "Model switch initiated"}, status_code=200)
         else:
@@ -192,6 +327,36 @@ def model_manager_app(config):
     async def model_info(request):
         return JSONResponse(model_manager.config, status_code=200)
 
+    async def switch_status(request):
+        return JSONResponse({**model_manager.switch_state,
+                             "worker": model_manager.worker.stats(),
+                             "next_worker": (model_manager.next_worker.stats()
+                                             if model_manager.next_worker else None)},
+                            status_code=200)
+
+    async def proxy_stats(request):
+        return JSONResponse({"abandoned_streams": model_manager.abandoned_streams,
+                             "upstreams": model_manager.upstreams.stats()},
+                            status_code=200)
+
+    async def pool(request):
+        if model_manager.pool is None:
+            return JSONResponse({"error": "No model pool configured"}, status_code=404)
+        return JSONResponse(model_manager.pool.stats(), status_code=200)
+
+    async def metrics(request):
+        return model_manager.metrics.registry.response()
+
+    async def logs(request):
+        if (worker := model_manager.find_worker(request.path_params["worker"])) is None:
+            return JSONResponse({"error": "No such worker"}, status_code=404)
+        return log_response(worker.log, request)
+
+    async def health(request):
+        worker = model_manager.worker
+        return JSONResponse({"status": worker.state, "worker": worker.stats()},
+                            status_code=200 if worker.state == "ready" else 503)
+
     async def is_alive(request):
         if model_manager.process is None:
             msg = {"message": False}
@@ -222,7 +387,13 @@ def model_manager_app(config):
         Route("/list_models", endpoint=list_models, methods=["GET"]),
         Route("/switch_model", endpoint=switch_model, methods=["POST"]),
         Route("/model_info", endpoint=model_info, methods=["GET"]),
+        Route("/switch_status", endpoint=switch_status, methods=["GET"]),
         Route("/is_alive", endpoint=is_alive, methods=["GET"]),
+        Route("/health", endpoint=health, methods=["GET"]),
+        Route("/pool", endpoint=pool, methods=["GET"]),
+        Route("/logs/{worker}", endpoint=logs, methods=["GET"]),
+        Route("/proxy_stats", endpoint=proxy_stats, methods=["GET"]),
+        Route("/metrics", endpoint=metrics, methods=["GET"]),
         Route("/reset_config", endpoint=reset_config, methods=["GET"]),
 
         Route("/reset_context", endpoint=reset_context, methods=["GET"]),
@@ -232,6 +403,19 @@ def model_manager_app(config):
         Route("/{endpoint_name:path}", endpoint=proxy_endpoint, methods=["GET", "POST"]),
     ]
 
+    async def startup():
+        await model_manager.upstreams.start([model_manager.service_url])
+        model_manager.watch(model_manager.worker)
+        model_manager._registry_task = asyncio.create_task(model_manager.registry.watch())
+
+    async def shutdown():
+        if model_manager._registry_task is not None:
+            model_manager._registry_task.cancel()
+        await model_manager.stop_monitors()
+        await model_manager.upstreams.aclose()
+
     app = Starlette(routes=routes, debug=True)
     app.state.model_manager = model_manager
+    app.add_event_handler("startup", startup)
+    app.add_event_handler("shutdown", shutdown)
     return app
@@ -1,159 +1,135 @@
-from typing import Optional, Any
-import json
-import subprocess
+from typing import Optional
+import asyncio
 import logging
 import copy
-from pathlib import Path
-from threading import Thread
-import re
-import glob
-
-import httpx
+import signal
+import hashlib
 
 from starlette.applications import Starlette
 from starlette.requests import Request
-from starlette.responses import StreamingResponse, JSONResponse, Response
+from starlette.responses import JSONResponse
 from starlette.routing import Route
-from starlette.background import BackgroundTask
+
+from .worker import Worker, WorkerUnavailable
+from .routing import Router, model_name
+from .planner import plan_config
+from .registry import ModelRegistry
+from .logs import log_response
+from .metrics import ProxyMetrics
+from .tracing import Trace, make_exporter
+from .upstream import (UpstreamPool, GENERATION_ENDPOINTS, relay, peek_body, peek_field,
+                       scan_field, leading_messages)
 
 
 logger = logging.getLogger(__name__)
 
 
-async def stream_response(upstream_url: str, data):
-    async with httpx.AsyncClient() as client:
-        async with client.stream("POST", upstream_url, json=data, timeout=None) as response:
-            async for chunk in response.aiter_bytes():
-                yield chunk
+class ModelManager:
+    """Manage workers on several GPUs and proxy requests to them.
 
+    The workers are given per GPU in the config by their GPU ids, or as a
+    list of :code:`models` that are placed onto the GPUs and CPU memory by
+    :func:`plan_config` according to their size.
 
-class ModelManager:
+    Args:
+        config: Manager config
+
+
+    """
     def __init__(self, config):
+        if "models" in config:
+            config = {**config, **plan_config(config, reserve=config.get("reserve_bytes",
+                                                                          512 << 20))}
         self._initial_config = config
         self.config = copy.deepcopy(self._initial_config)
-        self.processes: dict[int, dict[str, Any]] = {}
+        self.workers: dict[int, Worker] = {}
+        self._monitors: set[asyncio.Task] = set()
+        self._monitors_started = False
         self.service_url_base = "http://localhost"
         self.python = config["python"]
+        self.abandoned_streams = 0
+        self.upstreams = UpstreamPool.from_config(config)
         self.gpus = list(filter(lambda x: isinstance(x, int), self.config.keys()))
         self.use_multiple_models = config["use_multiple_models"]
+        model_root = config.get("model_root") or config.get("default", {}).get("model_root")
+        self.registry = ModelRegistry(model_root, config.get("model_index_path"),
+                                      config.get("model_poll_interval", 5.0))
+        self.registry.scan()
+        self._registry_task: Optional[asyncio.Task] = None
+        self.hold_timeout = config.get("hold_timeout", 120.0)
+        self.max_held = config.get("max_held", 64)
+        self.max_peek_bytes = config.get("max_peek_bytes", 1 << 20)
 
         self.port_base = 8001
         self.ports = {}
+        # GPUs serving the same model are replicas that requests are spread over
+        self.router = Router(config.get("default_model"), config.get("affinity_slack", 2))
+        self.trace_exporter = make_exporter(config.get("trace_exporter"), "model_manager")
+        self.metrics = ProxyMetrics(
+            lambda: self.workers.values(),
+            lambda: {r.url: r.in_flight for r in self.router.replicas.values()})
         if self.use_multiple_models:
             for i in self.gpus:
                 self.ports[i] = self.port_base + i
                 self.start_process(i)
         else:
+            self.ports[0] = self.port_base
             self.start_process(0)
 
-    def _print_stream(self, stream):
-        while True:
-            output = stream.readline()
-            if len(output):
-                print(output.strip())
-
-    def _start_llama_process(self, model_config, gpu_id: Optional[int] = None):
-        """Starts a llama.cpp process on a specific GPU."""
-        if gpu_id is not None:
-            return "Error"
-        port = self.ports[gpu_id]
-        cmd_args = [
-            "--model_root", model_config["model_root"],
-            "--model_path", model_config["model_path"],
-            "--lib_path", model_config["lib_path"],
-            "--mmproj_path", model_config["mmproj_path"],
-            "--n_predict", str(model_config["n_predict"]),
-            "--port", str(port),
-            "--overrides", json.dumps(model_config["overrides"])
-        ]
-        print(f"Starting llama.cpp process on GPU {gpu_id} with args {cmd_args}")
-        command = [self.python, "-u", "main.py", *cmd_args]
-        logger.info(f"Starting llama.cpp process: {' '.join(command)}")
-        process = subprocess.Popen(command, stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE, text=True)
-
-        thread_stdout = Thread(target=self._print_stream, args=[process.stdout])
-        thread_stderr = Thread(target=self._print_stream, args=[process.stderr])
-        thread_stdout.start()
-        thread_stderr.start()
-
-        self.processes[gpu_id] = {
-            "process": process,
-            "port": port,
-            "thread_stdout": thread_stdout,
-            "thread_stderr": thread_stderr
-        }
-
-    def _start_llama_server_process(self, model_config, gpu_id: Optional[int] = None):
-        """Starts a llama-server process on a specific GPU."""
-        gpu_id = gpu_id or 0
-        port = self.ports[gpu_id]
-        llama_server_path = Path(self.config["lib_path"]).parent.joinpath("llama-server")
-        model_path = str(Path(self.config["model_root"]).joinpath(model_config["model_path"]))
-
-        # Build args
-        args = [
-            "--model", model_path,
-            "--n-predict", str(model_config["n_predict"]),
-            "--port", str(port),
-            "--log-file", "~/logs/llama.log",
-        ]
-
-        for k, v in model_config["overrides"].items():
-            if v is True:
-                args.append(f"--{k.replace('_', '-')}")
-            else:
-                args.extend([f"--{k.replace('_', '-')}", str(v)])
-
-        if "--device" in args:
-            logger.info(f"Will launch on GPU {gpu_id}")
-        else:
-            logger.info(f"Will launch on GPU {gpu_id}")
-            args.extend(["--device", f"CUDA{gpu_id}"])
-        command = [str(llama_server_path), *args]
-        logger.info(f"Starting llama-server: {' '.join(command)}")
-        process = subprocess.Popen(command, stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE, text=True)
-
-        thread_stdout = Thread(target=self._print_stream, args=[process.stdout])
-        thread_stderr = Thread(target=self._print_stream, args=[process.stderr])
-        thread_stdout.start()
-        thread_stderr.start()
-
-        self.processes[gpu_id] = {
-            "process": process,
-            "port": port,
-            "thread_stdout": thread_stdout,
-            "thread_stderr": thread_stderr
-        }
+    def _count_abandoned(self):
+        self.abandoned_streams += 1
+        self.metrics.abandoned.inc()
 
     def start_process(self, gpu_id):
         print(f"Launching process for {gpu_id}")
         if self.use_multiple_models:
             model_config = self.config[gpu_id]
-            if "gemma" in model_config["model_path"].lower():
-                self._start_llama_process(model_config, gpu_id)
-            else:
-                self._start_llama_server_process(model_config, gpu_id)
+            # Planned workers may share a GPU or run on the CPU
+            worker = Worker(model_config, self.ports[gpu_id], self.python,
+                            model_config.get("gpu_id", gpu_id))
         else:
             model_config = self.config["default"]
-            if "gemma" in model_config["model_path"]:
-                self._start_llama_process(model_config)
-            else:
-                self._start_llama_server_process(model_config)
+            worker = Worker(model_config, self.ports[0], self.python)
+        self.workers[gpu_id] = worker
+        replica = self.router.add(gpu_id, worker.url, model_name(model_config))
+        replica.ready = False
+        worker.on_state = lambda state: setattr(replica, "ready", state == "ready")
+        worker.start()
+        if self._monitors_started:
+            self.watch(worker)
+
+    def watch(self, worker: Worker):
+        """Poll the health of :code:`worker` until it is stopped, and read its output"""
+        self.metrics.worker_started(worker)
+        for coro in (self.supervise(worker), worker.pump()):
+            task = asyncio.create_task(coro)
+            self._monitors.add(task)
+            task.add_done_callback(self._monitors.discard)
+
+    async def supervise(self, worker: Worker):
+        """Monitor :code:`worker`, and restart it if its process exits"""
+        await worker.monitor(self.upstreams.client(worker.url))
+        if not worker.exited():
+            return
+        await asyncio.sleep(worker.restart_delay())
+        if worker in self.workers.values() and worker.exited():
+            logger.warning(f"Restarting worker on port {worker.port}")
+            worker.start()
+            self.watch(worker)
+
+    async def start_monitors(self):
+        self._monitors_started = True
+        for worker in self.workers.values():
+            self.watch(worker)
+
+    async def stop_monitors(self):
+        self._monitors_started = False
+        for task in list(self._monitors):
+            task.cancel()
 
     def stop_process(self, gpu_id):
-        data = self.processes[gpu_id]
-        if data["process"]:
-            logger.info(f"Stopping process on GPU {gpu_id}")
-            data["process"].terminate()
-            data["process"].wait()
-            data["process"] = None
-            # Clean up threads
-        if data["thread_stdout"]:
-            data["thread_stdout"].join()
-        if data["thread_stderr"]:
-            data["thread_stderr"].join()
+        if (worker := self.workers.get(gpu_id)) is not None:
+            worker.stop()
 
     def load_model(self, new_config) -> bool:
         """Load a new model (or multiple models)."""
@@ -164,13 +140,13 @@ class ModelManager:
             gpu = new_config.pop("gpu")
         else:
             gpu = 0
-        if model_name := new_config.get("model_name"):
-            model_list = self.list_models()
-            matches = list(filter(lambda x: re.match(".+" + model_name + ".+", x, flags=re.IGNORECASE),
-                                  model_list))
-            if matches:
-                new_config.pop("model_name")
-                new_config["model_path"] = matches[0]
+        if name := new_config.pop("model_name", None):
+            if (entry := self.registry.find(name)) is None:
+                print(f"No model matches {name}")
+                return False
+            new_config["model_path"] = entry.name
+            if entry.mmproj and "mmproj_path" not in new_config:
+                new_config["mmproj_path"] = entry.mmproj
         elif "model_path" not in new_config:
             print("Bad new config")
             return False
@@ -193,8 +169,7 @@ class ModelManager:
             self.start_process(0)
 
     def list_models(self):
-        models = glob.glob(self.config["model_root"] + "/*.gguf")
-        return [Path(x).name for x in models if not Path(x).name.startswith("mmproj")]
+        return self.registry.names()
 
     def get_service_url(self, gpu_id=None):
         if gpu_id is None:
@@ -203,52 +178,94 @@ class ModelManager:
             port = self.ports.get(gpu_id, self.port_base)
         return f"http://localhost:{port}"
 
-    async def proxy_request(self, endpoint: str, request: Request, gpu_id: Optional[int] = None):
-        """Proxies request to specific GPU model."""
-        url = self.get_service_url(gpu_id) + f"/{endpoint}"
+    @staticmethod
+    def affinity_key(request: Request, head: bytes) -> Optional[str]:
+        """Key to keep the requests of a conversation on one replica.
 
-        headers = request.headers.mutablecopy()
+        The session or conversation id if the request has one, like the worker
+        uses, otherwise a hash of the messages up to the first user message.
+
+        Args:
+            request: The request
+            head: Start of its body
+
+
+        """
+        if key := (request.headers.get("x-session-id") or scan_field(head, "session_id") or
+                   scan_field(head, "conversation_id")):
+            return key
+        if (messages := leading_messages(head)) is not None:
+            return hashlib.blake2b(messages, digest_size=16).hexdigest()
+        return None
+
+    async def proxy_request(self, endpoint: str, request: Request, gpu_id: Optional[int] = None):
+        """Proxies request to specific GPU model, or to a replica of the requested model.
+
+        Without :code:`gpu_id` the model is read from the :code:`x-model`
+        header or the :code:`model` field of the body, the default model if
+        neither names one, and the request goes to the replica of that model
+        with the fewest requests in flight. Turns of the same conversation go to the same replica if
+        possible, see :meth:`affinity_key`. Replicas still loading their
+        model get requests only if none is ready, which are then held until it
+        is. The request and response are relayed as they are, see :func:`relay`,
+        with the time spent on the way in the :code:`Server-Timing` header.
+        """
+        body = None
+        trace = Trace(f"proxy /{endpoint}", self.trace_exporter)
         try:
-            if request.method == "GET":
-                resp = httpx.get(url, headers=headers, params=request.query_params)
-                if not endpoint:
-                    return Response(resp.content.decode(), status_code=200)
-                else:
-                    return JSONResponse(resp.json(), headers=resp.headers, status_code=200)
-            elif request.method == "POST":
-                data = await request.json()
-                if endpoint == "stream" or\
-                   endpoint in {"completions", "chat/completions", "v1/chat/completions"} and\
-                   data.get("stream"):
-                    return StreamingResponse(stream_response(url, data),
-                                             background=BackgroundTask(lambda: None),
-                                             media_type="text/event-stream")
-                elif endpoint in {"completions", "chat/completions", "v1/chat/completions"}:
-                    async with httpx.AsyncClient() as client:
-                        resp = await client.post(url, json=data, timeout=None)
-                        return JSONResponse(resp.json(), status_code=200)
-                else:
-                    async with httpx.AsyncClient() as client:
-                        resp = await client.post(url, json=data, timeout=2)
-                        return JSONResponse(resp.json(), status_code=200)
+            if gpu_id is not None:
+                replica = self.router.acquire(self.router.replicas[gpu_id])
             else:
-                return JSONResponse({"Error": "Method not allowed"}, status_code=405)
-        except Exception as e:
-            logger.error(f"Error proxying request to service.py: {e}")
-            return JSONResponse({"error": f"Failed to proxy request: {e}"}, status_code=500)
+                head = b""
+                model = request.headers.get("x-model")
+                if request.method == "POST":
+                    with trace.span("peek"):
+                        if model is None:
+                            model, head, body = await peek_field(request, "model",
+                                                                 max_bytes=self.max_peek_bytes)
+                        else:
+                            head, body = await peek_body(request)
+                with trace.span("route"):
+                    key = (self.affinity_key(request, head) if endpoint in GENERATION_ENDPOINTS
+                           else None)
+                    replica = self.router.route(model, key)
+        except KeyError as e:
+            if gpu_id is None and not model:
+                # Several models and none is the default
+                return JSONResponse({"error": f"{e.args[0]}, name the model in the model field "
+                                              "or the x-model header"}, status_code=400)
+            return JSONResponse({"error": f"No such model or GPU: {e.args[0]}"}, status_code=404)
+        try:
+            with trace.span("hold"):
+                await self.workers[replica.id].hold(self.hold_timeout, self.max_held)
+        except WorkerUnavailable as e:
+            self.router.release(replica)
+            return JSONResponse({"error": str(e)}, status_code=e.status_code,
+                                headers={"Retry-After": str(e.retry_after)})
+        except BaseException:
+            # E.g. the client went away while held
+            self.router.release(replica)
+            raise
+        client = self.upstreams.client(replica.url)
+        timeout = None if endpoint in GENERATION_ENDPOINTS else self.upstreams.control_timeout
+        return await relay(client, request, f"/{endpoint}", body=body, timeout=timeout,
+                           on_abandon=self._count_abandoned,
+                           on_close=lambda error: self.router.release(replica, error),
+                           on_response=self.metrics.response_observer(replica.url),
+                           trace=trace)
 
     async def interrupt(self, request: Request, gpu_id=None):
         if gpu_id is not None:
-            if self.processes.get(gpu_id) and self.processes[gpu_id]["process"]:
-                self.processes[gpu_id]["process"].send_signal(subprocess.signal.SIGINT)
+            if (worker := self.workers.get(gpu_id)) and worker.alive():
+                worker.process.send_signal(signal.SIGINT)  # type: ignore
                 return JSONResponse({"message": f"Interrupted GPU {gpu_id}"}, status_code=200)
             else:
                 return JSONResponse({"error": "No process running on this GPU"}, status_code=404)
         else:
             # Interrupt all models
-            for gpu_id in self.processes:
-                if self.processes[gpu_id]["process"]:
-                    self.processes[gpu_id]["process"].send_signal(subprocess.signal.SIGINT)
+            for worker in self.workers.values():
+                if worker.alive():
+                    worker.process.send_signal(signal.SIGINT)  # type: ignore
             return JSONResponse({"message": "Interrupted all models"}, status_code=200)
 
 
@@ -256,7 +273,7 @@ def model_manager_app(config):
     model_manager = ModelManager(config)
 
     async def list_models(request):
-        return JSONResponse(model_manager.list_models(), status_code=200)
+        return JSONResponse(model_manager.registry.list(), status_code=200)
 
     async def switch_model(request):
         params = await request.json()
@@ -277,12 +294,16 @@ def model_manager_app(config):
             return JSONResponse([model_manager.config[i]
                                  for i in model_manager.gpus], status_code=200)
 
+    async def proxy_stats(request):
+        return JSONResponse({"abandoned_streams": model_manager.abandoned_streams,
+                             "upstreams": model_manager.upstreams.stats()},
+                            status_code=200)
+
     async def is_alive(request):
-        if not model_manager.processes:
+        if not model_manager.workers:
             msg = {"message": False}
         else:
-            msg = {"message": [p["process"].poll() is None
-                               for p in model_manager.processes.values()]}
+            msg = {"message": [w.alive() for w in model_manager.workers.values()]}
         return JSONResponse(msg, status_code=200)
 
     async def reset_config(request):
@@ -297,6 +318,23 @@ def model_manager_app(config):
                 model_manager.reset_config(gpu_id)
                 return JSONResponse({"message": f"Reset Config for {gpu_id}"}, status_code=200)
 
+    async def replicas(request):
+        return JSONResponse(model_manager.router.stats(), status_code=200)
+
+    async def metrics(request):
+        return model_manager.metrics.registry.response()
+
+    async def logs(request):
+        if (worker := model_manager.workers.get(request.path_params["gpu_id"])) is None:
+            return JSONResponse({"error": "No such worker"}, status_code=404)
+        return log_response(worker.log, request)
+
+    async def health(request):
+        workers = {gpu: w.stats() for gpu, w in model_manager.workers.items()}
+        ready = any(w["state"] == "ready" for w in workers.values())
+        return JSONResponse({"status": "ready" if ready else "loading", "workers": workers},
+                            status_code=200 if ready else 503)
+
     async def proxy_endpoint(request: Request):
         endpoint_name = request.path_params["endpoint_name"]
         gpu_id = request.path_params.get("gpu_id")
@@ -317,13 +355,33 @@ def model_manager_app(config):
         Route("/switch_model", endpoint=switch_model, methods=["POST"]),
         Route("/model_info", endpoint=model_info, methods=["GET"]),
         Route("/is_alive", endpoint=is_alive, methods=["GET"]),
+        Route("/proxy_stats", endpoint=proxy_stats, methods=["GET"]),
         Route("/reset_config", endpoint=reset_config, methods=["GET"]),
         Route("/interrupt", endpoint=interrupt, methods=["GET"]),
         Route("/is_generating", endpoint=is_generating, methods=["GET"]),
         Route("/reset_context", endpoint=reset_context, methods=["GET"]),
+        Route("/replicas", endpoint=replicas, methods=["GET"]),
+        Route("/health", endpoint=health, methods=["GET"]),
+        Route("/logs/{gpu_id:int}", endpoint=logs, methods=["GET"]),
+        Route("/metrics", endpoint=metrics, methods=["GET"]),
         Route("/{gpu_id:int}/{endpoint_name:path}", endpoint=proxy_endpoint, methods=["GET", "POST"]),
+        Route("/{endpoint_name:path}", endpoint=proxy_endpoint, methods=["GET", "POST"]),
     ]
 
+    async def startup():
+        await model_manager.upstreams.start([model_manager.get_service_url(i)
+                                             for i in model_manager.workers])
+        await model_manager.start_monitors()
+        model_manager._registry_task = asyncio.create_task(model_manager.registry.watch())
+
+    async def shutdown():
+        if model_manager._registry_task is not None:
+            model_manager._registry_task.cancel()
+        await model_manager.stop_monitors()
+        await model_manager.upstreams.aclose()
+
     app = Starlette(routes=routes, debug=True)
     app.state.model_manager = model_manager
+    app.add_event_handler("startup", startup)
+    app.add_event_handler("shutdown", shutdown)
     return app
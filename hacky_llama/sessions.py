@@ -0,0 +1,114 @@
+from typing import Optional
+import collections
+import time
+
+
+class Session:
+    """A conversation slot.
+
+    Args:
+        session_id: Session / conversation id
+
+
+    """
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        # Message hashes the saved state corresponds to
+        self.prefix: list[str] = []
+        # Saved KV state (a ctypes array) while the session is not active
+        self.state = None
+        self.last_used = time.time()
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.state) if self.state is not None else 0
+
+    def drop_state(self):
+        self.state = None
+        self.prefix = []
+
+
+class SessionCache:
+    """LRU cache of :class:`Session` slots.
+
+    At most :code:`max_sessions` sessions are kept and the saved states of all
+    the sessions together hold at most :code:`max_bytes`. The least recently
+    used sessions are evicted first.
+
+    Args:
+        max_sessions: Maximum number of sessions
+        max_bytes: Maximum total size of the saved states
+
+
+    """
+    def __init__(self, max_sessions: int = 8, max_bytes: int = 4 << 30):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._sessions: collections.OrderedDict[str, Session] = collections.OrderedDict()
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
+    @property
+    def nbytes(self) -> int:
+        return sum(s.nbytes for s in self._sessions.values())
+
+    def get(self, session_id: str) -> Session:
+        """Get the session for :code:`session_id`, creating it if required.
+
+        Marks the session as most recently used.
+
+        """
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._sessions[session_id] = Session(session_id)
+        else:
+            self._sessions.move_to_end(session_id)
+        session.last_used = time.time()
+        return session
+
+    def peek(self, session_id: str) -> Optional[Session]:
+        return self._sessions.get(session_id)
+
+    def evict(self, keep: Optional[str] = None) -> list[Session]:
+        """Evict least recently used sessions until within limits.
+
+        Sessions over the count limit are removed. If the saved states are over
+        the byte limit the oldest states are dropped. The session :code:`keep`
+        is never evicted. The caller is responsible for dropping the state of
+        the returned sessions.
+
+        Returns:
+            The sessions that were removed or are to lose their state
+
+
+        """
+        evicted = []
+        for session_id in list(self._sessions):
+            if len(self._sessions) <= self.max_sessions:
+                break
+            if session_id != keep:
+                evicted.append(self._sessions.pop(session_id))
+        total = self.nbytes
+        for session in self._sessions.values():
+            if total <= self.max_bytes:
+                break
+            if session.session_id != keep and session.state is not None:
+                total -= session.nbytes
+                evicted.append(session)
+        self.evictions += len(evicted)
+        return evicted
+
+    def stats(self) -> dict:
+        return {"sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "state_bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions}
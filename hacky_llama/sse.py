@@ -0,0 +1,77 @@
+from typing import Any, Optional
+import json
+from json.encoder import encode_basestring_ascii
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# JSON string literal of a str. For token sized strings the C encoder of the
+# stdlib is faster than orjson, which only pays off for whole objects
+encode_string = encode_basestring_ascii
+
+
+def dumps(obj: Any) -> str:
+    """Serialize :code:`obj` to JSON, with :code:`orjson` if available"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+
+class SSEEncoder:
+    """Encode chat completion chunks as server sent events.
+
+    The JSON envelope of a delta chunk is constant, so it is rendered once and
+    only the text of each chunk is escaped.
+
+    Args:
+        batch_tokens: Number of chunks to put in a single :code:`data:` frame
+
+
+    """
+    done = "data: [DONE]\n\n"
+
+    def __init__(self, batch_tokens: int = 1):
+        self.batch_tokens = max(1, batch_tokens)
+        self._prefix = 'data: {"choices":[{"delta":{"content":'
+        self._suffix = '},"finish_reason":null}]}\n\n'
+        self._pending: list[str] = []
+
+    def frame(self, data: str) -> str:
+        """Frame arbitrary :code:`data` as an event"""
+        return f"data: {data}\n\n"
+
+    def delta(self, text: str) -> str:
+        """Event for a content delta of :code:`text`"""
+        return self._prefix + encode_string(text) + self._suffix
+
+    def add(self, text: str) -> Optional[str]:
+        """Add a chunk of text and return an event once a batch is full.
+
+        With :code:`batch_tokens` of 1 every chunk is returned as an event.
+
+        """
+        if self.batch_tokens == 1:
+            return self.delta(text)
+        self._pending.append(text)
+        if len(self._pending) >= self.batch_tokens:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        """Event for the pending chunks of an incomplete batch, if any"""
+        if not self._pending:
+            return None
+        text = "".join(self._pending)
+        self._pending.clear()
+        return self.delta(text)
+
+    def final(self, usage: dict) -> str:
+        """Last event of a stream with :code:`usage`"""
+        return self.frame(dumps({"choices": [{"delta": {"content": ""}, "finish_reason": "stop"}],
+                                 "usage": usage}))
+
+    def error(self, err: Any) -> str:
+        return self.frame(dumps({"error": str(err)}))
@@ -0,0 +1,127 @@
+from typing import Optional
+from pathlib import Path
+import hashlib
+import mmap
+import os
+
+
+class DiskStateCache:
+    """KV state snapshots on local disk.
+
+    A snapshot is the raw state of the context as saved by the library, keyed
+    by the model file and the hash of the messages it holds. Snapshots are
+    restored with a private memory map, so the state is paged in by the library
+    without being copied in Python. When the snapshots exceed :code:`max_bytes`
+    the least recently used ones are deleted.
+
+    Args:
+        cache_dir: Directory for the snapshots
+        model_path: Model file the states belong to
+        max_bytes: Maximum total size of the snapshots
+
+
+    """
+    suffix = ".kv"
+
+    def __init__(self, cache_dir: str, model_path: str, max_bytes: int = 16 << 30):
+        self.root = Path(cache_dir).expanduser()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        model = Path(model_path).absolute()
+        try:
+            stat = model.stat()
+            model_id = f"{model}:{stat.st_size}:{stat.st_mtime_ns}"
+        except OSError:
+            model_id = str(model)
+        self.model_id = hashlib.blake2b(model_id.encode(), digest_size=16).hexdigest()
+        self.hits = 0
+        self.misses = 0
+        self.saves = 0
+        self.evictions = 0
+
+    def path(self, prefix: list[str]) -> Path:
+        """Snapshot file for a message prefix
+
+        Args:
+            prefix: Message hashes of the prefix
+
+
+        """
+        h = hashlib.blake2b(self.model_id.encode(), digest_size=20)
+        for x in prefix:
+            h.update(x.encode())
+        return self.root.joinpath(h.hexdigest() + self.suffix)
+
+    def save(self, prefix: list[str], state) -> bool:
+        """Write a snapshot of :code:`state` for :code:`prefix`
+
+        Args:
+            prefix: Message hashes the state holds
+            state: State buffer as returned by :meth:`GemmaInterface.save_state`
+
+
+        """
+        if not prefix or state is None or not len(state):
+            return False
+        path = self.path(prefix)
+        tmp = path.with_suffix(".tmp")
+        try:
+            with open(tmp, "wb") as f:
+                f.write(memoryview(state))
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Could not save KV state to {path}: {e}")
+            tmp.unlink(missing_ok=True)
+            return False
+        self.saves += 1
+        self.enforce_budget()
+        return True
+
+    def find(self, hashes: list[str]) -> Optional[tuple[list[str], mmap.mmap]]:
+        """Find the snapshot for the longest proper prefix of :code:`hashes`.
+
+        Args:
+            hashes: Message hashes of the incoming request
+
+        Returns:
+            The matched prefix and a copy-on-write map of the snapshot, or :code:`None`
+
+
+        """
+        for n in range(len(hashes) - 1, 0, -1):
+            path = self.path(hashes[:n])
+            try:
+                with open(path, "rb") as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            except (OSError, ValueError):
+                continue
+            os.utime(path)
+            self.hits += 1
+            return hashes[:n], mm
+        self.misses += 1
+        return None
+
+    def snapshots(self) -> list[tuple[Path, os.stat_result]]:
+        return [(p, p.stat()) for p in self.root.glob("*" + self.suffix)]
+
+    def enforce_budget(self):
+        """Delete least recently used snapshots until within :code:`max_bytes`"""
+        snapshots = sorted(self.snapshots(), key=lambda x: x[1].st_mtime)
+        total = sum(st.st_size for _, st in snapshots)
+        for path, st in snapshots:
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= st.st_size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        snapshots = self.snapshots()
+        return {"dir": str(self.root),
+                "snapshots": len(snapshots),
+                "bytes": sum(st.st_size for _, st in snapshots),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "saves": self.saves,
+                "evictions": self.evictions}
@@ -0,0 +1,143 @@
+from typing import Optional, Callable
+import asyncio
+import threading
+import time
+
+
+class TokenBuffer:
+    """Thread-safe buffer between the library's token callback and asyncio.
+
+    The engine thread appends tokens with :meth:`put`. Instead of scheduling
+    a coroutine per token, the event loop is woken at most once per
+    :code:`flush_interval` seconds, or as soon as :code:`flush_bytes` are
+    pending. :meth:`get` returns everything pending as one chunk.
+
+    At most :code:`max_bytes` may be pending. When a consumer falls that far
+    behind, with :code:`overflow="block"` the engine thread waits for it to
+    catch up. With :code:`overflow="interrupt"` :code:`on_overflow` is called
+    and further tokens are dropped.
+
+    Args:
+        loop: Event loop of the consumer
+        flush_interval: Minimum seconds between wakeups of the loop
+        flush_bytes: Pending size at which the loop is woken immediately
+        max_bytes: Maximum pending size
+        overflow: Slow consumer policy, one of "block" or "interrupt"
+        on_overflow: Callback for the "interrupt" policy
+
+
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, flush_interval: float = 0.01,
+                 flush_bytes: int = 512, max_bytes: int = 1 << 20, overflow: str = "block",
+                 on_overflow: Optional[Callable[[], None]] = None):
+        if overflow not in {"block", "interrupt"}:
+            raise ValueError(f"Unknown overflow policy {overflow}")
+        self.loop = loop
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.on_overflow = on_overflow
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._chunks: list[str] = []
+        self._nbytes = 0
+        self._closed = False
+        self._wake_pending = False
+        self._last_wake = 0.0
+        self._event = asyncio.Event()
+        self.overflowed = False
+        self.puts = 0
+        self.wakeups = 0
+
+    def put(self, token: str):
+        """Append a token. Called from the engine thread"""
+        with self._lock:
+            while self._nbytes >= self.max_bytes and not self._closed:
+                if self.overflow == "interrupt":
+                    if not self.overflowed:
+                        self.overflowed = True
+                        if self.on_overflow is not None:
+                            self.on_overflow()
+                    return
+                self._not_full.wait(0.1)
+            self._chunks.append(token)
+            self._nbytes += len(token.encode())
+            self.puts += 1
+            now = time.monotonic()
+            wake = not self._wake_pending and (self._nbytes >= self.flush_bytes or
+                                               now - self._last_wake >= self.flush_interval)
+            if wake:
+                self._wake_pending = True
+                self._last_wake = now
+        if wake:
+            self._wake()
+
+    def close(self):
+        """Mark the end of the stream. Called from the engine thread"""
+        with self._lock:
+            self._closed = True
+            self._wake_pending = True
+        self._wake()
+
+    def _wake(self):
+        self.wakeups += 1
+        self.loop.call_soon_threadsafe(self._event.set)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    async def get(self) -> Optional[str]:
+        """Wait for the pending tokens and return them joined.
+
+        Returns :code:`None` once the stream is closed and drained.
+
+        """
+        while True:
+            with self._lock:
+                if self._chunks:
+                    chunk = "".join(self._chunks)
+                    self._chunks.clear()
+                    self._nbytes = 0
+                    self._wake_pending = False
+                    self._not_full.notify_all()
+                    return chunk
+                if self._closed:
+                    return None
+                self._wake_pending = False
+                # Tokens put within flush_interval of the last wakeup do not wake
+                # the loop, so wait at most until that interval has passed
+                timeout = self._last_wake + self.flush_interval - time.monotonic()
+            self._event.clear()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self._event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await self._event.wait()
+
+
+class TokenCollector:
+    """Accumulates the tokens of a response that is not streamed.
+
+    Has the producer side of :class:`TokenBuffer`, so the same token callback
+    serves both. Memory grows with the actual response rather than being
+    allocated for the longest possible one.
+
+    """
+    def __init__(self):
+        self._chunks: list[str] = []
+        self.nbytes = 0
+        self.closed = False
+
+    def put(self, token: str):
+        self._chunks.append(token)
+        self.nbytes += len(token.encode())
+
+    def close(self):
+        self.closed = True
+
+    def text(self) -> str:
+        return "".join(self._chunks)
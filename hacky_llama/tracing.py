@@ -0,0 +1,154 @@
+from typing import Optional, Protocol
+from contextlib import contextmanager
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """A phase of a request, with wall clock times in seconds
+
+    Args:
+        name: Name of the phase, a token as Server-Timing requires
+        start: Start time
+        end: End time, :code:`None` while it runs
+
+
+    """
+    def __init__(self, name: str, start: float, end: Optional[float] = None):
+        self.name = name
+        self.start = start
+        self.end = end
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.time()) - self.start
+
+
+class Exporter(Protocol):
+    def export(self, trace: "Trace"): ...
+
+
+class Trace:
+    """The spans of the phases of one request.
+
+    Spans are cheap enough to always record. They are rendered as a
+    :code:`Server-Timing` header with :meth:`server_timing`, as a dict with
+    :meth:`to_dict` and sent to the :code:`exporter` when the request is
+    :meth:`finish` ed.
+
+    Args:
+        name: Name of the request, e.g. its endpoint
+        exporter: Optional exporter, e.g. :class:`OTelExporter`
+
+
+    """
+    def __init__(self, name: str, exporter: Optional[Exporter] = None):
+        self.name = name
+        self.exporter = exporter
+        self.start = time.time()
+        self.end: Optional[float] = None
+        self.spans: list[Span] = []
+
+    @contextmanager
+    def span(self, name: str):
+        """Record the code in the block as span :code:`name`"""
+        span = self.add(name, time.time())
+        try:
+            yield span
+        finally:
+            span.end = time.time()
+
+    def add(self, name: str, start: float, end: Optional[float] = None) -> Span:
+        """Record a span measured elsewhere, e.g. by :class:`GemmaInterface`"""
+        span = Span(name, start, end)
+        self.spans.append(span)
+        return span
+
+    def accumulate(self, name: str, seconds: float):
+        """Add :code:`seconds` to span :code:`name`, for work done in many small steps"""
+        for span in self.spans:
+            if span.name == name:
+                span.end += seconds
+                return
+        now = time.time()
+        self.add(name, now - seconds, now)
+
+    def server_timing(self, prefix: str = "") -> str:
+        """Value of a :code:`Server-Timing` header with the spans that have ended
+
+        Args:
+            prefix: Prefix of the names, to tell apart the spans of a proxy
+                    from those of its backend in the same header
+
+
+        """
+        metrics = [f"{prefix}{s.name};dur={s.duration * 1000:.1f}"
+                   for s in self.spans if s.end is not None]
+        if self.end is not None:
+            metrics.append(f"{prefix}total;dur={(self.end - self.start) * 1000:.1f}")
+        return ", ".join(metrics)
+
+    def to_dict(self) -> dict:
+        return {"total_ms": ((self.end or time.time()) - self.start) * 1000,
+                "spans": [{"name": s.name, "start_ms": (s.start - self.start) * 1000,
+                           "duration_ms": s.duration * 1000} for s in self.spans]}
+
+    def finish(self):
+        """End the trace and export it"""
+        if self.end is not None:
+            return
+        self.end = time.time()
+        if self.exporter is not None:
+            try:
+                self.exporter.export(self)
+            except Exception as e:
+                logger.warning(f"Could not export trace {self.name}: {e}")
+
+
+class OTelExporter:
+    """Export traces as OpenTelemetry spans, if :code:`opentelemetry` is installed.
+
+    Spans go to the tracer provider configured for the process, e.g. by
+    :code:`opentelemetry-instrument` and the :code:`OTEL_*` environment
+    variables.
+
+    Args:
+        service_name: Name of the tracer
+
+
+    """
+    def __init__(self, service_name: str = "hacky_llama"):
+        from opentelemetry import trace as otel_trace
+        self.otel_trace = otel_trace
+        self.tracer = otel_trace.get_tracer(service_name)
+
+    def export(self, trace: Trace):
+        def ns(t: float) -> int:
+            return int(t * 1e9)
+        root = self.tracer.start_span(trace.name, start_time=ns(trace.start))
+        context = self.otel_trace.set_span_in_context(root)
+        for span in trace.spans:
+            end = span.end if span.end is not None else trace.end
+            self.tracer.start_span(span.name, context=context,
+                                   start_time=ns(span.start)).end(end_time=ns(end))
+        root.end(end_time=ns(trace.end))
+
+
+def make_exporter(name: Optional[str], service_name: str = "hacky_llama") -> Optional[Exporter]:
+    """The exporter configured as :code:`name`, only "otel" for now.
+
+    Tracing stays local, in headers and responses, if :code:`name` is empty
+    or the exporter's dependencies are missing.
+    """
+    if not name:
+        return None
+    if name != "otel":
+        raise ValueError(f"Unknown trace exporter {name}")
+    try:
+        return OTelExporter(service_name)
+    except ImportError:
+        logger.warning("opentelemetry is not installed, traces will not be exported")
+        return None
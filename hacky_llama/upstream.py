@@ -0,0 +1,341 @@
+from typing import Optional, Callable, AsyncIterator
+import json
+import logging
+import re
+import time
+
+import anyio
+import httpx
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import StreamingResponse, JSONResponse, Response
+
+from .tracing import Trace
+
+
+logger = logging.getLogger(__name__)
+
+
+# Optional manager settings for the connections to the workers
+UPSTREAM_OPTIONS = ("upstream_max_connections", "upstream_max_keepalive",
+                    "upstream_keepalive_expiry", "upstream_connect_timeout",
+                    "upstream_control_timeout")
+
+# Endpoints that generate and so may take arbitrarily long
+GENERATION_ENDPOINTS = {"stream", "completions", "chat/completions", "v1/chat/completions"}
+
+# Headers that apply to a single connection and are not forwarded. The
+# request's content-length is forwarded, as its body is passed on untouched
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+                      "te", "trailer", "transfer-encoding", "upgrade", "host"}
+
+
+class UpstreamPool:
+    """Long lived pooled :class:`httpx.AsyncClient` per backend.
+
+    Connections to each worker are kept alive and reused, so proxying a request
+    does not pay for a new TCP connection. Clients for the backends known
+    up front are created by :meth:`start`, others on first use. All of them are
+    closed by :meth:`aclose`.
+
+    Generation requests have no read timeout, control requests like
+    :code:`/is_generating` time out after :code:`control_timeout` seconds.
+
+    Args:
+        max_connections: Maximum connections per backend
+        max_keepalive: Maximum idle connections kept per backend
+        keepalive_expiry: Seconds after which idle connections are closed
+        connect_timeout: Seconds to wait for a connection
+        control_timeout: Timeout for control requests
+        transport: Optional transport for all clients, e.g. an
+                   :class:`httpx.ASGITransport` to serve a worker in process
+
+
+    """
+    def __init__(self, max_connections: int = 64, max_keepalive: int = 16,
+                 keepalive_expiry: float = 30.0, connect_timeout: float = 5.0,
+                 control_timeout: float = 2.0,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive,
+                                   keepalive_expiry=keepalive_expiry)
+        self.timeout = httpx.Timeout(None, connect=connect_timeout)
+        self.control_timeout = control_timeout
+        self.transport = transport
+        self._clients: dict[str, httpx.AsyncClient] = {}
+
+    @classmethod
+    def from_config(cls, config: dict) -> "UpstreamPool":
+        """Pool with the :data:`UPSTREAM_OPTIONS` present in :code:`config`"""
+        return cls(**{k.removeprefix("upstream_"): config[k]
+                      for k in UPSTREAM_OPTIONS if config.get(k) is not None})
+
+    def client(self, base_url: str) -> httpx.AsyncClient:
+        """The client for the backend at :code:`base_url`
+
+        Args:
+            base_url: Scheme, host and port of the backend
+
+
+        """
+        if (client := self._clients.get(base_url)) is None or client.is_closed:
+            client = self._clients[base_url] = httpx.AsyncClient(
+                base_url=base_url, limits=self.limits, timeout=self.timeout,
+                transport=self.transport)
+        return client
+
+    async def start(self, base_urls: list[str]):
+        for url in base_urls:
+            self.client(url)
+
+    async def close(self, base_url: str):
+        """Close the client for the backend at :code:`base_url`, e.g. once it is stopped"""
+        if (client := self._clients.pop(base_url, None)) is not None:
+            await client.aclose()
+
+    async def aclose(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+    def stats(self) -> dict:
+        return {"backends": list(self._clients),
+                "max_connections": self.limits.max_connections,
+                "max_keepalive": self.limits.max_keepalive_connections}
+
+
+async def peek_body(request: Request, limit: int = 4096) -> tuple[bytes, AsyncIterator[bytes]]:
+    """Read ahead the first :code:`limit` bytes of a request body, or a little more.
+
+    Returns:
+        The bytes read and an iterator over the whole body, including them
+
+
+    """
+    stream = request.stream()
+    head: list[bytes] = []
+    size = 0
+    async for chunk in stream:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= limit:
+            break
+
+    async def body():
+        for chunk in head:
+            yield chunk
+        async for chunk in stream:
+            yield chunk
+    return b"".join(head), body()
+
+
+async def peek_field(request: Request, field: str, limit: int = 4096,
+                     max_bytes: int = 1 << 20
+                     ) -> tuple[Optional[str], bytes, AsyncIterator[bytes]]:
+    """Read ahead of a request body until the string :code:`field` is found.
+
+    Clients may send the field after long messages or images, so reading
+    goes on past :code:`limit` until the field is found with
+    :func:`scan_field` or :code:`max_bytes` are read. A body read whole is
+    parsed instead, and then its top level field is returned, if any. The
+    value is :code:`None` if the field is not found either way.
+
+    Args:
+        request: The request
+        field: Name of the field
+        limit: Bytes to read before looking for the field
+        max_bytes: Most bytes to read ahead
+
+
+    Returns:
+        The value of the field, the bytes read and an iterator over the whole body
+
+
+    """
+    stream = request.stream()
+    head: list[bytes] = []
+    size = 0
+    value = None
+    complete = True
+    async for chunk in stream:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= limit:
+            if (value := scan_field(b"".join(head), field)) is not None:
+                complete = False
+                break
+            if size >= max_bytes:
+                complete = False
+                break
+            # Doubled, so that the bytes read are scanned about twice in all
+            limit = min(2 * size, max_bytes)
+    data = b"".join(head)
+    if complete:
+        try:
+            parsed = json.loads(data)
+        except ValueError:
+            value = scan_field(data, field)
+        else:
+            value = parsed.get(field) if isinstance(parsed, dict) else None
+            value = value if isinstance(value, str) else None
+
+    async def body():
+        yield data
+        if not complete:
+            async for chunk in stream:
+                yield chunk
+    return value, data, body()
+
+
+def scan_field(head: bytes, field: str) -> Optional[str]:
+    """Value of a string :code:`field` in the start of a JSON body, without parsing it.
+
+    Only a hint, the first occurrence is returned even if it is nested.
+
+    Args:
+        head: Start of the body
+        field: Name of the field
+
+
+    """
+    pattern = rb'"' + re.escape(field.encode()) + rb'"\s*:\s*"((?:[^"\\]|\\.)*)"'
+    if match := re.search(pattern, head):
+        return match.group(1).decode(errors="replace")
+    return None
+
+
+def leading_messages(head: bytes, max_bytes: int = 1024) -> Optional[bytes]:
+    """Raw JSON of the messages up to the first user message, without parsing the body.
+
+    They stay the same over the turns of a conversation, so their hash can
+    identify it. If the first user message does not end within :code:`head`,
+    the first :code:`max_bytes` of the messages are returned instead.
+
+    Args:
+        head: Start of a chat completions body
+        max_bytes: Size to cut long messages at
+
+
+    """
+    if (match := re.search(rb'"messages"\s*:\s*\[', head)) is None:
+        return None
+    start = match.end()
+    depth = 0
+    element_start = start
+    # Strings, which may be cut off by the end of head, are skipped whole
+    for token in re.finditer(rb'"(?:[^"\\]|\\.)*(?:"|\Z)|[{}\[\]]', head[start:]):
+        c = token.group()
+        i = start + token.start()
+        if c in (b"{", b"["):
+            if depth == 0:
+                element_start = i
+            depth += 1
+        elif c in (b"}", b"]"):
+            if depth == 0:
+                break
+            depth -= 1
+            if depth == 0 and scan_field(head[element_start:i + 1], "role") == "user":
+                return head[start:i + 1]
+    if len(head) - start >= max_bytes:
+        return head[start:start + max_bytes]
+    return None
+
+
+def forward_headers(headers) -> list[tuple[bytes, bytes]]:
+    return [(k, v) for k, v in headers.raw if k.decode().lower() not in HOP_BY_HOP_HEADERS]
+
+
+async def relay(client: httpx.AsyncClient, request: Request, url: str,
+                body: Optional[AsyncIterator[bytes]] = None,
+                timeout: Optional[float] = None,
+                on_abandon: Optional[Callable[[], None]] = None,
+                on_close: Optional[Callable[[bool], None]] = None,
+                on_response: Optional[Callable[[int, float], None]] = None,
+                trace: Optional[Trace] = None) -> Response:
+    """Relay :code:`request` to :code:`url` as it is and its response back.
+
+    Neither body is parsed or re-encoded. The upstream status and headers are
+    relayed, except for hop-by-hop headers, and the response is streamed as
+    it arrives.
+
+    Args:
+        client: Client for the backend
+        request: The request to relay
+        url: URL to relay it to
+        body: Body to send instead of reading it from :code:`request`,
+              e.g. from :func:`peek_body`
+        timeout: Read timeout, :code:`None` for none
+        on_abandon: Optional callback if the client goes away before the end
+        on_close: Optional callback once the exchange is over, with whether the
+                  backend failed
+        on_response: Optional callback with the status, 502 if the backend
+                     could not be reached, and the seconds until the backend
+                     responded
+        trace: Optional :class:`Trace` of the request. The wait for the
+               backend is added as the "upstream" span, the spans are
+               appended to the :code:`Server-Timing` header with a "proxy_"
+               prefix and the trace is finished once the exchange is over
+
+
+    """
+    upstream_request = client.build_request(
+        request.method, url, params=request.query_params,
+        headers=forward_headers(request.headers),
+        content=body if body is not None else request.stream(),
+        timeout=httpx.Timeout(timeout, connect=client.timeout.connect))
+    # Latency on the monotonic clock, the span on the wall clock of the trace
+    start = time.monotonic()
+    wall_start = time.time()
+    try:
+        response = await client.send(upstream_request, stream=True)
+    except httpx.HTTPError as e:
+        logger.error(f"Error proxying request to {url}: {e}")
+        if on_response is not None:
+            on_response(502, time.monotonic() - start)
+        if on_close is not None:
+            on_close(True)
+        failed = JSONResponse({"error": f"Failed to proxy request: {e}"}, status_code=502)
+        if trace is not None:
+            trace.add("upstream", wall_start, time.time())
+            trace.finish()
+            failed.headers.append("Server-Timing", trace.server_timing("proxy_"))
+        return failed
+    if on_response is not None:
+        on_response(response.status_code, time.monotonic() - start)
+    if trace is not None:
+        trace.add("upstream", wall_start, time.time())
+    closed = False
+
+    async def close(error: bool = False):
+        nonlocal closed
+        if closed:
+            return
+        closed = True
+        with anyio.CancelScope(shield=True):
+            await response.aclose()
+        if on_close is not None:
+            on_close(error)
+        if trace is not None:
+            trace.finish()
+
+    async def content():
+        finished = False
+        error = False
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+            finished = True
+        except httpx.HTTPError:
+            error = True
+            raise
+        finally:
+            await close(error)
+            if not finished and not error and on_abandon is not None:
+                on_abandon()
+    # The background task closes the response should it never be iterated
+    relayed = StreamingResponse(content(), status_code=response.status_code,
+                                background=BackgroundTask(close))
+    relayed.raw_headers = forward_headers(response.headers)
+    if trace is not None:
+        relayed.raw_headers.append((b"server-timing", trace.server_timing("proxy_").encode()))
+    return relayed
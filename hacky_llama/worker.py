@@ -0,0 +1,382 @@
+from typing import Optional, Callable
+from pathlib import Path
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import time
+
+import httpx
+
+from .logs import LogBuffer
+
+
+logger = logging.getLogger(__name__)
+
+
+# Optional worker (main.py) settings forwarded from the manager config when present
+WORKER_OPTIONS = ("max_queue_depth", "max_queue_wait", "max_sessions", "max_session_bytes",
+                  "state_cache_dir", "state_cache_bytes", "token_flush_interval",
+                  "token_flush_bytes", "token_buffer_bytes", "token_overflow",
+                  "image_cache_bytes", "image_max_side", "image_format", "image_workers",
+                  "image_root", "trace_exporter")
+
+# Request that makes a worker generate a token before it gets traffic
+WARMUP_REQUEST = {"messages": [{"role": "user", "content": "Hi"}], "max_tokens": 1,
+                  "session_id": "warmup"}
+
+
+def worker_option_args(config) -> list[str]:
+    """Command line args for the optional worker settings present in :code:`config`
+
+    Args:
+        config: Model config
+
+
+    """
+    args = []
+    for k in WORKER_OPTIONS:
+        if config.get(k) is not None:
+            args.extend([f"--{k}", str(config[k])])
+    return args
+
+
+class WorkerUnavailable(Exception):
+    """The worker did not become ready for a request in time"""
+    status_code = 503
+
+    def __init__(self, message: str, retry_after: int = 5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_gemma(config) -> bool:
+    """Whether :code:`config` is served by the gemma worker (main.py) or by llama-server"""
+    if engine := config.get("engine"):
+        return engine == "gemma"
+    return "gemma-3" in config["model_path"].lower()
+
+
+class Worker:
+    """A model server subprocess on a port, the gemma worker or llama-server.
+
+    Tracks the requests proxied to it, so that it can be drained before it is
+    stopped.
+
+    Its :code:`state` is polled from its :code:`/health` by :meth:`monitor`.
+    It is "starting" until the server answers, "loading" until the model has
+    loaded, and then "ready". It is "failed" if the process exits, the model
+    does not load or a ready worker misses :code:`health_max_misses` polls in
+    a row, and "stopped" once stopped. A failed worker whose process runs is
+    still polled, and is ready again once it answers. One whose process
+    exited is up to its manager to restart, see :meth:`restart_delay`. Requests that arrive
+    before it is ready are held by :meth:`hold`.
+
+    Its output is read by :meth:`pump` into :code:`log`.
+
+    Args:
+        config: Model config
+        port: Port for the worker to listen on
+        python: Python to run the gemma worker with
+        gpu_id: Optional GPU to pin the worker to
+
+
+    """
+    def __init__(self, config: dict, port: int, python: str, gpu_id: Optional[int] = None):
+        self.config = config
+        self.port = port
+        self.python = python
+        self.gpu_id = gpu_id
+        self.url = f"http://localhost:{port}"
+        self.process: Optional[subprocess.Popen] = None
+        self.in_flight = 0
+        self.started_at: Optional[float] = None
+        self.ready_at: Optional[float] = None
+        self.failed_at: Optional[float] = None
+        self.state = "stopped"
+        self._state_changed = asyncio.Event()
+        self.held = 0
+        self.misses = 0
+        self.max_misses = config.get("health_max_misses", 3)
+        self.crashes = 0
+        self.on_state: Optional[Callable[[str], None]] = None
+        self.log = LogBuffer(str(port), config.get("log_lines", 2000))
+
+    def set_state(self, state: str):
+        if state == self.state:
+            return
+        logger.info(f"Worker on port {self.port} is {state}")
+        self.state = state
+        if state == "ready":
+            self.ready_at = time.time()
+            self.failed_at = None
+            self.crashes = 0
+        elif state == "failed":
+            self.failed_at = time.time()
+        self._state_changed.set()
+        self._state_changed = asyncio.Event()
+        if self.on_state is not None:
+            self.on_state(state)
+
+    def command(self) -> tuple[list[str], Optional[dict]]:
+        """Command line and environment to start the worker with"""
+        config = self.config
+        env = None
+        if is_gemma(config):
+            args = ["--model_root", config["model_root"],
+                    "--model_path", config["model_path"],
+                    "--lib_path", config["lib_path"],
+                    "--mmproj_path", config["mmproj_path"],
+                    "--n_predict", str(config["n_predict"]),
+                    "--port", str(self.port),
+                    "--overrides", json.dumps(config["overrides"]),
+                    *worker_option_args(config)]
+            if self.gpu_id is not None and "device" not in config["overrides"]:
+                env = {**os.environ, "CUDA_VISIBLE_DEVICES": str(self.gpu_id)}
+            return [self.python, "-u", "main.py", *args], env
+        llama_server_path = Path(config["lib_path"]).parent.joinpath("llama-server")
+        args = ["--model", str(Path(config["model_root"]).joinpath(config["model_path"])),
+                "--n-predict", str(config["n_predict"]),
+                "--port", str(self.port),
+                "--log-file", "~/logs/llama.log"]
+        for k, v in config["overrides"].items():
+            if v is True:
+                args.append(f"--{k.replace('_', '-')}")
+            else:
+                args.extend([f"--{k.replace('_', '-')}", str(v)])
+        if self.gpu_id is not None and "--device" not in args:
+            args.extend(["--device", f"CUDA{self.gpu_id}"])
+        return [str(llama_server_path), *args], env
+
+    def start(self):
+        command, env = self.command()
+        logger.info(f"Starting worker on port {self.port}: {' '.join(command)}")
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                        env=env)
+        self.started_at = time.time()
+        self.misses = 0
+        self.log.reopen()
+        self.set_state("starting")
+
+    async def pump(self, limit: int = 1 << 20):
+        """Read the worker's output into :code:`log` until it exits.
+
+        The pipes are read by the event loop, so a quiet or dead worker costs
+        nothing. Lines longer than :code:`limit` are dropped.
+        """
+        if (process := self.process) is None:
+            return
+        loop = asyncio.get_running_loop()
+
+        async def read(pipe, stream: str):
+            reader = asyncio.StreamReader(limit=limit)
+            transport, _ = await loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader), pipe)
+            try:
+                while True:
+                    try:
+                        line = await reader.readline()
+                    except ValueError:
+                        self.log.append(stream, f"[line longer than {limit} bytes dropped]")
+                        continue
+                    if not line:
+                        break
+                    self.log.append(stream, line.decode(errors="replace").rstrip())
+            finally:
+                transport.close()
+        try:
+            await asyncio.gather(read(process.stdout, "stdout"), read(process.stderr, "stderr"))
+        finally:
+            self.log.close()
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def exited(self) -> bool:
+        """Whether the process has exited without being stopped"""
+        return self.process is not None and self.process.poll() is not None
+
+    def restart_delay(self) -> float:
+        """Seconds to wait before restarting the exited process
+
+        Doubles with each restart that exits before it is ready, from
+        :code:`restart_delay` in the config up to a minute.
+        """
+        delay = min(self.config.get("restart_delay", 1.0) * 2 ** self.crashes, 60.0)
+        self.crashes += 1
+        return delay
+
+    def acquire(self):
+        self.in_flight += 1
+
+    def release(self, error: bool = False):
+        self.in_flight -= 1
+
+    async def check(self, client: httpx.AsyncClient, timeout: float = 2.0):
+        """Update :code:`state` from the worker's health
+
+        Args:
+            client: Client for the worker
+            timeout: Timeout of the health request
+
+
+        """
+        if self.state == "stopped":
+            return
+        if self.exited():
+            if self.state != "failed":
+                logger.error(f"Worker on port {self.port} exited with "
+                             f"{self.process.returncode}")  # type: ignore
+                self.set_state("failed")
+            return
+        try:
+            response = await client.get("/health", timeout=timeout)
+        except httpx.HTTPError as e:
+            # Not listening yet, or busy
+            self.missed(str(e) or type(e).__name__)
+            return
+        if response.status_code == 200:
+            self.misses = 0
+            self.set_state("ready")
+        elif response.status_code == 503:
+            try:
+                failed = response.json().get("status") == "error"
+            except ValueError:
+                failed = False
+            self.misses = 0
+            self.set_state("failed" if failed else "loading")
+        else:
+            self.missed(f"status {response.status_code}")
+
+    def missed(self, reason: str):
+        """Count a failed health poll. Only a ready worker fails, after :code:`max_misses`"""
+        if self.state != "ready":
+            return
+        self.misses += 1
+        logger.warning(f"Worker on port {self.port} missed health poll {self.misses} of "
+                       f"{self.max_misses}: {reason}")
+        if self.misses >= self.max_misses:
+            self.set_state("failed")
+
+    async def monitor(self, client: httpx.AsyncClient, interval: float = 0.5,
+                      ready_interval: float = 5.0):
+        """Poll the worker's health until it is stopped or its process exits
+
+        Args:
+            client: Client for the worker
+            interval: Seconds between polls until it is ready
+            ready_interval: Seconds between polls once it is ready
+
+
+        """
+        while self.state != "stopped":
+            await self.check(client, timeout=max(interval * 4, 1.0))
+            if self.exited():
+                return
+            await asyncio.sleep(ready_interval if self.state == "ready" else interval)
+
+    async def wait_state(self, timeout: float) -> bool:
+        """Wait until the worker is ready, failed or stopped. Returns whether it is ready"""
+        deadline = time.monotonic() + timeout
+        while self.state not in {"ready", "failed", "stopped"}:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._state_changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return self.state == "ready"
+
+    async def hold(self, timeout: float = 120.0, max_held: int = 64):
+        """Hold a request until the worker is ready.
+
+        Args:
+            timeout: Maximum seconds to hold it
+            max_held: Maximum number of requests held at a time
+
+
+        Raises:
+            WorkerUnavailable: If the worker is not ready in time, failed, or too
+                               many requests are held already
+
+        """
+        if self.state == "ready":
+            return
+        if self.state in {"failed", "stopped"}:
+            raise WorkerUnavailable(f"Worker for {self.config['model_path']} is {self.state}",
+                                    retry_after=30)
+        if self.held >= max_held:
+            raise WorkerUnavailable(f"Too many requests waiting for {self.config['model_path']}")
+        self.held += 1
+        try:
+            if not await self.wait_state(timeout):
+                raise WorkerUnavailable(f"Worker for {self.config['model_path']} is {self.state}")
+        finally:
+            self.held -= 1
+
+    async def wait_ready(self, client: httpx.AsyncClient, timeout: float = 600.0) -> bool:
+        """Wait until the worker is ready and has generated a token.
+
+        :meth:`monitor` must be running.
+
+        Args:
+            client: Client for the worker
+            timeout: Maximum seconds to wait
+
+
+        """
+        deadline = time.monotonic() + timeout
+        if not await self.wait_state(timeout):
+            return False
+        try:
+            response = await client.post("/v1/chat/completions", json=WARMUP_REQUEST,
+                                         timeout=max(deadline - time.monotonic(), 1.0))
+        except httpx.HTTPError as e:
+            logger.error(f"Warmup of worker on port {self.port} failed: {e}")
+            return False
+        return response.status_code == 200
+
+    async def drain(self, timeout: float = 600.0, interval: float = 0.1) -> bool:
+        """Wait for the requests in flight to finish
+
+        Args:
+            timeout: Maximum seconds to wait
+            interval: Seconds between checks
+
+
+        """
+        deadline = time.monotonic() + timeout
+        while self.in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(interval)
+        return not self.in_flight
+
+    def stop(self, timeout: float = 30.0):
+        """Terminate the worker, and kill it if it does not exit within :code:`timeout`"""
+        self.set_state("stopped")
+        if self.process is None:
+            return
+        logger.info(f"Stopping worker on port {self.port}")
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    async def astop(self, timeout: float = 30.0):
+        """:meth:`stop` without blocking the event loop"""
+        self.set_state("stopped")
+        await asyncio.to_thread(self.stop, timeout)
+
+    def stats(self) -> dict:
+        return {"port": self.port,
+                "model_path": self.config["model_path"],
+                "state": self.state,
+                "alive": self.alive(),
+                "in_flight": self.in_flight,
+                "held": self.held,
+                "started_at": self.started_at,
+                "ready_at": self.ready_at}
@@ -17,6 +17,38 @@ if __name__ == "__main__":
     parser.add_argument("--n_predict", type=int)
     parser.add_argument("--overrides")
     parser.add_argument("--port", type=int)
+    parser.add_argument("--max_queue_depth", type=int, default=16,
+                        help="Maximum number of requests waiting for the model")
+    parser.add_argument("--max_queue_wait", type=float, default=60.0,
+                        help="Maximum seconds a request may wait in the queue")
+    parser.add_argument("--max_sessions", type=int, default=8,
+                        help="Maximum number of conversations with a saved KV state")
+    parser.add_argument("--max_session_bytes", type=int, default=4 << 30,
+                        help="Maximum total size of the saved KV states")
+    parser.add_argument("--state_cache_dir",
+                        help="Directory to persist KV state snapshots across restarts")
+    parser.add_argument("--state_cache_bytes", type=int, default=16 << 30,
+                        help="Maximum total size of the KV state snapshots on disk")
+    parser.add_argument("--token_flush_interval", type=float, default=0.01,
+                        help="Minimum seconds between deliveries of streamed tokens")
+    parser.add_argument("--token_flush_bytes", type=int, default=512,
+                        help="Pending size at which streamed tokens are delivered at once")
+    parser.add_argument("--token_buffer_bytes", type=int, default=1 << 20,
+                        help="Maximum size of undelivered tokens per stream")
+    parser.add_argument("--token_overflow", choices=["block", "interrupt"], default="block",
+                        help="Whether to pause or stop generation for a slow client")
+    parser.add_argument("--image_cache_bytes", type=int, default=256 << 20,
+                        help="Maximum total size of the decoded images kept in memory")
+    parser.add_argument("--image_max_side", type=int,
+                        help="Downscale images larger than this many pixels on a side")
+    parser.add_argument("--image_format", default="PNG", choices=["PNG", "JPEG"],
+                        help="Format to re-encode downscaled images as")
+    parser.add_argument("--image_workers", type=int, default=4,
+                        help="Number of threads to preprocess images with")
+    parser.add_argument("--image_root",
+                        help="Directory requests may refer to local images in by path")
+    parser.add_argument("--trace_exporter", choices=["otel"],
+                        help="Export the traces of requests, with OpenTelemetry if installed")
     args = parser.parse_args()
 
     model_root = args.__dict__.pop("model_root")
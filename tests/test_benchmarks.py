@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+from hacky_llama.fake_engine import FakeGemmaLib
+from benchmarks.load import Workload, percentiles, main
+
+
+def test_workload_and_percentiles():
+    workload = Workload(prompt_words=(4, 8), output_tokens=(2, 3), image_ratio=0.5, image_side=8)
+    a, b = workload.requests(8, "a"), workload.requests(8, "b")
+    assert [r["max_tokens"] for r in a] == [r["max_tokens"] for r in b]
+    assert {r["max_tokens"] for r in a} <= {2, 3}
+    assert a[0]["session_id"] == "a-0" and b[0]["session_id"] == "b-0"
+    assert 0 < sum(isinstance(r["messages"][0]["content"], dict) for r in a) < 8
+    assert percentiles([]) is None
+    assert percentiles([0.001, 0.002, 0.003, 0.004, 0.005]) == pytest.approx(
+        {"mean": 3, "p50": 3, "p95": 4.8, "p99": 4.96, "max": 5})
+    assert FakeGemmaLib(reply="a b", fill=True).tokens(5) == ["a", " b", " a", " b", " a"]
+
+
+def test_load_sweep_over_fake_stack(tmp_path):
+    main(["--concurrency", "1,2", "--requests", "4", "--prompt_words", "4:8",
+          "--output_tokens", "3:5", "--image_ratio", "0.5", "--image_side", "16",
+          "--tokens_per_second", "1000", "--out", str(tmp_path / "report.json")])
+    report = json.loads((tmp_path / "report.json").read_text())
+    assert [level["concurrency"] for level in report["levels"]] == [1, 2]
+    for level in report["levels"]:
+        assert level["ok"] == 4 and level["errors"] == {}
+        assert level["ttft_ms"]["p50"] <= level["latency_ms"]["p50"]
+        assert level["itl_ms"] is not None and level["requests_per_second"] > 0
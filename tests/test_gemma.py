@@ -40,12 +40,11 @@ async def _stream(iface):
     iface.loop = loop
 
     async def receive_tokens(iface):
-        while True:
-            token = await iface.q.get()
+        async for token in iface.receive_tokens():
             print(token, end="")
 
-    asyncio.create_task(receive_tokens(iface))
     eval_message(iface, 1024, True, stop_strings=["```"])
+    asyncio.create_task(receive_tokens(iface))
     await asyncio.sleep(2)
 
 
@@ -4,10 +4,13 @@ import asyncio
 import yaml
 import json
 import sys
-from threading import Thread
+import time
+import httpx
+from threading import Thread, Event
 
 from hacky_llama import gemma_service
-from hacky_llama.gemma_service import create_app, chat
+from hacky_llama.gemma_service import create_app, chat, stream_chat, complete_chat
+from hacky_llama.gemma_iface import GemmaInterface
 
 
 from starlette.applications import Starlette
@@ -15,7 +18,8 @@ from starlette.routing import Route
 from starlette.testclient import TestClient
 import uvicorn
 
-from util import MockLlamaInterface, fake_process_chat
+from util import (MockLlamaInterface, FakeGemmaLib, FakeGemmaLibWithState, fake_process_chat,
+                  loading_worker_app, worker_app)
 
 
 port = int(os.environ.get("LLAMA_TEST_PORT") or 8001)
@@ -36,6 +40,188 @@ async def test_stream_with_injected_mock():
         assert "is" in content
 
 
+@pytest.mark.asyncio
+async def test_prefix_reuse_evaluates_only_new_messages():
+    lib = FakeGemmaLib(reply="Hi there")
+    iface = GemmaInterface(None, "model.gguf", lib=lib)
+    first = [{"role": "user", "content": "Hello"}]
+    chunks = [c async for c in stream_chat(iface, first)]
+    assert "there" in "".join(chunks)
+    assert lib.evaluated[-1] == (first, True)
+
+    second = [*first, {"role": "assistant", "content": "Hi there"},
+              {"role": "user", "content": "How are you?"}]
+    _ = [c async for c in stream_chat(iface, second)]
+    assert lib.evaluated[-1] == ([second[-1]], False)
+    assert iface.cached_messages == 2
+    assert lib.resets == 1
+
+    third = [*second, {"role": "assistant", "content": "Hi there"},
+             {"role": "user", "content": "Bye"}]
+    assert complete_chat(iface, third) == "Hi there"
+    assert lib.evaluated[-1] == ([third[-1]], False)
+
+
+@pytest.mark.asyncio
+async def test_prefix_reset_on_divergence():
+    lib = FakeGemmaLib(reply="Hi there")
+    iface = GemmaInterface(None, "model.gguf", lib=lib)
+    first = [{"role": "user", "content": "Hello"}]
+    complete_chat(iface, first)
+    edited = [*first, {"role": "assistant", "content": "Something else"},
+              {"role": "user", "content": "How are you?"}]
+    complete_chat(iface, edited)
+    assert lib.evaluated[-1] == (edited, True)
+    assert lib.resets == 2
+    complete_chat(iface, [*edited, {"role": "assistant", "content": "Hi there"},
+                          {"role": "user", "content": "Again"}], reset=True)
+    assert lib.evaluated[-1][1] is True
+    assert lib.resets == 3
+
+
+def test_collect_honors_max_tokens_and_split_characters():
+    lib = FakeGemmaLib(reply=" ".join(["word"] * 50))
+    iface = GemmaInterface(None, "model.gguf", lib=lib, n_predict=20)
+    assert complete_chat(iface, [{"role": "user", "content": "Hi"}]) == " ".join(["word"] * 20)
+    assert complete_chat(iface, [{"role": "user", "content": "Hi"}], reset=True,
+                         max_tokens=3) == "word word word"
+    assert lib.predicted_n == 3
+
+    # Multi byte characters split across tokens
+    euro = "\u20ac".encode()
+    lib.tokens = lambda: [euro[:1], euro[1:] + b" ok", euro[:2]]
+    lib.gemma3_static_stream_response = lambda callback, n, stops, n_stops: [
+        callback(t) for t in [*lib.tokens(), b"[EOS]"]]
+    assert complete_chat(iface, [{"role": "user", "content": "Hi"}],
+                         reset=True) == "\u20ac ok\ufffd"
+
+
+@pytest.mark.parametrize("lib_cls", [FakeGemmaLib, FakeGemmaLibWithState])
+def test_sessions_keep_their_kv_state(lib_cls):
+    lib = lib_cls(reply="Ok")
+    iface = GemmaInterface(None, "model.gguf", lib=lib, max_sessions=2)
+
+    def turn(history, session_id, text):
+        history.append({"role": "user", "content": text})
+        history.append({"role": "assistant",
+                        "content": complete_chat(iface, history, session_id=session_id)})
+
+    a, b, c = [], [], []
+    turn(a, "a", "Hello from a")
+    turn(b, "b", "Hello from b")
+    turn(a, "a", "More from a")
+    if iface.supports_state:
+        assert lib.evaluated[-1] == ([a[-2]], False)
+        assert lib.context[0]["content"] == "Hello from a"
+    else:
+        assert lib.evaluated[-1][1] is True
+    turn(c, "c", "Hello from c")
+    # b was least recently used and is evicted
+    assert "b" not in iface.sessions
+    turn(b, "b", "More from b")
+    assert lib.evaluated[-1][1] is True
+    assert iface.sessions.stats()["evictions"] >= 1
+
+
+def test_kv_state_persists_across_restarts(tmp_path):
+    history = [{"role": "user", "content": "Hello"}]
+    iface = GemmaInterface(None, "model.gguf", lib=FakeGemmaLibWithState(reply="Ok"),
+                           state_cache_dir=str(tmp_path))
+    history.append({"role": "assistant", "content": complete_chat(iface, history)})
+    iface.persist_sessions()
+    assert iface.disk_cache.stats()["snapshots"] == 1
+
+    lib = FakeGemmaLibWithState(reply="Ok")
+    restarted = GemmaInterface(None, "model.gguf", lib=lib, state_cache_dir=str(tmp_path))
+    history.append({"role": "user", "content": "Again"})
+    complete_chat(restarted, history)
+    assert lib.evaluated[-1] == ([history[-1]], False)
+    assert lib.loads == 1
+    assert lib.context[0]["content"] == "Hello"
+
+    other_model = GemmaInterface(None, "other.gguf", lib=FakeGemmaLibWithState(reply="Ok"),
+                                 state_cache_dir=str(tmp_path))
+    complete_chat(other_model, history)
+    assert other_model.lib.evaluated[-1][1] is True
+
+
+def test_kv_state_disk_budget(tmp_path):
+    iface = GemmaInterface(None, "model.gguf", lib=FakeGemmaLibWithState(reply="Ok"),
+                           max_sessions=1, state_cache_dir=str(tmp_path), state_cache_bytes=200)
+    for i in range(5):
+        complete_chat(iface, [{"role": "user", "content": f"Hello {i} " * 5}], session_id=str(i))
+    stats = iface.disk_cache.stats()
+    assert stats["saves"] == 4
+    assert stats["bytes"] <= 200
+    assert stats["evictions"] > 0
+
+
+def test_is_generating_responds_during_collect():
+    lib = FakeGemmaLib(reply=" ".join(["word"] * 100), token_delay=0.02)
+    iface = GemmaInterface(None, "model.gguf", lib=lib)
+    app = asyncio.run(create_app({}, mock_llama_interface=iface))
+    results = []
+    with TestClient(app) as client:
+        t = Thread(target=lambda: results.append(
+            client.post("/v1/chat/completions",
+                        json={"messages": [{"role": "user", "content": "Hello"}]})))
+        t.start()
+        deadline = time.time() + 5
+        while not lib.generating and time.time() < deadline:
+            time.sleep(0.005)
+        start = time.perf_counter()
+        response = client.get("/is_generating")
+        elapsed = time.perf_counter() - start
+        assert response.json()["message"] is True
+        assert elapsed < 0.05
+        assert client.get("/interrupt").status_code == 200
+        t.join(5)
+    assert results[0].status_code == 200
+    content = results[0].json()["choices"][0]["message"]["content"]
+    assert 0 < len(content.split()) < 100
+
+
+@pytest.mark.asyncio
+async def test_client_disconnect_interrupts_generation():
+    lib = FakeGemmaLib(reply=" ".join(["word"] * 500), token_delay=0.005)
+    iface = GemmaInterface(None, "model.gguf", lib=lib)
+    app = await create_app({}, mock_llama_interface=iface)
+    await app.router.startup()
+    body = json.dumps({"stream": True,
+                       "messages": [{"role": "user", "content": "Hello"}]}).encode()
+    incoming = [{"type": "http.request", "body": body, "more_body": False}]
+    disconnect = asyncio.Event()
+    sent = []
+
+    async def receive():
+        if incoming:
+            return incoming.pop(0)
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+        if len(sent) > 5:
+            disconnect.set()
+
+    scope = {"type": "http", "asgi": {"version": "3.0", "spec_version": "2.3"},
+             "http_version": "1.1", "method": "POST", "scheme": "http",
+             "path": "/v1/chat/completions", "raw_path": b"/v1/chat/completions",
+             "query_string": b"", "root_path": "", "server": ("test", 80),
+             "client": ("test", 1234), "headers": [(b"content-type", b"application/json")]}
+    await asyncio.wait_for(app(scope, receive, send), 5)
+    scheduler = app.state.scheduler
+    for _ in range(100):
+        if not scheduler.busy:
+            break
+        await asyncio.sleep(0.01)
+    assert lib.interrupted
+    assert lib.predicted_n < 500
+    assert not scheduler.busy
+    assert scheduler.stats()["abandoned"] == 1
+    assert iface.cached_prefix == []
+
+
 def run_test_server():
     config = {"lib_path": None, "model_path": None, "mmproj_path": None, "overrides": None}
 
@@ -263,3 +449,68 @@ def test_real_server():
     time.sleep(3)
     test_simple_msg(port=8001)
     # test_image_stream()
+
+
+@pytest.mark.asyncio
+async def test_health_while_model_loads(monkeypatch):
+    loaded = Event()
+    app = await loading_worker_app(monkeypatch, FakeGemmaLib(reply="Hi there"), loaded)
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app), base_url="http://worker")
+    response = await client.get("/health")
+    assert response.status_code == 503 and response.json()["status"] == "loading"
+    assert (await client.get("/is_generating")).status_code == 503
+    # Requests wait for the model in the queue
+    pending = asyncio.create_task(client.post("/v1/chat/completions", json={
+        "messages": [{"role": "user", "content": "Hello"}]}))
+    await asyncio.sleep(0.05)
+    assert not pending.done()
+    loaded.set()
+    assert (await pending).json()["choices"][0]["message"]["content"] == "Hi there"
+    response = await client.get("/health")
+    assert response.status_code == 200 and response.json()["status"] == "ready"
+    await app.router.shutdown()
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_requests_fail_at_once_if_model_does_not_load(monkeypatch):
+    loaded = Event()
+
+    def load(loop, **config):
+        loaded.wait(10)
+        raise RuntimeError("no such file")
+    monkeypatch.setattr(gemma_service, "GemmaInterface", load)
+    app = await create_app({"max_queue_wait": 30})
+    await app.router.startup()
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app), base_url="http://worker")
+    body = {"messages": [{"role": "user", "content": "Hello"}]}
+    pending = asyncio.create_task(client.post("/v1/chat/completions", json=body))
+    await asyncio.sleep(0.05)
+    loaded.set()
+    # Queued and new requests do not wait for max_queue_wait
+    for response in (await asyncio.wait_for(pending, 5),
+                     await client.post("/v1/chat/completions", json={**body, "stream": True})):
+        assert response.status_code == 503 and "no such file" in response.json()["error"]
+    assert (await client.get("/health")).json()["status"] == "error"
+    await app.router.shutdown()
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_health_served_during_streamed_prefill():
+    lib = FakeGemmaLib(reply="Done", prefill_delay=0.1)
+    app = await worker_app(lib)
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app), base_url="http://worker")
+    streamed = asyncio.create_task(client.post("/v1/chat/completions", json={
+        "messages": [{"role": "user", "content": "one two three four five"}], "stream": True}))
+    # The prompt takes half a second, on the engine thread, while health is polled
+    gaps = []
+    last = time.monotonic()
+    while not streamed.done():
+        assert (await client.get("/health")).status_code == 200
+        await asyncio.sleep(0.01)
+        gaps.append(time.monotonic() - last)
+        last = time.monotonic()
+    assert lib.evaluated and len(gaps) > 5 and max(gaps) < 0.25
+    assert "Done" in (await streamed).text
+    await client.aclose()
@@ -0,0 +1,127 @@
+import asyncio
+import base64
+import ctypes
+import json
+import mmap
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from hacky_llama.image_cache import ImageCache
+from hacky_llama.image_preprocess import ImagePreprocessor, ImageError
+from hacky_llama.image_input import resolve_image_refs
+from hacky_llama.gemma_iface import GemmaInterface
+from hacky_llama.gemma_service import complete_chat, create_app
+from starlette.testclient import TestClient
+
+from util import FakeGemmaLib
+
+
+def b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+def png(width, height, color="white") -> bytes:
+    out = BytesIO()
+    Image.new("RGB", (width, height), color).save(out, format="PNG")
+    return out.getvalue()
+
+
+def test_image_cache_lru_by_bytes():
+    cache = ImageCache(max_bytes=25)
+    a, b, c = [(ctypes.c_ubyte * 10)() for _ in range(3)]
+    cache.put("a", a)
+    cache.put("b", b)
+    assert cache.get("a") is a
+    cache.put("c", c)
+    assert cache.stats()["evictions"] == 1
+    assert cache.get("b") is None
+    assert cache.get("a") is a
+    assert cache.nbytes == 20
+
+
+def test_preprocessor_downscales_large_images():
+    small, large = png(64, 32), png(2000, 1000)
+    preprocessor = ImagePreprocessor(max_side=512, format="JPEG")
+    (small_out, small_t), (large_out, large_t) = preprocessor.process([b64(small), large])
+    assert small_out == small
+    assert large_t["width"] == 512 and large_t["height"] == 256
+    assert large_t["format"] == "JPEG"
+    assert Image.open(BytesIO(large_out)).size == (512, 256)
+    assert all(k in large_t for k in ["decode_ms", "resize_ms", "encode_ms", "bytes_in"])
+    with pytest.raises(ImageError):
+        preprocessor.process_one(b"not an image")
+    with pytest.raises(ImageError):
+        preprocessor.process_one("not base64!")
+
+
+def test_decompression_bombs_are_image_errors(monkeypatch):
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+    with pytest.raises(ImageError):
+        ImagePreprocessor().process_one(png(64, 32))
+
+
+def test_images_are_decoded_and_sent_once():
+    lib = FakeGemmaLib(reply="Ok")
+    iface = GemmaInterface(None, "model.gguf", "mmproj.gguf", lib=lib)
+    pages = [b64(png(10, 10, "red")), b64(png(10, 10, "blue"))]
+    history = [{"role": "user", "content": {"text": "Explain <__image__> <__image__>",
+                                            "images": pages}}]
+    for i in range(10):
+        history.append({"role": "assistant", "content": complete_chat(iface, history)})
+        history.append({"role": "user", "content": f"And then {i}?"})
+    assert lib.images[0] == [png(10, 10, "red"), png(10, 10, "blue")]
+    assert all(not imgs for imgs in lib.images[1:])
+    complete_chat(iface, history, reset=True)
+    assert lib.images[-1] == lib.images[0]
+    assert [t["cached"] for t in iface.image_timings] == [True, True]
+    assert iface.image_cache.stats()["misses"] == 2
+    assert iface.image_cache.stats()["hits"] == 2
+
+
+def test_local_images_are_mapped_and_confined_to_root(tmp_path):
+    root = tmp_path / "images"
+    root.mkdir()
+    (root / "page.png").write_bytes(png(10, 10, "red"))
+    (tmp_path / "secret.png").write_bytes(png(10, 10))
+    messages = [{"role": "user", "content": [{"type": "text", "text": "Read <__image__>"},
+                                             {"type": "image", "image": {"path": "page.png"}}]}]
+    ref = resolve_image_refs(messages, {}, str(root))[0]["content"][1]["image"]
+    assert isinstance(ref.data, mmap.mmap)
+    lib = FakeGemmaLib(reply="Ok")
+    iface = GemmaInterface(None, "model.gguf", "mmproj.gguf", lib=lib)
+    array = iface.prepare_images([ref, ref])[0]
+    # The library reads the mapped file itself
+    assert ctypes.addressof(array) == ctypes.addressof(ctypes.c_char.from_buffer(ref.data))
+    assert bytes(array) == png(10, 10, "red")
+    for path in ["../secret.png", str(tmp_path / "secret.png"), "missing.png"]:
+        with pytest.raises(ImageError):
+            resolve_image_refs([{"role": "user", "content": {"text": "", "images": [{"path": path}]}}],
+                               {}, str(root))
+    with pytest.raises(ImageError):
+        resolve_image_refs(messages, {}, None)
+
+
+# The uploads' temporary files are closed, not left to the garbage collector
+@pytest.mark.filterwarnings("error::ResourceWarning")
+def test_multipart_image_upload():
+    lib = FakeGemmaLib(reply="Ok")
+    iface = GemmaInterface(None, "model.gguf", "mmproj.gguf", lib=lib)
+    app = asyncio.run(create_app({}, mock_llama_interface=iface))
+    small, large = png(10, 10, "red"), png(1200, 1200, "blue")
+    payload = {"messages": [{"role": "user",
+                             "content": {"text": "Compare <__image__> <__image__>",
+                                         "images": [{"upload": "a"}, {"upload": "b"}]}}]}
+    with TestClient(app) as client:
+        response = client.post("/v1/chat/completions",
+                               data={"payload": json.dumps(payload)},
+                               files={"a": ("a.png", small, "image/png"),
+                                      "b": ("b.png", large, "image/png")})
+        assert response.status_code == 200
+        assert lib.images[-1] == [small, large]
+        payload["messages"][0]["content"]["images"] = [{"upload": "c"}]
+        response = client.post("/v1/chat/completions",
+                               data={"payload": json.dumps(payload)},
+                               files={"a": ("a.png", small, "image/png")})
+        assert response.status_code == 400
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import sys
+
+import httpx
+import pytest
+
+from hacky_llama import service, worker, logs
+from hacky_llama.logs import LogBuffer
+
+from test_service import config
+
+
+SCRIPT = "import sys\nfor i in range(5):\n    print(f'out {i}', flush=True)\nprint('err', file=sys.stderr)"
+
+
+@pytest.fixture
+def fake_command(monkeypatch):
+    monkeypatch.setattr(worker.Worker, "command",
+                        lambda self: ([sys.executable, "-c", SCRIPT], None))
+
+
+@pytest.mark.asyncio
+async def test_worker_output_goes_to_its_log(fake_command):
+    w = worker.Worker(config, 8001, "python")
+    w.start()
+    followed = []
+
+    async def follow():
+        async for line in w.log.follow(0):
+            followed.append(line["text"])
+    follower = asyncio.create_task(follow())
+    # Returns once the worker has exited, without polling for output
+    await asyncio.wait_for(w.pump(), 10)
+    await asyncio.wait_for(follower, 1)
+    assert sorted(followed) == sorted([f"out {i}" for i in range(5)] + ["err"])
+    assert [line["stream"] for line in w.log.tail(10)].count("stderr") == 1
+    assert w.log.closed
+    w.process.wait()
+
+    log = LogBuffer("8001", max_lines=4)
+    for i in range(6):
+        log.append("stdout", str(i))
+    assert [line["text"] for line in log.tail(10)] == ["2", "3", "4", "5"]
+    assert [line["seq"] for line in log.since(4)] == [5, 6]
+
+
+def test_worker_output_printed_without_logging_config(monkeypatch, capsys):
+    monkeypatch.setattr(logging.getLogger(), "handlers", [])
+    monkeypatch.setattr(logs.logger, "handlers", [])
+    monkeypatch.setattr(logs.logger, "level", logging.NOTSET)
+    LogBuffer("8001").append("stdout", "loading model")
+    assert capsys.readouterr().out == "loading model\n"
+
+
+@pytest.mark.asyncio
+async def test_logs_endpoint(fake_command):
+    manager_app = service.model_manager_app(config)
+    manager = manager_app.state.model_manager
+    await manager_app.router.startup()
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(manager_app), base_url="http://proxy")
+    response = await client.get("/logs/current", params={"follow": "1", "tail": "0"})
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert len(response.text.splitlines()) == 6
+    response = await client.get("/logs/8001", params={"tail": "2"})
+    assert response.json()["closed"] and len(response.json()["lines"]) == 2
+    assert [line["seq"] for line in response.json()["lines"]] == [5, 6]
+    assert (await client.get("/logs/9999")).status_code == 404
+    assert (await client.get("/logs/current", params={"tail": "x"})).status_code == 400
+    manager.worker.process.wait()
+    await manager_app.router.shutdown()
+    await client.aclose()
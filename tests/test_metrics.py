@@ -0,0 +1,50 @@
+import httpx
+import pytest
+
+from hacky_llama.metrics import MetricsRegistry
+
+from util import FakeGemmaLib, worker_app
+
+
+def test_render_text_format():
+    registry = MetricsRegistry()
+    requests = registry.counter("requests_total", "Requests", ["outcome"])
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+    registry.gauge("depth", "Depth", fn=lambda: 3)
+    requests.inc(outcome="ok")
+    requests.inc(2, outcome='a "b"')
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests", "# TYPE requests_total counter",
+        'requests_total{outcome="ok"} 1', 'requests_total{outcome="a \\"b\\""} 2',
+        "# HELP latency_seconds Latency", "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1', 'latency_seconds_bucket{le="1"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3', "latency_seconds_sum 5.55",
+        "latency_seconds_count 3",
+        "# HELP depth Depth", "# TYPE depth gauge", "depth 3"]
+    with pytest.raises(ValueError):
+        requests.inc(status="ok")
+
+
+@pytest.mark.asyncio
+async def test_worker_metrics():
+    app = await worker_app(FakeGemmaLib(reply="Hi there"))
+    metrics = app.state.metrics
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app),
+                                 base_url="http://worker") as client:
+        for stream in (True, False):
+            body = {"messages": [{"role": "user", "content": "Hello"}], "stream": stream}
+            assert (await client.post("/v1/chat/completions", json=body)).status_code == 200
+        body = {"messages": [{"role": "user", "content": {"text": "", "images": [
+            {"path": "a.png"}]}}]}
+        assert (await client.post("/v1/chat/completions", json=body)).status_code == 400
+        response = await client.get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'llama_requests_total{outcome="ok"} 2' in response.text
+    assert 'llama_requests_total{outcome="bad_request"} 1' in response.text
+    assert metrics.ttft.count() == metrics.queue_wait.count() == 2
+    assert metrics.tokens_per_second.count() == 2
+    assert metrics.generated_tokens.get() > 0
+    assert "llama_queue_depth 0" in response.text
@@ -0,0 +1,93 @@
+import struct
+
+import pytest
+
+from hacky_llama.gguf import read_header, GGUFError
+from hacky_llama.planner import Device, PlanError, estimate, plan, plan_config
+
+from util import write_model
+
+
+def test_read_header(tmp_path):
+    write_model(tmp_path / "tiny.gguf")
+    header = read_header(tmp_path / "tiny.gguf")
+    assert header.summary() == {
+        "architecture": "llama", "name": "tiny", "file_type": "Q4_K_M", "n_layers": 4,
+        "context_length": 8192, "n_embd": 256, "n_vocab": 100, "n_tensors": 10,
+        "n_params": 2 * 256 * 100 + 4 * 5 * 256 * 256,
+        "weight_bytes": 256 * 100 * 2 + 4 * 5 * 256 * 144 + 256 * 100 // 32 * 34}
+    # The vocabulary is skipped but counted
+    assert "tokenizer.ggml.tokens" not in header.metadata
+    assert header.layer_bytes() == [5 * 256 * 144] * 4
+    assert header.head_counts() == [2] * 4 and header.key_length == 32
+    (tmp_path / "bad.gguf").write_bytes(b"GGUF\x03\x00\x00\x00\x01")
+    with pytest.raises(GGUFError):
+        read_header(tmp_path / "bad.gguf")
+    # A long array of an unknown type
+    (tmp_path / "bad.gguf").write_bytes(
+        b"GGUF" + struct.pack("<IQQQ", 3, 0, 1, 1) + b"k" + struct.pack("<IIQ", 9, 99, 100))
+    with pytest.raises(GGUFError, match="Unknown type 99 of k"):
+        read_header(tmp_path / "bad.gguf")
+
+
+def test_estimate_kv_for_overrides(tmp_path):
+    write_model(tmp_path / "tiny.gguf")
+    header = read_header(tmp_path / "tiny.gguf")
+    est = estimate(header)
+    # K and V of 2 heads of 32 f16 values per position and layer
+    assert est.n_ctx == 4096 and est.kv_bytes == 4 * 4096 * 2 * 64 * 2
+    assert estimate(header, {"ctx_size": 0}).kv_bytes == 2 * est.kv_bytes
+    assert estimate(header, {"cache_type_k": "q8_0", "cache_type_v": "q8_0"}).kv_bytes < est.kv_bytes
+    gpu, cpu = est.split(est.n_layers + 1)
+    assert cpu == est.input_bytes and gpu + cpu == est.total
+    assert est.split(0) == (0, est.total)
+    assert est.split(2)[0] == sum(est.layers[2:]) + est.offload_bytes
+
+
+def test_plan_packs_models_onto_devices(tmp_path):
+    write_model(tmp_path / "big.gguf", n_layers=8)
+    write_model(tmp_path / "small.gguf", n_layers=2)
+    big = estimate(read_header(tmp_path / "big.gguf"))
+    small = estimate(read_header(tmp_path / "small.gguf"))
+    big_gpu = big.split(9)[0]
+    small_gpu = small.split(3)[0]
+    cpu = Device(None, 1 << 30)
+
+    # Best fit: the small model takes the smaller GPU it fits on
+    devices = [Device(0, big_gpu + small_gpu + 20), Device(1, small_gpu + 10), cpu]
+    placed = plan([("big", big, None), ("small", small, None)], devices, reserve=0)
+    assert (placed["big"].device, placed["big"].n_gpu_layers) == (0, 9)
+    assert (placed["small"].device, placed["small"].n_gpu_layers) == (1, 3)
+
+    # Partial offload of what fits, the rest in CPU memory
+    placed = plan([("big", big, None)], [Device(0, big.split(5)[0]), cpu], reserve=0)
+    assert placed["big"].n_gpu_layers == 5
+    assert placed["big"].cpu_bytes == big.total - big.split(5)[0]
+
+    # CPU only hosts
+    placed = plan([("big", big, None), ("small", small, None)], [cpu], reserve=0)
+    assert [(p.device, p.n_gpu_layers) for p in placed.values()] == [(None, 0), (None, 0)]
+    # Even with a fixed number of layers to offload
+    placed = plan([("big", big, 99)], [cpu], reserve=0)
+    assert (placed["big"].device, placed["big"].n_gpu_layers) == (None, 0)
+    with pytest.raises(PlanError):
+        plan([("big", big, None)], [Device(None, big.total - 1)], reserve=0)
+    with pytest.raises(PlanError):
+        plan([("big", big, 9)], [Device(0, big_gpu - 1), cpu], reserve=0)
+
+
+def test_plan_config(tmp_path):
+    write_model(tmp_path / "qwen3-8b.gguf")
+    config = {"python": "python", "use_multiple_models": True,
+              "default": {"model_root": str(tmp_path), "lib_path": "/lib/libgemma.so",
+                          "n_predict": 128, "overrides": {"flash_attn": True}},
+              "models": [{"model_path": "qwen3-8b.gguf", "replicas": 2,
+                          "overrides": {"ctx_size": 1024}}]}
+    est = estimate(read_header(tmp_path / "qwen3-8b.gguf"), {"ctx_size": 1024})
+    gpu = est.split(5)[0]
+    planned = plan_config(config, [Device(0, gpu), Device(1, gpu + 1), Device(None, 1 << 30)],
+                          reserve=0)
+    assert sorted(planned) == [0, 1]
+    assert {c["gpu_id"] for c in planned.values()} == {0, 1}
+    assert planned[0]["overrides"] == {"flash_attn": True, "ctx_size": 1024, "n_gpu_layers": 5}
+    assert "replicas" not in planned[0] and planned[0]["placement"]["gpu_bytes"] == gpu
@@ -0,0 +1,48 @@
+import os
+
+from hacky_llama.registry import ModelRegistry
+
+from util import write_model
+
+
+def test_registry_indexes_and_finds_models(tmp_path):
+    for name in ("gemma-3-4b-it-Q4_K_M.gguf", "gemma-3-12b-it-Q4_K_M.gguf",
+                 "mmproj-gemma-3-4b-f16.gguf", "mmproj-gemma-3-12b-f16.gguf"):
+        write_model(tmp_path / name, arch="gemma3")
+    write_model(tmp_path / "qwen2.5-7b-instruct.gguf", arch="qwen2")
+    (tmp_path / "broken.gguf").write_bytes(b"not gguf")
+    registry = ModelRegistry(str(tmp_path), cache_path=str(tmp_path / "index.json"))
+    registry.refresh()
+    assert registry.names() == ["broken.gguf", "gemma-3-12b-it-Q4_K_M.gguf",
+                                "gemma-3-4b-it-Q4_K_M.gguf", "qwen2.5-7b-instruct.gguf"]
+    models = {m["name"]: m for m in registry.list()}
+    assert models["gemma-3-4b-it-Q4_K_M.gguf"]["mmproj"] == "mmproj-gemma-3-4b-f16.gguf"
+    assert models["gemma-3-12b-it-Q4_K_M.gguf"]["mmproj"] == "mmproj-gemma-3-12b-f16.gguf"
+    assert models["qwen2.5-7b-instruct.gguf"]["mmproj"] is None
+    assert models["qwen2.5-7b-instruct.gguf"]["metadata"]["architecture"] == "qwen2"
+    assert models["gemma-3-4b-it-Q4_K_M.gguf"]["metadata"]["file_type"] == "Q4_K_M"
+    assert models["broken.gguf"]["metadata"] is None and models["broken.gguf"]["error"]
+
+    assert registry.find("gemma-3-4b-it-Q4_K_M.gguf").name == "gemma-3-4b-it-Q4_K_M.gguf"
+    assert registry.find("GEMMA-3-12B-IT-Q4_K_M").name == "gemma-3-12b-it-Q4_K_M.gguf"
+    assert registry.find("gemma 12b").name == "gemma-3-12b-it-Q4_K_M.gguf"
+    assert registry.find("qwen2.5").name == "qwen2.5-7b-instruct.gguf"
+    assert registry.find("qwen 7b").name == "qwen2.5-7b-instruct.gguf"
+    # Sizes and numbers match whole
+    assert registry.find("gemma 2b") is None and registry.find("2") is None
+    assert registry.find("4b").name == "gemma-3-4b-it-Q4_K_M.gguf"
+    # Regex metacharacters are plain characters
+    assert registry.find("qwen2.5+").name == "qwen2.5-7b-instruct.gguf"
+    assert registry.find("(") is None and registry.find("llama") is None
+    assert registry.find("mmproj-gemma-3-4b-f16.gguf") is None
+
+    # Only new and changed files are parsed, also after a restart
+    registry = ModelRegistry(str(tmp_path), cache_path=str(tmp_path / "index.json"))
+    registry.refresh()
+    assert registry.parsed == 0
+    write_model(tmp_path / "qwen2.5-7b-instruct.gguf", arch="qwen3")
+    os.utime(tmp_path / "qwen2.5-7b-instruct.gguf", ns=(1, 1))
+    os.remove(tmp_path / "broken.gguf")
+    registry.refresh()
+    assert registry.parsed == 1 and "broken.gguf" not in registry.names()
+    assert registry.find("qwen2.5").metadata["architecture"] == "qwen3"
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from starlette.testclient import TestClient
+
+from hacky_llama.gemma_service import create_app
+from hacky_llama.scheduler import RequestScheduler, QueueFullError, QueueTimeoutError
+
+from util import MockLlamaInterface
+
+
+@pytest.mark.asyncio
+async def test_scheduler_is_fifo():
+    scheduler = RequestScheduler("iface", max_queue_depth=4, max_queue_wait=1)
+    order = []
+
+    async def worker(i):
+        async with scheduler.slot():
+            order.append(i)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*[worker(i) for i in range(5)])
+    assert order == list(range(5))
+    assert scheduler.stats()["completed"] == 5
+    assert not scheduler.busy
+
+
+@pytest.mark.asyncio
+async def test_scheduler_rejects_when_full():
+    scheduler = RequestScheduler("iface", max_queue_depth=1, max_queue_wait=1)
+    await scheduler.acquire()
+    waiter = asyncio.create_task(scheduler.acquire())
+    await asyncio.sleep(0)
+    assert scheduler.queue_depth == 1
+    with pytest.raises(QueueFullError) as e:
+        await scheduler.acquire()
+    assert e.value.status_code == 429
+    assert e.value.retry_after >= 1
+    scheduler.release()
+    assert await waiter == "iface"
+    scheduler.release()
+    assert scheduler.stats()["rejected_queue_full"] == 1
+
+
+@pytest.mark.asyncio
+async def test_scheduler_wait_timeout():
+    scheduler = RequestScheduler("iface", max_queue_depth=2, max_queue_wait=0.05)
+    await scheduler.acquire()
+    with pytest.raises(QueueTimeoutError) as e:
+        await scheduler.acquire()
+    assert e.value.status_code == 503
+    assert scheduler.queue_depth == 0
+    scheduler.release()
+    assert not scheduler.busy
+
+
+@pytest.mark.asyncio
+async def test_scheduler_cancelled_waiter_is_skipped():
+    scheduler = RequestScheduler("iface", max_queue_depth=2, max_queue_wait=1)
+    await scheduler.acquire()
+    waiter = asyncio.create_task(scheduler.acquire())
+    await asyncio.sleep(0)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    scheduler.release()
+    assert not scheduler.busy
+    assert scheduler.queue_depth == 0
+
+
+def test_busy_service_returns_retry_after():
+    app = asyncio.run(create_app({"max_queue_depth": 0},
+                                 mock_llama_interface=MockLlamaInterface()))
+    with TestClient(app) as client:
+        app.state.scheduler._busy = True
+        response = client.get("/reset_context")
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) >= 1
+        stats = client.get("/queue_stats").json()
+        assert stats["rejected_queue_full"] == 1
@@ -0,0 +1,341 @@
+import asyncio
+import json
+import sys
+import threading
+
+import httpx
+import pytest
+
+from hacky_llama import service, worker
+from hacky_llama.pool import ModelPool
+from hacky_llama.upstream import UpstreamPool, scan_field
+
+from util import FakeGemmaLib, Backends, worker_app, loading_worker_app
+
+
+config = {"python": "python", "model_root": "/models", "model_path": "gemma-3-4b.gguf",
+          "lib_path": "/lib/libgemma.so", "mmproj_path": "mmproj.gguf", "n_predict": 128,
+          "overrides": {}}
+
+
+def start_worker(self):
+    self.set_state("starting")
+
+
+async def proxied_worker(monkeypatch, lib=None, app=None):
+    """Manager app in front of an in process worker app, and a client for it"""
+    monkeypatch.setattr(worker.Worker, "start", start_worker)
+    manager_app = service.model_manager_app(config)
+    manager = manager_app.state.model_manager
+    app = app or await worker_app(lib)
+    manager.upstreams = UpstreamPool(transport=httpx.ASGITransport(app))
+    await manager_app.router.startup()
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(manager_app), base_url="http://proxy")
+    return manager_app, client
+
+
+@pytest.mark.asyncio
+async def test_proxy_reuses_one_pooled_client(monkeypatch):
+    lib = FakeGemmaLib(reply="Hi there")
+    manager_app, client = await proxied_worker(monkeypatch, lib)
+    manager = manager_app.state.model_manager
+
+    async def ask(i, stream):
+        body = {"messages": [{"role": "user", "content": f"Hello {i}"}], "stream": stream}
+        response = await client.post("/v1/chat/completions", json=body)
+        assert response.status_code == 200
+        return response.text if stream else response.json()["choices"][0]["message"]["content"]
+
+    results = await asyncio.gather(*[ask(i, i % 2 == 0) for i in range(6)])
+    assert all("there" in r for r in results)
+    assert json.loads((await client.get("/is_generating")).text)["message"] is False
+    assert manager.upstreams.stats()["backends"] == [manager.service_url]
+    upstream = manager.upstreams.client(manager.service_url)
+    await manager_app.router.shutdown()
+    assert upstream.is_closed
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_proxy_relays_status_headers_and_body(monkeypatch):
+    lib = FakeGemmaLib(reply="Hi there")
+    manager_app, client = await proxied_worker(monkeypatch, lib)
+    body = b'{"messages": [{"role": "user", "content": "Hello"}], "max_tokens": 1}'
+    response = await client.post("/v1/chat/completions", content=body,
+                                 headers={"content-type": "application/json"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert response.json()["choices"][0]["message"]["content"] == "Hi"
+
+    # Upstream errors are not turned into 200s
+    response = await client.post("/v1/chat/completions", content=b'{"messages": [{"role": "user", '
+                                 b'"content": {"text": "", "images": [{"path": "a.png"}]}}]}')
+    assert response.status_code == 400
+    assert "not enabled" in response.json()["error"]
+    assert (await client.get("/no_such_endpoint")).status_code == 404
+    await manager_app.router.shutdown()
+    await client.aclose()
+
+
+def test_scan_field():
+    head = b'{"model": "gemma-3-27b", "session_id": "a\\"b", "messages": [{"role": "user", "con'
+    assert scan_field(head, "model") == "gemma-3-27b"
+    assert scan_field(head, "session_id") == 'a\\"b'
+    assert scan_field(head, "stream") is None
+
+
+@pytest.mark.asyncio
+async def test_switch_model_without_downtime(monkeypatch, tmp_path):
+    stopped = []
+    monkeypatch.setattr(worker.Worker, "start", start_worker)
+    monkeypatch.setattr(worker.Worker, "stop", lambda self, timeout=30: stopped.append(self.port))
+    (tmp_path / "gemma-3-12b-it.gguf").touch()
+    old_lib = FakeGemmaLib(reply=" ".join(["old"] * 20), token_delay=0.02)
+    new_lib = FakeGemmaLib(reply="new")
+    manager_app = service.model_manager_app({**config, "model_root": str(tmp_path)})
+    manager = manager_app.state.model_manager
+    manager.upstreams = UpstreamPool(transport=Backends({8001: await worker_app(old_lib),
+                                                        8002: await worker_app(new_lib)}))
+    await manager_app.router.startup()
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(manager_app), base_url="http://proxy")
+    body = {"messages": [{"role": "user", "content": "Hello"}], "stream": True}
+
+    in_flight = asyncio.create_task(client.post("/v1/chat/completions", json=body))
+    while not old_lib.generating:
+        await asyncio.sleep(0.01)
+    response = await client.post("/switch_model", json={"model_name": "12b"})
+    assert response.status_code == 200
+    assert (await client.post("/switch_model", json={"model_name": "12b"})).status_code == 400
+    while (await client.get("/switch_status")).json()["state"] != "idle":
+        await asyncio.sleep(0.01)
+    # The old worker was stopped only after its stream had finished
+    assert stopped == [8001]
+    assert (await in_flight).text.count("old") == 20
+    assert manager.config["model_path"] == "gemma-3-12b-it.gguf"
+    assert manager.service_port == 8002
+    response = await client.post("/v1/chat/completions", json={**body, "stream": False})
+    assert response.json()["choices"][0]["message"]["content"] == "new"
+    # Warmed up before getting traffic
+    assert new_lib.evaluated[0][0] == worker.WARMUP_REQUEST["messages"]
+    await manager_app.router.shutdown()
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_requests_held_until_worker_is_ready(monkeypatch):
+    loaded = threading.Event()
+    lib = FakeGemmaLib(reply="Hi there")
+    manager_app, client = await proxied_worker(
+        monkeypatch, app=await loading_worker_app(monkeypatch, lib, loaded))
+    manager = manager_app.state.model_manager
+    body = {"messages": [{"role": "user", "content": "Hello"}]}
+
+    held = asyncio.create_task(client.post("/v1/chat/completions", json=body))
+    while manager.worker.held == 0 or manager.worker.state != "loading":
+        await asyncio.sleep(0.01)
+    response = await client.get("/health")
+    assert response.status_code == 503 and response.json()["status"] == "loading"
+    # Holds are bounded in time
+    manager.hold_timeout = 0.05
+    response = await client.post("/v1/chat/completions", json=body)
+    assert response.status_code == 503 and response.headers["retry-after"] == "5"
+    assert not held.done()
+
+    loaded.set()
+    response = await held
+    assert response.json()["choices"][0]["message"]["content"] == "Hi there"
+    assert (await client.get("/health")).json()["worker"]["held"] == 0
+    await manager_app.router.shutdown()
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_worker_fails_only_after_consecutive_missed_polls():
+    replies = []
+
+    def health(request):
+        if not replies:
+            raise httpx.ReadTimeout("busy", request=request)
+        return replies.pop(0)
+    client = httpx.AsyncClient(transport=httpx.MockTransport(health), base_url="http://worker")
+    w = worker.Worker({**config, "health_max_misses": 2}, 8001, "python")
+    w.set_state("starting")
+    await w.check(client)
+    assert w.state == "starting"
+    replies.append(httpx.Response(200, json={"status": "ok"}))
+    await w.check(client)
+    assert w.state == "ready"
+    # A prompt may keep the worker from answering a poll
+    await w.check(client)
+    assert w.state == "ready" and w.misses == 1
+    replies.append(httpx.Response(200, json={"status": "ok"}))
+    await w.check(client)
+    assert w.state == "ready" and w.misses == 0
+    await w.check(client)
+    await w.check(client)
+    assert w.state == "failed"
+    # Polled again once its prompt is done
+    replies.append(httpx.Response(200, json={"status": "ok"}))
+    await w.check(client)
+    assert w.state == "ready" and w.failed_at is None
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_exited_worker_is_restarted(monkeypatch):
+    monkeypatch.setattr(worker.Worker, "command",
+                        lambda self: ([sys.executable, "-c", "raise SystemExit(1)"], None))
+    manager_app = service.model_manager_app({**config, "restart_delay": 0.01})
+    manager = manager_app.state.model_manager
+    await manager_app.router.startup()
+    first = manager.worker
+    model = config["model_path"]
+    for _ in range(200):
+        if manager.metrics.restarts.get(model=model) >= 2:
+            break
+        await asyncio.sleep(0.01)
+    # The same worker, with a doubling delay while it keeps exiting
+    assert manager.metrics.restarts.get(model=model) >= 2
+    assert manager.worker is first and first.crashes >= 2
+    await manager_app.router.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_model_pool_keeps_recent_models_resident(monkeypatch, tmp_path):
+    stopped = []
+    monkeypatch.setattr(worker.Worker, "start", start_worker)
+    monkeypatch.setattr(worker.Worker, "stop", lambda self, timeout=30: stopped.append(self.port))
+    for name in ("gemma-3-4b.gguf", "gemma-3-12b-it.gguf", "qwen3-8b.gguf"):
+        (tmp_path / name).write_bytes(b"\0" * 100)
+    manager_app = service.model_manager_app({**config, "model_root": str(tmp_path),
+                                             "pool_bytes": 250})
+    manager = manager_app.state.model_manager
+    manager.upstreams = manager.pool.upstreams = UpstreamPool(transport=Backends(
+        {8001: await worker_app(FakeGemmaLib(reply="four")),
+         8002: await worker_app(FakeGemmaLib(reply="other"))}))
+    await manager_app.router.startup()
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(manager_app), base_url="http://proxy")
+
+    async def ask(model=None):
+        body = {"messages": [{"role": "user", "content": "Hello"}]}
+        response = await client.post("/v1/chat/completions",
+                                     json={**body, "model": model} if model else body)
+        return response.status_code, response.json()
+    assert (await ask())[1]["choices"][0]["message"]["content"] == "four"
+    assert (await ask("12b"))[1]["choices"][0]["message"]["content"] == "other"
+    assert (await ask("gemma-3-4b"))[1]["choices"][0]["message"]["content"] == "four"
+    # The 12b is the least recently used model that is not the current one
+    assert (await ask("qwen3-8b.gguf"))[1]["choices"][0]["message"]["content"] == "other"
+    assert (await ask("llama"))[0] == 404
+    stats = (await client.get("/pool")).json()
+    assert [(e["event"], e["model_path"]) for e in stats["events"]] == [
+        ("load", "gemma-3-4b.gguf"), ("load", "gemma-3-12b-it.gguf"),
+        ("evict", "gemma-3-12b-it.gguf"), ("load", "qwen3-8b.gguf")]
+    assert [m["model_path"] for m in stats["models"]] == ["qwen3-8b.gguf", "gemma-3-4b.gguf"]
+    assert stats["used"] == 200 and stopped == [8002]
+    assert "gemma-3-12b-it.gguf" in stats["evicted_resident_seconds"]
+
+    # Switching to a resident model loads nothing
+    assert (await client.post("/switch_model", json={"model_name": "8b"})).status_code == 200
+    while (await client.get("/switch_status")).json()["state"] != "idle":
+        await asyncio.sleep(0.01)
+    assert manager.service_port == 8002 and manager.pool.loads == 3
+    assert (await ask())[1]["choices"][0]["message"]["content"] == "other"
+    assert (await ask("12b"))[1]["choices"][0]["message"]["content"] == "four"
+    assert stopped == [8002, 8001]
+    await manager_app.router.shutdown()
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_model_pool_drains_evicted_models_without_blocking_loads(monkeypatch, tmp_path):
+    stopped = []
+    monkeypatch.setattr(worker.Worker, "start", start_worker)
+    monkeypatch.setattr(worker.Worker, "stop", lambda self, timeout=30: stopped.append(self.port))
+    configs = {}
+    for name, size in (("a.gguf", 100), ("c.gguf", 150), ("d.gguf", 50)):
+        (tmp_path / name).write_bytes(b"\0" * size)
+        configs[name] = {**config, "model_root": str(tmp_path), "model_path": name}
+    started = []
+    pool = ModelPool(200, [8001, 8002, 8003], "python", UpstreamPool(), started.append)
+    a = await pool.get(configs["a.gguf"])
+    assert a.in_flight == 1 and started == [a]
+
+    # The c evicts the a, and is started once the request to the a has finished
+    loading = asyncio.create_task(pool.get(configs["c.gguf"]))
+    await asyncio.sleep(0.05)
+    assert not loading.done() and list(pool.workers) == ["c.gguf"]
+    assert pool.workers["c.gguf"].in_flight == 1
+    # Meanwhile other models load
+    d = await asyncio.wait_for(pool.get(configs["d.gguf"]), 1)
+    assert started == [a, d] and d.port == 8002
+    a.release()
+    c = await asyncio.wait_for(loading, 5)
+    assert started == [a, d, c] and c.port == 8001 and stopped == [8001]
+
+
+@pytest.mark.asyncio
+async def test_model_pool_fails_requests_for_model_evicted_before_start(monkeypatch, tmp_path):
+    monkeypatch.setattr(worker.Worker, "start", start_worker)
+    monkeypatch.setattr(worker.Worker, "stop", lambda self, timeout=30: None)
+    configs = {}
+    for name, size in (("a.gguf", 100), ("c.gguf", 150)):
+        (tmp_path / name).write_bytes(b"\0" * size)
+        configs[name] = {**config, "model_root": str(tmp_path), "model_path": name}
+    started = []
+    pool = ModelPool(200, [8001, 8002], "python", UpstreamPool(), started.append)
+    a = await pool.get(configs["a.gguf"])
+    loading = asyncio.create_task(pool.get(configs["c.gguf"]))
+    await asyncio.sleep(0.05)
+    c = pool.workers["c.gguf"]
+    held = asyncio.create_task(c.hold(timeout=60))
+    # The c is evicted while it waits for the a to drain
+    pool.remove(c)
+    a.release()
+    assert await asyncio.wait_for(loading, 5) is c
+    with pytest.raises(worker.WorkerUnavailable):
+        await asyncio.wait_for(held, 1)
+    assert c.state == "stopped" and started == [a]
+    c.release()
+
+
+@pytest.mark.asyncio
+async def test_proxy_metrics(monkeypatch):
+    manager_app, client = await proxied_worker(monkeypatch, FakeGemmaLib(reply="Hi there"))
+    manager = manager_app.state.model_manager
+    body = {"messages": [{"role": "user", "content": "Hello"}], "stream": True}
+    assert (await client.post("/v1/chat/completions", json=body)).status_code == 200
+    text = (await client.get("/metrics")).text
+    backend = manager.service_url
+    assert f'llama_proxy_requests_total{{backend="{backend}",status="200"}} 1' in text
+    assert f'llama_proxy_upstream_latency_seconds_count{{backend="{backend}"}} 1' in text
+    assert f'llama_proxy_active_streams{{backend="{backend}"}} 0' in text
+    assert "llama_proxy_abandoned_streams_total 0" in text
+    manager._count_abandoned()
+    text = (await client.get("/metrics")).text
+    assert "# TYPE llama_proxy_abandoned_streams_total counter" in text
+    assert "llama_proxy_abandoned_streams_total 1" in text
+    # Only a worker replacing a failed one of the same model is a restart
+    model = manager.worker.config["model_path"]
+    switched = worker.Worker(config, 8002, "python")
+    manager.worker.set_state("stopped")
+    manager.metrics.worker_started(switched)
+    assert not manager.metrics.restarts.values
+    switched.set_state("failed")
+    manager.metrics.worker_started(worker.Worker(config, 8001, "python"))
+    assert manager.metrics.restarts.get(model=model) == 1
+    assert manager.metrics.starts.get(model=model) == 3
+    await manager_app.router.shutdown()
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_proxy_server_timing(monkeypatch):
+    manager_app, client = await proxied_worker(monkeypatch, FakeGemmaLib(reply="Hi there"))
+    body = {"messages": [{"role": "user", "content": "Hello"}]}
+    response = await client.post("/v1/chat/completions", json=body)
+    names = [m.split(";")[0] for m in response.headers["server-timing"].split(", ")]
+    # The worker's spans, then those of the proxy
+    assert names[:2] == ["parse", "queue"] and names[-2:] == ["proxy_hold", "proxy_upstream"]
+    await manager_app.router.shutdown()
+    await client.aclose()
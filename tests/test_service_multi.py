@@ -0,0 +1,137 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from hacky_llama import service_multi, worker
+from hacky_llama.routing import Router
+from hacky_llama.upstream import UpstreamPool
+
+from util import FakeGemmaLib, Backends, worker_app
+
+
+def model_config(model_path):
+    return {"model_path": model_path, "lib_path": "/lib/libgemma.so", "model_root": "/models",
+            "mmproj_path": "mmproj.gguf", "n_predict": 128, "overrides": {}}
+
+
+async def manager_with_workers(monkeypatch, models: dict[int, str], libs: dict[int, FakeGemmaLib]):
+    monkeypatch.setattr(worker.Worker, "start", lambda self: self.set_state("starting"))
+    config = {"python": "python", "use_multiple_models": True, "model_root": "/models",
+              **{gpu: model_config(path) for gpu, path in models.items()}}
+    app = service_multi.model_manager_app(config)
+    manager = app.state.model_manager
+    manager.upstreams = UpstreamPool(transport=Backends(
+        {manager.ports[gpu]: await worker_app(lib) for gpu, lib in libs.items()}))
+    await app.router.startup()
+    while not all(r.ready for r in manager.router.replicas.values()):
+        await asyncio.sleep(0.01)
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app), base_url="http://proxy")
+    return app, client
+
+
+def test_router_resolves_model_names():
+    router = Router()
+    router.add(0, "http://localhost:8001", "gemma-3-27b-it-Q4_K_M")
+    router.add(1, "http://localhost:8002", "gemma-3-27b-it-Q4_K_M")
+    router.add(2, "http://localhost:8003", "qwen3-8b")
+    assert [r.id for r in router.resolve("gemma-3-27b-it-Q4_K_M.gguf")] == [0, 1]
+    assert [r.id for r in router.resolve("QWEN3")] == [2]
+    with pytest.raises(KeyError):
+        router.resolve(None)
+    with pytest.raises(KeyError):
+        router.resolve("llama")
+    first = router.route("gemma")
+    second = router.route("gemma")
+    assert {first.id, second.id} == {0, 1}
+    router.release(first, error=True)
+    # Unhealthy replicas are avoided even if less loaded
+    assert router.route("gemma") is second
+
+
+@pytest.mark.asyncio
+async def test_requests_spread_over_replicas(monkeypatch):
+    libs = {gpu: FakeGemmaLib(reply="Hi there", token_delay=0.05) for gpu in (0, 1)}
+    app, client = await manager_with_workers(
+        monkeypatch, {0: "gemma-3-4b.gguf", 1: "gemma-3-4b.gguf"}, libs)
+    manager = app.state.model_manager
+
+    async def ask(i):
+        response = await client.post("/v1/chat/completions", json={
+            "model": "gemma-3-4b", "messages": [{"role": "user", "content": f"Hello {i}"}]})
+        assert response.status_code == 200
+        return response.json()["choices"][0]["message"]["content"]
+
+    assert await asyncio.gather(*[ask(i) for i in range(4)]) == ["Hi there"] * 4
+    stats = (await client.get("/replicas")).json()
+    assert stats["models"] == {"gemma-3-4b": [0, 1]}
+    assert [r["requests"] for r in stats["replicas"]] == [2, 2]
+    assert all(r["in_flight"] == 0 for r in stats["replicas"])
+    assert [len(lib.evaluated) for lib in libs.values()] == [2, 2]
+    response = await client.post("/v1/chat/completions", json={
+        "model": "llama", "messages": [{"role": "user", "content": "Hello"}]})
+    assert response.status_code == 404
+    assert (await client.get("/1/is_generating")).json()["message"] is False
+    assert manager.router.replicas[1].requests == 3
+    await app.router.shutdown()
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_conversations_stick_to_a_replica(monkeypatch):
+    libs = {gpu: FakeGemmaLib(reply="Hi there") for gpu in (0, 1)}
+    app, client = await manager_with_workers(
+        monkeypatch, {0: "gemma-3-4b.gguf", 1: "gemma-3-4b.gguf"}, libs)
+    router = app.state.model_manager.router
+
+    async def converse(first, turns, **kwargs):
+        history = [{"role": "system", "content": "Be brief"}, {"role": "user", "content": first}]
+        for i in range(turns):
+            response = await client.post("/v1/chat/completions",
+                                         json={"messages": history, **kwargs})
+            history += [{"role": "assistant", "content": response.json()["choices"][0]["message"]["content"]},
+                        {"role": "user", "content": f"And {i}?"}]
+
+    for i in range(4):
+        await converse(f"Hello {i}", 3)
+    # Every turn after the first reuses the prefix cached on its replica
+    assert sum(lib.resets for lib in libs.values()) == 4
+    assert router.stats()["affinity"]["hit_rate"] == 1.0
+
+    preferred = router.rank("conv-1", list(router.replicas.values()))
+    preferred[0].failed_at = time.monotonic()
+    await converse("Hi", 2, session_id="conv-1")
+    affinity = router.stats()["affinity"]
+    assert affinity["fallbacks"] == 2 and affinity["requests"] == 14
+    assert not preferred[0].healthy
+
+
+@pytest.mark.asyncio
+async def test_model_found_after_long_messages(monkeypatch):
+    libs = {0: FakeGemmaLib(reply="Gemma"), 1: FakeGemmaLib(reply="Qwen")}
+    app, client = await manager_with_workers(
+        monkeypatch, {0: "gemma-3-4b.gguf", 1: "qwen3-8b.gguf"}, libs)
+    # As OpenAI clients send it, the model after messages far longer than a peek
+    body = ('{"messages": [{"role": "user", "content": "' + "word " * 20000 + '"}], '
+            '"model": "qwen3-8b"}')
+    response = await client.post("/v1/chat/completions", content=body)
+    assert response.json()["choices"][0]["message"]["content"] == "Qwen"
+
+    async def chunks():
+        for i in range(0, len(body), 4096):
+            yield body[i:i + 4096].encode()
+    response = await client.post("/v1/chat/completions", content=body,
+                                 headers={"x-model": "qwen3-8b"})
+    assert response.json()["choices"][0]["message"]["content"] == "Qwen"
+    # Past the cap requests go to the default model, with their body intact
+    manager = app.state.model_manager
+    manager.max_peek_bytes = 16384
+    response = await client.post("/v1/chat/completions", content=chunks())
+    assert response.status_code == 400
+    manager.router.default_model = "gemma-3-4b"
+    response = await client.post("/v1/chat/completions", content=chunks())
+    assert response.json()["choices"][0]["message"]["content"] == "Gemma"
+    assert len(libs[0].evaluated[-1][0][0]["content"]) == len("word " * 20000)
+    await app.router.shutdown()
+    await client.aclose()
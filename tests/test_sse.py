@@ -0,0 +1,28 @@
+import json
+
+from hacky_llama.sse import SSEEncoder
+
+
+def parse(event):
+    assert event.startswith("data: ") and event.endswith("\n\n")
+    return json.loads(event[6:])
+
+
+def test_delta_matches_json_envelope():
+    encoder = SSEEncoder()
+    for text in ["plain", " \"quoted\"\n", "naïve ∑ 😀", "\\back\\slash\t"]:
+        assert parse(encoder.delta(text)) == {"choices": [{"delta": {"content": text},
+                                                          "finish_reason": None}]}
+
+
+def test_batching_and_final():
+    encoder = SSEEncoder(batch_tokens=3)
+    events = [encoder.add(t) for t in ["a", "b", "c", "d"]]
+    assert events[:2] == [None, None]
+    assert parse(events[2])["choices"][0]["delta"]["content"] == "abc"
+    assert events[3] is None
+    assert parse(encoder.flush())["choices"][0]["delta"]["content"] == "d"
+    assert encoder.flush() is None
+    final = parse(encoder.final({"usage": {"total_tokens": 4}}))
+    assert final["choices"][0]["finish_reason"] == "stop"
+    assert final["usage"] == {"usage": {"total_tokens": 4}}
@@ -0,0 +1,93 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from hacky_llama.token_buffer import TokenBuffer, TokenCollector
+
+
+async def collect(buffer):
+    chunks = []
+    while (chunk := await buffer.get()) is not None:
+        chunks.append(chunk)
+    return chunks
+
+
+@pytest.mark.asyncio
+async def test_token_buffer_coalesces_fast_producer():
+    buffer = TokenBuffer(asyncio.get_running_loop(), flush_interval=0.05, flush_bytes=1 << 16)
+
+    def produce():
+        for i in range(2000):
+            buffer.put(f"t{i} ")
+        buffer.close()
+
+    thread = threading.Thread(target=produce)
+    thread.start()
+    chunks = await asyncio.wait_for(collect(buffer), 5)
+    thread.join()
+    assert "".join(chunks) == "".join(f"t{i} " for i in range(2000))
+    assert len(chunks) < 50
+    assert buffer.wakeups < 50
+
+
+@pytest.mark.asyncio
+async def test_token_buffer_delivers_within_interval():
+    buffer = TokenBuffer(asyncio.get_running_loop(), flush_interval=0.05)
+    buffer.put("first")
+    assert await buffer.get() == "first"
+    # Within the interval of the last wakeup, no wakeup is scheduled
+    buffer.put("second")
+    start = time.monotonic()
+    assert await asyncio.wait_for(buffer.get(), 1) == "second"
+    assert time.monotonic() - start < 0.5
+    buffer.close()
+    assert await buffer.get() is None
+
+
+@pytest.mark.asyncio
+async def test_token_buffer_blocks_producer_when_full():
+    buffer = TokenBuffer(asyncio.get_running_loop(), max_bytes=10)
+    done = threading.Event()
+
+    def produce():
+        for _ in range(10):
+            buffer.put("12345")
+        buffer.close()
+        done.set()
+
+    thread = threading.Thread(target=produce)
+    thread.start()
+    await asyncio.sleep(0.1)
+    assert not done.is_set()
+    chunks = await asyncio.wait_for(collect(buffer), 5)
+    thread.join()
+    assert "".join(chunks) == "12345" * 10
+    assert max(len(c) for c in chunks) <= 15
+
+
+@pytest.mark.asyncio
+async def test_token_buffer_interrupt_policy():
+    interrupted = []
+    buffer = TokenBuffer(asyncio.get_running_loop(), max_bytes=10, overflow="interrupt",
+                         on_overflow=lambda: interrupted.append(True))
+    for _ in range(5):
+        buffer.put("12345")
+    buffer.close()
+    assert await collect(buffer) == ["1234512345"]
+    assert interrupted == [True]
+    assert buffer.overflowed
+
+
+@pytest.mark.asyncio
+async def test_token_buffer_counts_utf8_bytes():
+    buffer = TokenBuffer(asyncio.get_running_loop(), max_bytes=10, overflow="interrupt")
+    # 3 characters but 5 bytes, so the third token does not fit
+    for _ in range(3):
+        buffer.put("héé")
+    buffer.close()
+    assert await collect(buffer) == ["héé" * 2] and buffer.overflowed
+    collector = TokenCollector()
+    collector.put("日本")
+    assert collector.nbytes == 6
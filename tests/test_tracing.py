@@ -0,0 +1,65 @@
+import json
+
+import httpx
+import pytest
+
+from hacky_llama.tracing import Trace, make_exporter
+
+from util import FakeGemmaLib, worker_app
+
+
+class Recorder:
+    def __init__(self):
+        self.traces = []
+
+    def export(self, trace):
+        self.traces.append(trace)
+
+
+def test_trace_spans_and_server_timing():
+    exporter = Recorder()
+    trace = Trace("/chat", exporter)
+    with trace.span("parse"):
+        pass
+    trace.accumulate("sse", 0.001)
+    trace.accumulate("sse", 0.002)
+    running = trace.add("generate", trace.start)
+    assert [s.name for s in trace.spans] == ["parse", "sse", "generate"]
+    assert trace.spans[1].duration == pytest.approx(0.003, abs=1e-6)
+    # Spans still running and the total are left out until they end
+    assert [m.split(";")[0] for m in trace.server_timing("proxy_").split(", ")] == [
+        "proxy_parse", "proxy_sse"]
+    running.end = trace.start + 0.5
+    trace.finish()
+    trace.finish()
+    assert exporter.traces == [trace]
+    assert "generate;dur=500.0" in trace.server_timing()
+    assert trace.server_timing().split(", ")[-1].startswith("total;dur=")
+    assert trace.to_dict()["spans"][2] == {"name": "generate", "start_ms": 0,
+                                           "duration_ms": pytest.approx(500, abs=1e-3)}
+    assert make_exporter(None) is None
+    with pytest.raises(ValueError):
+        make_exporter("zipkin")
+
+
+@pytest.mark.asyncio
+async def test_worker_server_timing_and_usage_timing():
+    app = await worker_app(FakeGemmaLib(reply="Hi there"))
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app),
+                                 base_url="http://worker") as client:
+        body = {"messages": [{"role": "user", "content": "Hello"}], "include_timing": True,
+                "temperature": 0.5}
+        response = await client.post("/v1/chat/completions", json=body)
+        names = [m.split(";")[0] for m in response.headers["server-timing"].split(", ")]
+        assert names == ["parse", "queue", "sync", "sampler", "prefill", "first_token",
+                         "generate", "total"]
+        assert [s["name"] for s in response.json()["timing"]["spans"]] == names[:-1]
+
+        response = await client.post("/v1/chat/completions", json={**body, "stream": True})
+        assert [m.split(";")[0] for m in response.headers["server-timing"].split(", ")] == [
+            "parse", "queue"]
+        final = json.loads(response.text.split("data: ")[-1])
+        assert "sse" in [s["name"] for s in final["usage"]["timing"]["spans"]]
+
+        body.pop("include_timing")
+        assert "timing" not in (await client.post("/v1/chat/completions", json=body)).json()
@@ -1,10 +1,18 @@
 import asyncio
 from typing import Optional, AsyncGenerator
+import ctypes
 import json
 
+import httpx
 from starlette.requests import Request
 from starlette.responses import StreamingResponse, Response
 
+from hacky_llama import gemma_service
+from hacky_llama.gguf import write_header
+from hacky_llama.gemma_iface import GemmaInterface
+from hacky_llama.gemma_service import create_app
+from hacky_llama.fake_engine import FakeGemmaLib
+
 
 class MockLlamaInterface:
     def __init__(self, *args, **kwargs):
@@ -75,3 +83,79 @@ async def fake_process_chat(iface, messages: list[dict[str, str]],
     print("Sending resp", resp)
     yield json.dumps(resp)
     yield "[DONE]"
+
+
+class FakeGemmaLibWithState(FakeGemmaLib):
+    """:class:`FakeGemmaLib` that also exports the KV state API.
+
+    The "KV state" is the JSON of the messages evaluated since the last reset.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.context = []
+        self.loads = 0
+
+    def gemma3_static_eval_message_text_only(self, msgs, add_bos):
+        self.context.extend(json.loads(msgs))
+        return super().gemma3_static_eval_message_text_only(msgs, add_bos)
+
+    def gemma3_static_reset(self):
+        self.context = []
+        return super().gemma3_static_reset()
+
+    def gemma3_static_state_size(self):
+        return len(json.dumps(self.context).encode())
+
+    def gemma3_static_state_save(self, buf, size):
+        data = json.dumps(self.context).encode()
+        ctypes.memmove(buf, data, len(data))
+        return len(data)
+
+    def gemma3_static_state_load(self, ptr, size):
+        self.context = json.loads(ctypes.string_at(ptr, size))
+        self.loads += 1
+        return size
+
+
+async def worker_app(lib):
+    """Started worker app serving :code:`lib`"""
+    app = await create_app({}, mock_llama_interface=GemmaInterface(None, "model.gguf", lib=lib))
+    await app.router.startup()
+    return app
+
+
+async def loading_worker_app(monkeypatch, lib, loaded):
+    """Started worker app that loads :code:`lib` once :code:`loaded` is set"""
+    def load(loop, **config):
+        loaded.wait(10)
+        return GemmaInterface(None, "model.gguf", lib=lib)
+    monkeypatch.setattr(gemma_service, "GemmaInterface", load)
+    app = await create_app({})
+    await app.router.startup()
+    return app
+
+
+class Backends(httpx.AsyncBaseTransport):
+    """Serve in process worker apps by port"""
+    def __init__(self, apps):
+        self.transports = {port: httpx.ASGITransport(app) for port, app in apps.items()}
+
+    async def handle_async_request(self, request):
+        return await self.transports[request.url.port].handle_async_request(request)
+
+
+F16, Q8_0, Q4_K = 1, 8, 12
+
+
+def write_model(path, n_layers=4, n_embd=256, n_vocab=100, arch="llama"):
+    """Synthetic GGUF without weights"""
+    tensors = [("token_embd.weight", (n_embd, n_vocab), F16)]
+    for i in range(n_layers):
+        tensors += [(f"blk.{i}.attn_q.weight", (n_embd, n_embd), Q4_K),
+                    (f"blk.{i}.ffn_up.weight", (n_embd, 4 * n_embd), Q4_K)]
+    tensors.append(("output.weight", (n_embd, n_vocab), Q8_0))
+    write_header(path, {"general.architecture": arch, "general.name": "tiny",
+                        "general.file_type": 15, f"{arch}.block_count": n_layers,
+                        f"{arch}.context_length": 8192, f"{arch}.embedding_length": n_embd,
+                        f"{arch}.attention.head_count": 8, f"{arch}.attention.head_count_kv": 2,
+                        "tokenizer.ggml.tokens": [f"t{i}" for i in range(n_vocab)]}, tensors)